@@ -32,3 +32,27 @@ except NameError:    # pragma: no cover Python >= 3.0
     TEXT = str
 else:
     TEXT = unicode
+
+try:
+    import Queue as queue
+except ImportError:  # pragma: no cover Python 3.x
+    import queue
+
+try:
+    intern = intern
+except NameError:    # pragma: no cover Python 3.x
+    from sys import intern
+
+try:
+    from urllib import unquote
+    from urllib2 import urlopen
+    from urlparse import urlsplit
+except ImportError:  # pragma: no cover Python 3.x
+    from urllib.parse import unquote
+    from urllib.parse import urlsplit
+    from urllib.request import urlopen
+
+try:
+    from cStringIO import StringIO as NativeStringIO
+except ImportError:  # pragma: no cover Python 3.x
+    from io import StringIO as NativeStringIO
@@ -0,0 +1,231 @@
+"""ASGI variant of the response logging middleware (Python 3 only).
+
+"""
+import asyncio
+import io
+import traceback
+
+from http.client import responses
+
+from repoze.debug.logwriter import AsyncLogWriter
+from repoze.debug.responselogger import DEFAULT_MAX_CAPTURE
+from repoze.debug.responselogger import BodyCapture
+from repoze.debug.responselogger import BodyCounter
+from repoze.debug.responselogger import ChunkTimer
+from repoze.debug.responselogger import RequestInfo
+from repoze.debug.responselogger import ResponseLoggingMiddleware
+from repoze.debug.responselogger import request_path
+from repoze.debug.ui import DebugGui
+from repoze.debug.ui import is_gui_url
+
+try:
+    _running_loop = asyncio.get_running_loop
+except AttributeError: # pragma: no cover Python < 3.7
+    # returns the running loop when called from a coroutine (3.5.3+)
+    _running_loop = asyncio.get_event_loop
+
+class ASGIResponseLoggingMiddleware(ResponseLoggingMiddleware):
+    """ Log the requests and responses of an ASGI application.
+
+    Writes the same verbose and trace logs (``B`` / ``A`` / ``F`` / ``E``
+    records), and keeps the same entries for the debug UI, as
+    :class:`repoze.debug.responselogger.ResponseLoggingMiddleware`, whose
+    arguments it takes.
+
+    The event loop only captures data in memory:  log records are always
+    formatted and written by an
+    :class:`repoze.debug.logwriter.AsyncLogWriter` (one is created if
+    ``log_writer`` is None), and finished entries are stored, and the
+    debug UI rendered, in the loop's default executor.
+    """
+    def __init__(self, app, max_bodylen, keep, verbose_logger, trace_logger,
+                 log_writer=None, max_memory=0,
+                 max_capture=DEFAULT_MAX_CAPTURE, sampler=None, tail=None,
+                 entries=None, latency=None, counters=None):
+        if log_writer is None:
+            log_writer = AsyncLogWriter()
+        elif log_writer.overflow == 'block':
+            raise ValueError("A 'block' log writer would block the event "
+                             "loop;  use 'drop'")
+        ResponseLoggingMiddleware.__init__(
+            self, app, max_bodylen, keep, verbose_logger, trace_logger,
+            log_writer, max_memory, max_capture, sampler, tail, entries,
+            latency, counters)
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http':
+            # e.g. websocket or lifespan
+            await self.application(scope, receive, send)
+            return
+
+        environ = scope_environ(scope)
+        if is_gui_url(environ):
+            await self.serve_gui(environ, send)
+            return
+
+        if self.counters is not None:
+            self.counters.begin()
+
+        sampled = self.sampler is None or self.sampler(environ)
+        request_id = id(scope)
+        request_info = RequestInfo(self, environ)
+        request_info['method'] = scope['method']
+        request_info['path'] = request_path(environ)
+        request_info['body'] = b''
+        request_info['bodylen'] = 0
+        request_info['begin'] = self.now_ns
+        if sampled and self.tail is None:
+            self.log_request_begin(request_id, request_info)
+        else:
+            self.trace_request_begin(request_id, request_info)
+
+        entry = None
+        if sampled:
+            entry = {'id': request_id, 'request': request_info}
+            if self.keep and self.tail is None:
+                self.entries.append(entry)
+            request_capture = BodyCapture(self.capture_limit)
+            capture = BodyCapture(self.capture_limit)
+        else:
+            # only the trace log is written
+            request_capture = BodyCounter()
+            capture = BodyCounter()
+        timer = ChunkTimer()
+        response = []
+
+        async def receive_wrapper():
+            message = await receive()
+            if message['type'] == 'http.request':
+                request_capture.feed(message.get('body', b''))
+            return message
+
+        async def send_wrapper(message):
+            if message['type'] == 'http.response.start':
+                response.append(self.start_response(request_id, message,
+                                                    entry))
+            elif message['type'] == 'http.response.body':
+                chunk = message.get('body', b'')
+                if chunk and timer.tick(self.now_ns):
+                    self.trace('F', request_id, timer.first)
+                capture.feed(chunk)
+            await send(message)
+
+        wait = False
+        exception = None
+        try:
+            await self.application(scope, receive_wrapper, send_wrapper)
+            wait = True
+        except asyncio.CancelledError:
+            # e.g. on a disconnect:  the request was aborted, not finished
+            # (CancelledError isn't an Exception since Python 3.8)
+            exception = traceback.format_exc()
+            raise
+        except Exception:
+            exception = traceback.format_exc()
+            wait = True
+            raise
+        finally:
+            # also runs if the request is cancelled, e.g. on a disconnect;
+            # the bookkeeping then goes ahead without us waiting for it
+            end = self.now_ns
+            if response:
+                response_info = response[0]
+            else:
+                if exception is None:
+                    status = '500 Response Not Started'
+                else:
+                    status = '500 Exception Raised'
+                response_info = self.get_response_info(status, [])
+                response_info['begin'] = end
+                if entry is not None:
+                    entry['response'] = response_info
+            if exception is not None:
+                response_info['exception'] = exception
+            request_info['body'] = request_capture.logvalue()
+            request_info['bodylen'] = request_capture.bodylen
+            response_info['body'] = capture.logvalue()
+            response_info['first_byte'] = timer.first
+            response_info['chunks'] = timer.chunks
+            response_info['max_gap'] = timer.max_gap
+            if sampled:
+                done = _running_loop().run_in_executor(
+                    None, self.log_response_end, request_id, request_info,
+                    response_info, capture.bodylen, entry, None, end)
+                if wait:
+                    await done
+            else:
+                self.record_response(request_id, request_info,
+                                     response_info['status'],
+                                     capture.bodylen, end)
+                if exception is None:
+                    self.trace_response_end(request_id, end, capture.bodylen,
+                                            timer.chunks, timer.max_gap)
+
+    def start_response(self, request_id, message, entry):
+        """ Record the start of a response, from its ASGI message.
+        """
+        code = message['status']
+        headers = [(name.decode('latin1'), value.decode('latin1'))
+                   for name, value in message.get('headers', ())]
+        response_info = self.get_response_info(
+            '%d %s' % (code, responses.get(code, '')), headers)
+        response_info['begin'] = self.now_ns
+        if entry is not None:
+            entry['response'] = response_info
+        self.log_response_begin(request_id, response_info)
+        return response_info
+
+    async def serve_gui(self, environ, send):
+        """ Render the debug UI (a WSGI application) in the executor.
+        """
+        status_headers = []
+        def start_response(status, headers, exc_info=None):
+            status_headers[:] = [status, headers]
+        def render():
+            return b''.join(DebugGui(self)(environ, start_response))
+        body = await _running_loop().run_in_executor(None, render)
+        status, headers = status_headers
+        await send({'type': 'http.response.start',
+                    'status': int(status.split(' ', 1)[0]),
+                    'headers': [(name.lower().encode('latin1'),
+                                 value.encode('latin1'))
+                                for name, value in headers],
+                   })
+        await send({'type': 'http.response.body', 'body': body})
+
+def scope_environ(scope):
+    """ Build a WSGI-style environ describing the ASGI ``scope``.
+
+    It is what the request details (URL, CGI and WSGI variables) of the
+    verbose log and the debug UI are computed from.
+    """
+    server = scope.get('server') or ('localhost', 80)
+    environ = {
+        'REQUEST_METHOD': scope['method'],
+        'SCRIPT_NAME': scope.get('root_path', ''),
+        'PATH_INFO': scope['path'],
+        'QUERY_STRING': scope.get('query_string', b'').decode('latin1'),
+        'SERVER_NAME': server[0],
+        'SERVER_PORT': str(server[1]),
+        'SERVER_PROTOCOL': 'HTTP/%s' % scope.get('http_version', '1.1'),
+        'wsgi.url_scheme': scope.get('scheme', 'http'),
+        'wsgi.input': io.BytesIO(),
+        'wsgi.errors': io.StringIO(),
+        'wsgi.version': (1, 0),
+        'wsgi.multithread': False,
+        'wsgi.multiprocess': False,
+        'wsgi.run_once': False,
+        'asgi.version': scope.get('asgi', {}).get('version', '2.0'),
+        }
+    client = scope.get('client')
+    if client:
+        environ['REMOTE_ADDR'] = client[0]
+    for name, value in scope.get('headers', ()):
+        name = name.decode('latin1').upper().replace('-', '_')
+        if name not in ('CONTENT_TYPE', 'CONTENT_LENGTH'):
+            name = 'HTTP_' + name
+        value = value.decode('latin1')
+        if name in environ:
+            value = '%s,%s' % (environ[name], value)
+        environ[name] = value
+    return environ
@@ -0,0 +1,42 @@
+"""Wall-clock timestamps measured with a monotonic clock.
+
+The wall clock is read once, when this module is imported;  later times
+add the elapsed time of a monotonic, high-resolution counter.  Durations
+computed from them are therefore never negative or inflated by clock
+adjustments (e.g. NTP steps), at the price of timestamps drifting from the
+wall clock as it gets adjusted.
+"""
+import time
+
+try:
+    perf_counter_ns = time.perf_counter_ns
+except AttributeError: # pragma: no cover  (Python < 3.7)
+    _perf_counter = getattr(time, 'perf_counter', time.time)
+    def perf_counter_ns():
+        return int(_perf_counter() * 1e9)
+
+try:
+    time_ns = time.time_ns
+except AttributeError: # pragma: no cover  (Python < 3.7)
+    def time_ns():
+        return int(time.time() * 1e9)
+
+# the monotonic counter keeps running across fork(), so the anchor is
+# valid in child processes too
+_EPOCH_NS = time_ns()
+_ANCHOR_NS = perf_counter_ns()
+
+def now_ns():
+    """ Return the current time, in integer nanoseconds since the epoch.
+    """
+    return _EPOCH_NS + perf_counter_ns() - _ANCHOR_NS
+
+def now():
+    """ Return the current time, in (float) seconds since the epoch.
+    """
+    return now_ns() / 1e9
+
+def to_ns(seconds):
+    """ Convert ``seconds`` to integer nanoseconds.
+    """
+    return int(round(seconds * 1e9))
@@ -0,0 +1,568 @@
+"""Storage for the request / response entries shown in the debug UI.
+
+"""
+import collections
+import json
+import mmap
+import os
+import struct
+import sys
+import threading
+
+try:
+    import fcntl
+except ImportError:  # pragma: no cover Windows
+    fcntl = None
+
+from repoze.debug._compat import STRING_TYPES
+from repoze.debug._compat import intern
+
+# rough per-object overhead of the dicts, lists and tuples making up an entry
+_OVERHEAD = 64
+# size of a reference to a shared string
+_POINTER = 8
+# variable and header values are cut to this many characters
+MAX_VALUE_LENGTH = 1024
+_TEXT_TYPES = (bytes,) + STRING_TYPES
+
+def _sizeof(value):
+    if isinstance(value, _TEXT_TYPES):
+        return len(value)
+    return sys.getsizeof(value)
+
+def estimate_size(entry):
+    """ Estimate the number of bytes held by ``entry``.
+
+    Counts bodies, URLs, variables and headers;  this is an approximation,
+    meant for enforcing a memory budget rather than for exact accounting.
+    """
+    size = _OVERHEAD
+    for name in ('request', 'response'):
+        info = entry.get(name)
+        if not info:
+            continue
+        record_size = getattr(info, 'size', None)
+        if record_size is not None:
+            # compacted (see Record)
+            size += record_size
+            continue
+        size += _OVERHEAD
+        environ = getattr(info, 'environ', None)
+        if environ is not None:
+            # not yet broken down into variables (see RequestInfo);  don't
+            # force it just to estimate
+            for k, v in environ.items():
+                size += _OVERHEAD + _sizeof(k) + _sizeof(v)
+            keys = ('body', 'status')
+            variables = ('headers',)
+        else:
+            keys = ('url', 'body', 'status')
+            variables = ('cgi_variables', 'wsgi_variables', 'headers')
+        for key in keys:
+            size += _sizeof(dict.get(info, key) or b'')
+        for key in variables:
+            for k, v in info.get(key, ()):
+                size += _OVERHEAD + _sizeof(k) + _sizeof(v)
+    return size
+
+class StringTable(object):
+    """ Share a single copy of repeated values, e.g. ``Host`` or
+    ``User-Agent`` headers, between entries.
+
+    Only values of at most ``max_length`` characters are shared;  the table
+    is emptied once it holds ``max_strings`` values, so that its size stays
+    bounded.
+    """
+    def __init__(self, max_strings=10000, max_length=256):
+        self.max_strings = max_strings
+        self.max_length = max_length
+        self.strings = {}
+
+    def share(self, value):
+        """ Return ``(value, shared)``, using the table's copy of ``value``
+        if possible.
+        """
+        if len(value) > self.max_length:
+            return value, False
+        strings = self.strings
+        shared = strings.get(value)
+        if shared is None:
+            if len(strings) >= self.max_strings:
+                strings.clear()
+            shared = strings.setdefault(value, value)
+        return shared, True
+
+def _text(value):
+    if isinstance(value, bytes) and not isinstance(value, str):
+        value = value.decode('latin1') # pragma: no cover Python 3.x only
+    elif not isinstance(value, STRING_TYPES):
+        # don't keep (e.g.) the application or request objects alive
+        value = repr(value)
+    if len(value) > MAX_VALUE_LENGTH:
+        value = value[:MAX_VALUE_LENGTH] + '...'
+    return value
+
+_SCALAR_TYPES = (bool, int, float, type(None))
+
+def plain_value(value):
+    """ Return ``value`` if it is plain data (a number, or a tuple of
+    numbers, e.g. ``wsgi.version``), else it as text:  capped, and for
+    other objects their ``repr``.
+    """
+    if isinstance(value, _SCALAR_TYPES):
+        return value
+    if type(value) is tuple:
+        for item in value:
+            if not isinstance(item, _SCALAR_TYPES):
+                break
+        else:
+            return value
+    return _text(value)
+
+def _same_file(st, path):
+    """ Is ``path`` (still) the file of which ``st`` is the status?
+    """
+    try:
+        other = os.stat(path)
+    except OSError:
+        return False
+    return (st.st_dev, st.st_ino) == (other.st_dev, other.st_ino)
+
+def _name(name):
+    if type(name) is str:
+        name = intern(name)
+    return name
+
+class Record(object):
+    """ Compact, read-only mapping of the request or response details of a
+    finished entry.
+
+    Variables and headers become tuples of (interned name, value) pairs,
+    their values text of at most ``MAX_VALUE_LENGTH`` characters, shared
+    through a ``StringTable`` where possible.  ``size`` approximates the
+    bytes held by the record, like ``estimate_size`` (but counting shared
+    values as references).
+    """
+    __slots__ = ('size',)
+    _keys = {}             # mapping key: slot
+    _variables = ()
+
+    def __init__(self, info, strings):
+        size = _OVERHEAD
+        for key, slot in self._keys.items():
+            try:
+                value = info[key]
+            except KeyError:
+                continue
+            if key in self._variables:
+                pairs = []
+                for name, v in value:
+                    name = _name(name)
+                    v, shared = strings.share(_text(v))
+                    size += _OVERHEAD + _sizeof(name)
+                    size += shared and _POINTER or _sizeof(v)
+                    pairs.append((name, v))
+                value = tuple(pairs)
+            elif isinstance(value, _TEXT_TYPES):
+                size += _sizeof(value)
+            setattr(self, slot, value)
+        self.size = size
+
+    def __getitem__(self, key):
+        try:
+            return getattr(self, self._keys[key])
+        except (KeyError, AttributeError):
+            raise KeyError(key)
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def __contains__(self, key):
+        slot = self._keys.get(key)
+        return slot is not None and hasattr(self, slot)
+
+    def keys(self):
+        return [key for key, slot in self._keys.items()
+                if hasattr(self, slot)]
+
+    def __repr__(self):
+        return repr(dict([(key, self[key]) for key in self.keys()]))
+
+class RequestRecord(Record):
+    __slots__ = ('method', 'path', 'url', 'begin', 'body', 'bodylen',
+                 'cgi_variables', 'wsgi_variables')
+    _keys = dict([(x, x) for x in __slots__])
+    _variables = ('cgi_variables', 'wsgi_variables')
+
+class ResponseRecord(Record):
+    __slots__ = ('status', 'headers', 'content_length', 'begin', 'end',
+                 'body', 'exception', 'first_byte', 'chunks', 'max_gap')
+    _keys = dict([(x, x) for x in __slots__])
+    _keys['content-length'] = _keys.pop('content_length')
+    _variables = ('headers',)
+
+def compact_entry(entry, strings):
+    """ Replace the request and response details of the (finished)
+    ``entry`` by records, in place.
+
+    Return True if anything was replaced.
+    """
+    compacted = False
+    for name, cls in (('request', RequestRecord),
+                      ('response', ResponseRecord)):
+        info = entry.get(name)
+        if info is not None and not isinstance(info, Record):
+            entry[name] = cls(info, strings)
+            compacted = True
+    return compacted
+
+def _finished(entry):
+    return 'end' in entry.get('response', ())
+
+class EntryStore(object):
+    """ Ring buffer of the most recent entries.
+
+    Holds at most ``keep`` entries;  if ``max_memory`` is nonzero, the
+    oldest entries are also evicted once the estimated size of all entries
+    exceeds that many bytes.  Appending and evicting are O(1).
+
+    Iterating over the store walks a snapshot, so that readers (e.g. the
+    debug UI) don't hold the lock while rendering.  Finished entries are
+    compacted (see ``Record``) when first read rather than as they finish,
+    so that serving requests doesn't pay for it.
+    """
+    def __init__(self, keep, max_memory=0):
+        self.keep = keep
+        self.max_memory = max_memory
+        self.memory = 0
+        self.lock = threading.Lock()
+        self.strings = StringTable()
+        self._entries = collections.deque()
+        self._sizes = {}
+
+    def append(self, entry):
+        size = self.max_memory and estimate_size(entry) or 0
+        self.lock.acquire()
+        try:
+            while self._entries and len(self._entries) >= self.keep:
+                self._evict()
+            self._entries.append(entry)
+            self._sizes[id(entry)] = size
+            self.memory += size
+            self._enforce_budget()
+        finally:
+            self.lock.release()
+
+    def update(self, entry):
+        """ Re-account ``entry`` once it has grown (e.g. gained a response).
+        """
+        if not self.max_memory:
+            return
+        size = estimate_size(entry)
+        self.lock.acquire()
+        try:
+            old = self._sizes.get(id(entry))
+            if old is None:
+                return # already evicted
+            self._sizes[id(entry)] = size
+            self.memory += size - old
+            self._enforce_budget()
+        finally:
+            self.lock.release()
+
+    def _enforce_budget(self):
+        if self.max_memory:
+            while len(self._entries) > 1 and self.memory > self.max_memory:
+                self._evict()
+
+    def _evict(self):
+        entry = self._entries.popleft()
+        self.memory -= self._sizes.pop(id(entry), 0)
+
+    def _compact(self, entries):
+        compacted = [entry for entry in entries
+                     if _finished(entry) and
+                        compact_entry(entry, self.strings)]
+        if not compacted or not self.max_memory:
+            return
+        sizes = [(entry, estimate_size(entry)) for entry in compacted]
+        self.lock.acquire()
+        try:
+            for entry, size in sizes:
+                old = self._sizes.get(id(entry))
+                if old is not None: # else, already evicted
+                    self._sizes[id(entry)] = size
+                    self.memory += size - old
+        finally:
+            self.lock.release()
+
+    def snapshot(self):
+        self.lock.acquire()
+        try:
+            entries = list(self._entries)
+        finally:
+            self.lock.release()
+        self._compact(entries)
+        return entries
+
+    def __iter__(self):
+        return iter(self.snapshot())
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __getitem__(self, index):
+        self.lock.acquire()
+        try:
+            entry = self._entries[index]
+        finally:
+            self.lock.release()
+        self._compact([entry])
+        return entry
+
+def _jsonable(value):
+    if isinstance(value, bytes):
+        return value.decode('utf-8', 'replace')
+    if value is None or isinstance(value, (bool, int, float) + STRING_TYPES):
+        return value
+    if isinstance(value, (list, tuple)):
+        return [_jsonable(x) for x in value]
+    return '%s' % (value,)
+
+def serialize_entry(entry, pid):
+    """ Convert ``entry`` into JSON-compatible data, tagged with ``pid``.
+
+    Bodies are decoded as UTF-8, and values which JSON can't represent
+    (e.g. the application in the WSGI variables) are converted to text.
+    """
+    record = {'id': entry.get('id'), 'pid': pid}
+    for name in ('request', 'response'):
+        info = entry.get(name)
+        if info is None:
+            continue
+        data = record[name] = {}
+        for key in info.keys():
+            data[key] = _jsonable(info[key])
+        if name == 'request':
+            # computed on demand (see RequestInfo)
+            for key in ('url', 'cgi_variables', 'wsgi_variables'):
+                try:
+                    data[key] = _jsonable(info[key])
+                except KeyError:
+                    pass
+    return record
+
+class SharedEntryStore(object):
+    """ Ring of the most recent entries, shared by all processes on a host.
+
+    Entries are stored, JSON-encoded, in the fixed-size slots of a
+    memory-mapped file at ``path``, so that the debug UI served by any
+    worker process shows the requests served by all of them.  Entries are
+    written once their response is finished;  each is tagged with the pid
+    of the process which served it.  Entries larger than ``slot_size``
+    lose their bodies, then their variables.
+
+    Processes sharing a file must use the same ``keep`` and ``slot_size``
+    (at least 1KB).  A store opened with another geometry (e.g. after a
+    configuration change) replaces the file with a new one, rather than
+    resizing a file which older processes may still have mapped;  those
+    keep using the old file until they exit.
+    """
+    MAGIC = b'RZENTRY1'
+    HEADER = struct.Struct('<8sIIQ')   # magic, slots, slot size, sequence
+    SLOT = struct.Struct('<QI')        # sequence, length
+
+    max_memory = 0
+    memory = 0
+
+    def __init__(self, path, keep, slot_size=65536):
+        if fcntl is None: # pragma: no cover
+            raise ValueError('Shared entries need fcntl')
+        if slot_size < 1024:
+            raise ValueError('slot_size must be at least 1KB')
+        self.path = path
+        self.keep = keep
+        self.slot_size = slot_size
+        self.lock = threading.Lock()
+        self._pending = set()
+        size = self.HEADER.size + keep * slot_size
+        while True:
+            self.fd = os.open(path, os.O_RDWR | os.O_CREAT, int('0600', 8))
+            self._lock_file(fcntl.LOCK_EX)
+            try:
+                st = os.fstat(self.fd)
+                header = os.read(self.fd, self.HEADER.size)
+                if not _same_file(st, path):
+                    # replaced by another process meanwhile:  open it anew
+                    opened = False
+                elif st.st_size == 0:
+                    # a new file
+                    os.ftruncate(self.fd, size)
+                    os.lseek(self.fd, 0, os.SEEK_SET)
+                    os.write(self.fd,
+                             self.HEADER.pack(self.MAGIC, keep, slot_size, 0))
+                    opened = True
+                elif (st.st_size == size and
+                      len(header) == self.HEADER.size and
+                      self.HEADER.unpack(header)[:3] ==
+                          (self.MAGIC, keep, slot_size)):
+                    opened = True
+                else:
+                    # other processes may have mapped the file:  shrinking
+                    # it would crash them (SIGBUS) when reading its end
+                    self._replace_file(size)
+                    opened = False
+                if opened:
+                    self.map = mmap.mmap(self.fd, size)
+            finally:
+                self._unlock_file()
+            if opened:
+                break
+            os.close(self.fd)
+
+    def _replace_file(self, size):
+        """ Atomically replace the file at ``path`` with an empty one of
+        ``size`` bytes, for our geometry.
+        """
+        tmp = '%s.%d.tmp' % (self.path, os.getpid())
+        fd = os.open(tmp, os.O_RDWR | os.O_CREAT | os.O_TRUNC,
+                     int('0600', 8))
+        try:
+            os.ftruncate(fd, size)
+            os.write(fd, self.HEADER.pack(self.MAGIC, self.keep,
+                                          self.slot_size, 0))
+        finally:
+            os.close(fd)
+        os.rename(tmp, self.path)
+
+    def _header(self):
+        """ Return the slot count, slot size and sequence of the mapped
+        file, checking that its slots lie within the mapping and the file.
+        """
+        magic, slots, slot_size, sequence = self.HEADER.unpack_from(
+            self.map, 0)
+        end = self.HEADER.size + slots * slot_size
+        if (magic != self.MAGIC or slot_size < self.SLOT.size or
+            end > len(self.map) or end > os.fstat(self.fd).st_size):
+            raise ValueError('Shared entries file %r was changed by another '
+                             'process' % self.path)
+        return slots, slot_size, sequence
+
+    def _lock_file(self, mode):
+        self.lock.acquire()
+        try:
+            # POSIX locks are per process;  the thread lock covers threads
+            fcntl.lockf(self.fd, mode, self.HEADER.size, 0, os.SEEK_SET)
+        except:
+            self.lock.release()
+            raise
+
+    def _unlock_file(self):
+        try:
+            fcntl.lockf(self.fd, fcntl.LOCK_UN, self.HEADER.size, 0,
+                        os.SEEK_SET)
+        finally:
+            self.lock.release()
+
+    def append(self, entry):
+        if _finished(entry):
+            self._write(entry)
+        else:
+            # written once finished, via ``update``
+            self._pending.add(id(entry))
+
+    def update(self, entry):
+        if id(entry) in self._pending:
+            self._pending.discard(id(entry))
+            self._write(entry)
+
+    def _encode(self, entry):
+        record = serialize_entry(entry, os.getpid())
+        limit = self.slot_size - self.SLOT.size
+        data = json.dumps(record).encode('utf-8')
+        infos = [record[name] for name in ('request', 'response')
+                 if name in record]
+        if len(data) > limit:
+            for info in infos:
+                info['body'] = '(not shared: entry too large)'
+            data = json.dumps(record).encode('utf-8')
+        if len(data) > limit:
+            for info in infos:
+                for key in ('cgi_variables', 'wsgi_variables', 'headers'):
+                    if key in info:
+                        info[key] = []
+            data = json.dumps(record).encode('utf-8')
+        if len(data) > limit:
+            request = record.get('request', {})
+            record = {'id': record['id'], 'pid': record['pid'],
+                      'request': {'method': (request.get('method')
+                                             or '')[:16],
+                                  'url': (request.get('url') or '')[:256],
+                                  'begin': request.get('begin'),
+                                  'body': '',
+                                  'cgi_variables': [],
+                                  'wsgi_variables': [],
+                                 }}
+            data = json.dumps(record).encode('utf-8')
+        return data
+
+    def _write(self, entry):
+        data = self._encode(entry)
+        self._lock_file(fcntl.LOCK_EX)
+        try:
+            try:
+                slots, slot_size, sequence = self._header()
+            except ValueError:
+                return # don't fail the request:  the entry is lost
+            if len(data) > slot_size - self.SLOT.size:
+                return
+            sequence += 1
+            self.HEADER.pack_into(self.map, 0, self.MAGIC, slots, slot_size,
+                                  sequence)
+            offset = self.HEADER.size + ((sequence - 1) % slots) * slot_size
+            self.SLOT.pack_into(self.map, offset, sequence, len(data))
+            start = offset + self.SLOT.size
+            self.map[start:start + len(data)] = data
+        finally:
+            self._unlock_file()
+
+    def snapshot(self):
+        """ Return the stored entries, oldest first.
+        """
+        records = []
+        self._lock_file(fcntl.LOCK_SH)
+        try:
+            slots, slot_size, last = self._header()
+            offset = self.HEADER.size
+            for i in range(slots):
+                sequence, length = self.SLOT.unpack_from(self.map, offset)
+                if sequence:
+                    start = offset + self.SLOT.size
+                    length = min(length, slot_size - self.SLOT.size)
+                    records.append((sequence, self.map[start:start + length]))
+                offset += slot_size
+        finally:
+            self._unlock_file()
+        records.sort(key=lambda x: x[0])
+        return [json.loads(data.decode('utf-8')) for sequence, data in records]
+
+    def __iter__(self):
+        return iter(self.snapshot())
+
+    def __len__(self):
+        self._lock_file(fcntl.LOCK_SH)
+        try:
+            slots, slot_size, sequence = self._header()
+        finally:
+            self._unlock_file()
+        return min(sequence, slots)
+
+    def __getitem__(self, index):
+        return self.snapshot()[index]
+
+    def close(self):
+        self.map.close()
+        os.close(self.fd)
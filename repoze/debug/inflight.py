@@ -0,0 +1,175 @@
+"""Registry of the requests being served, and of the threads serving them.
+
+"""
+import threading
+
+from repoze.debug import clock
+from repoze.debug._compat import thread
+
+class InflightRequest(object):
+    """ A request being served, by the thread ``thread_id``.
+
+    ``info`` holds the request details (see
+    :class:`repoze.debug.responselogger.RequestInfo`);  ``begin`` is in
+    seconds since the epoch.
+    """
+    __slots__ = ('request_id', 'thread_id', 'method', 'info', 'begin',
+                 'reported')
+
+    def __init__(self, request_id, thread_id, method, info, begin):
+        self.request_id = request_id
+        self.thread_id = thread_id
+        self.method = method
+        self.info = info
+        self.begin = begin
+        self.reported = None # when the watchdog last reported it
+
+    @property
+    def url(self):
+        return self.info.get('url')
+
+class InflightRegistry(object):
+    """ The requests being served, by request id.
+
+    Registering a request costs a dict update under a lock;  the request is
+    attributed to the thread registering it.
+    """
+    def __init__(self):
+        self.requests = {}
+        self.lock = threading.Lock()
+
+    def begin(self, request_id, method, info, begin):
+        request = InflightRequest(request_id, thread.get_ident(), method,
+                                  info, begin)
+        self.lock.acquire()
+        try:
+            self.requests[request_id] = request
+        finally:
+            self.lock.release()
+        return request
+
+    def end(self, request_id):
+        self.lock.acquire()
+        try:
+            self.requests.pop(request_id, None)
+        finally:
+            self.lock.release()
+
+    def get(self, request_id):
+        return self.requests.get(request_id)
+
+    def by_thread(self):
+        """ Map the ids of the threads serving requests to their request
+        (the earliest one, should a thread be serving several).
+
+        The lock isn't taken (copying the dict is atomic), so that this may
+        be called from a signal handler, which may have interrupted a
+        thread holding it.
+        """
+        requests = list(self.requests.values())
+        requests.sort(key=lambda x: x.begin, reverse=True)
+        result = {}
+        for request in requests:
+            result[request.thread_id] = request
+        return result
+
+    def snapshot(self):
+        """ Return the requests being served, longest-running first.
+        """
+        self.lock.acquire()
+        try:
+            requests = list(self.requests.values())
+        finally:
+            self.lock.release()
+        requests.sort(key=lambda x: x.begin)
+        return requests
+
+    def clear(self):
+        self.lock.acquire()
+        try:
+            self.requests = {}
+        finally:
+            self.lock.release()
+
+    def __len__(self):
+        return len(self.requests)
+
+# the registry shared by the middlewares of the process, unless they are
+# given their own
+default_registry = InflightRegistry()
+
+class EnvironInfo(dict):
+    """ Request details for the registry, the URL only being computed from
+    the environ when first looked up (e.g. to dump the threads).
+    """
+    def __init__(self, environ):
+        dict.__init__(self)
+        self.environ = environ
+
+    def __missing__(self, key):
+        if key != 'url':
+            raise KeyError(key)
+        from repoze.debug.responselogger import construct_url
+        url = self['url'] = construct_url(self.environ)
+        return url
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+class InflightMiddleware(object):
+    """ Register each request in ``registry`` while it is being served, so
+    that thread dumps show which request each thread is serving.
+
+    Requests already registered, e.g. by an outer response logger, are
+    passed through.
+    """
+    def __init__(self, app, registry=None):
+        if registry is None:
+            registry = default_registry
+        self.app = app
+        self.registry = registry
+
+    def __call__(self, environ, start_response):
+        registry = self.registry
+        request_id = id(environ)
+        if registry.get(request_id) is not None:
+            return self.app(environ, start_response)
+        registry.begin(request_id, environ.get('REQUEST_METHOD', 'GET'),
+                       EnvironInfo(environ), clock.now())
+        try:
+            app_iter = self.app(environ, start_response)
+        except:
+            registry.end(request_id)
+            raise
+        # keep e.g. wsgi.file_wrapper responses recognizable by the server
+        from repoze.debug.responselogger import call_on_close
+        if call_on_close(app_iter, lambda: registry.end(request_id)):
+            return app_iter
+        return ClosingIterator(app_iter, registry.end, request_id)
+
+class ClosingIterator(object):
+    """ Iterate over ``app_iter``, calling ``callback(*args)`` once it is
+    closed.
+    """
+    def __init__(self, app_iter, callback, *args):
+        self.app_iter = app_iter
+        self.callback = callback
+        self.args = args
+
+    def __iter__(self):
+        return iter(self.app_iter)
+
+    def close(self):
+        try:
+            close = getattr(self.app_iter, 'close', None)
+            if close is not None:
+                close()
+        finally:
+            self.callback(*self.args)
+
+def make_middleware(app, global_conf):
+    """ Paste filter-app converter """
+    return InflightMiddleware(app)
@@ -0,0 +1,456 @@
+"""Background log writing for the response logger.
+
+Request threads hand small raw records to an ``AsyncLogWriter``;  a single
+writer thread formats them and passes them to the loggers in batches, so
+that file I/O, handler locks and rollover checks stay off the request path.
+
+``AppendFile`` (and ``AppendLogHandler``, its ``logging`` handler) lets
+several processes share one log file safely.
+"""
+import atexit
+import logging
+import os
+import re
+import shutil
+import sys
+import threading
+import time
+import traceback
+
+try:
+    import fcntl
+except ImportError:  # pragma: no cover Windows
+    fcntl = None
+
+from repoze.debug import clock
+from repoze.debug._compat import STRING_TYPES
+from repoze.debug._compat import gzip
+from repoze.debug._compat import queue
+
+_STOP = object()
+
+def format_record(fmt, args):
+    """ Render a raw log record.
+
+    ``fmt`` is either a '%'-style format string or a callable which
+    returns the message when called with ``args``.
+    """
+    if callable(fmt):
+        return fmt(*args)
+    return fmt % args
+
+class AsyncLogWriter(object):
+    """ Format and write log records on a background thread.
+
+    ``maxsize`` bounds the number of records waiting to be written.  When
+    the queue is full, ``overflow`` decides what happens to a new record:
+    'drop' discards it and counts it in ``dropped``, 'block' makes the
+    request thread wait until the writer catches up.
+    """
+    def __init__(self, maxsize=10000, overflow='drop', batch_size=100):
+        if overflow not in ('drop', 'block'):
+            raise ValueError('Unknown overflow policy: %s' % overflow)
+        self.queue = queue.Queue(maxsize)
+        self.overflow = overflow
+        self.batch_size = batch_size
+        self.dropped = 0
+        self.lock = threading.Lock()
+        self.thread = None
+        self.pid = None
+        self._registered = False
+
+    def put(self, logger, fmt, args):
+        """ Queue a record;  ``logger.info`` is called with the formatted
+        message on the writer thread.
+        """
+        self.start()
+        record = (logger, fmt, args)
+        if self.overflow == 'block':
+            self.queue.put(record)
+            return
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.lock.acquire()
+            try:
+                self.dropped += 1
+            finally:
+                self.lock.release()
+
+    def start(self):
+        # Threads do not survive a fork:  (re)start the writer lazily in
+        # whichever process actually serves requests.
+        pid = os.getpid()
+        if self.thread is not None and self.pid == pid:
+            return
+        self.lock.acquire()
+        try:
+            if self.thread is None or self.pid != pid:
+                if self.pid != pid:
+                    # a queue inherited across a fork may hold a stale lock
+                    self.queue = queue.Queue(self.queue.maxsize)
+                thread = threading.Thread(target=self.run,
+                                          name='repoze.debug log writer')
+                thread.daemon = True
+                thread.start()
+                if not self._registered:
+                    atexit.register(self.close)
+                    self._registered = True
+                self.thread = thread
+                self.pid = pid
+        finally:
+            self.lock.release()
+
+    def run(self):
+        while True:
+            batch = [self.queue.get()]
+            try:
+                while len(batch) < self.batch_size:
+                    batch.append(self.queue.get_nowait())
+            except queue.Empty:
+                pass
+            stop = _STOP in batch
+            if stop:
+                batch = batch[:batch.index(_STOP)]
+            try:
+                self.write(batch)
+            finally:
+                for i in range(len(batch) + stop):
+                    self.queue.task_done()
+            if stop:
+                return
+
+    def write(self, batch):
+        """ Format a batch of records and hand them to their loggers.
+
+        Consecutive text messages for the same logger are joined into a
+        single call to ``logger.info`` where that writes the same as one
+        call per message (see ``joinable``).
+        """
+        pending = []
+        current = None
+        for logger, fmt, args in batch:
+            try:
+                message = format_record(fmt, args)
+            except Exception:
+                traceback.print_exc(file=sys.stderr)
+                continue
+            text = isinstance(message, STRING_TYPES)
+            if logger is not current or not text:
+                self._flush(current, pending)
+                current = logger
+                pending = []
+            pending.append(message)
+        self._flush(current, pending)
+
+    def _flush(self, logger, messages):
+        if not messages:
+            return
+        try:
+            if isinstance(messages[0], STRING_TYPES) and joinable(logger):
+                logger.info('\n'.join(messages))
+            else:
+                for message in messages:
+                    logger.info(message)
+        except Exception:
+            traceback.print_exc(file=sys.stderr)
+
+    def flush(self):
+        """ Block until every queued record has been written.
+        """
+        if self.thread is not None and self.pid == os.getpid():
+            self.queue.join()
+
+    def close(self, timeout=None):
+        """ Write out pending records and stop the writer thread.
+        """
+        thread = self.thread
+        if thread is None or self.pid != os.getpid():
+            return
+        self.queue.put(_STOP)
+        thread.join(timeout)
+        self.thread = None
+
+def joinable(logger):
+    """ Can messages for ``logger`` be joined by newlines into one record?
+
+    Only if it writes them as they are, line by line:  a plain
+    ``logging.Logger``, without filters or parents to propagate to, whose
+    handlers are all ``AppendLogHandler`` instances without filters or
+    formatters (as set up by the Paste factory).  Other loggers get one
+    record per message, so that their formatters and filters apply to
+    each.
+    """
+    if not isinstance(logger, logging.Logger) or logger.filters:
+        return False
+    if logger.propagate and logger.parent is not None:
+        return False
+    if not logger.handlers:
+        return False
+    for handler in logger.handlers:
+        if (not isinstance(handler, AppendLogHandler) or handler.filters or
+            handler.formatter is not None):
+            return False
+    return True
+
+class AppendFile(object):
+    """ A log file shared by several processes.
+
+    Each ``write`` is a single ``os.write`` to a descriptor opened with
+    ``O_APPEND``, so that records written by different processes never
+    interleave.  Once the file reaches ``max_bytes`` (0:  never), the
+    process which notices renames it, under an ``flock`` on
+    ``<filename>.lock``, to ``<filename>.<timestamp>``;  the other
+    processes reopen ``filename`` when they see that it is a new file,
+    checking at most every ``check_interval`` seconds.  Rotated files are
+    gzipped on a background thread, ``compress_delay`` seconds later (so
+    that the last records written by other processes get in first), and
+    only the newest ``backup_count`` are kept.
+
+    ``header`` is written at the start of every new file.  ``generation``
+    counts the times the file was (re)opened.
+    """
+    _ROTATED = r'\.\d{8}-\d{6}-\d{6}(\.gz)?$'
+
+    def __init__(self, filename, max_bytes=0, backup_count=0, header=b'',
+                 check_interval=1.0, compress=True, compress_delay=None,
+                 mode=0o644):
+        self.filename = os.path.abspath(filename)
+        self.max_bytes = max_bytes
+        self.backup_count = backup_count
+        self.header = header
+        self.check_interval = check_interval
+        self.compress = compress
+        if compress_delay is None:
+            compress_delay = 2 * check_interval
+        self.compress_delay = compress_delay
+        self.mode = mode
+        self.lock = threading.Lock()
+        self.fd = None
+        self.size = 0
+        self.generation = 0
+        self.checked = 0
+        self.compressor = None
+        self._rotated = re.compile(
+            re.escape(os.path.basename(self.filename)) + self._ROTATED)
+        self.lock.acquire()
+        try:
+            self._open()
+        finally:
+            self.lock.release()
+
+    def _open(self):
+        fd = os.open(self.filename, os.O_WRONLY | os.O_APPEND | os.O_CREAT,
+                     self.mode)
+        if self.fd is not None:
+            os.close(self.fd)
+        self.fd = fd
+        self.size = os.fstat(fd).st_size
+        if self.header and not self.size:
+            self.size += os.write(fd, self.header)
+        self.generation += 1
+        self.checked = clock.now()
+
+    def tell(self):
+        return self.size
+
+    def write(self, data):
+        """ Append ``data`` to the file, then rotate it if it is full.
+        """
+        self.lock.acquire()
+        try:
+            written = os.write(self.fd, data)
+            while written < len(data): # pragma: no cover (e.g. disk full)
+                written += os.write(self.fd, data[written:])
+            self.size += written
+            if self.max_bytes and self.backup_count:
+                if self.size >= self.max_bytes:
+                    # the size is only what we know of:  check the file
+                    self.size = os.fstat(self.fd).st_size
+                    if self.size >= self.max_bytes:
+                        self._rotate()
+        finally:
+            self.lock.release()
+
+    def refresh(self):
+        """ Reopen the file if it was rotated (e.g. by another process).
+
+        Checks at most every ``check_interval`` seconds.
+        """
+        now = clock.now()
+        if now - self.checked < self.check_interval:
+            return
+        self.lock.acquire()
+        try:
+            self.checked = now
+            if self._moved():
+                self._open()
+        finally:
+            self.lock.release()
+
+    def reopen(self):
+        """ Reopen the file unconditionally, e.g. from a signal handler
+        after an external tool rotated it.
+        """
+        self.lock.acquire()
+        try:
+            self._open()
+        finally:
+            self.lock.release()
+
+    def _moved(self):
+        try:
+            st = os.stat(self.filename)
+        except OSError:
+            return True
+        current = os.fstat(self.fd)
+        return (st.st_ino, st.st_dev) != (current.st_ino, current.st_dev)
+
+    def _rotate(self):
+        lock_fd = os.open(self.filename + '.lock', os.O_WRONLY | os.O_CREAT,
+                          self.mode)
+        try:
+            if fcntl is not None:
+                fcntl.flock(lock_fd, fcntl.LOCK_EX)
+            if not self._moved():
+                # nobody else rotated it meanwhile
+                now = clock.now()
+                rotated = '%s.%s-%06d' % (
+                    self.filename,
+                    time.strftime('%Y%m%d-%H%M%S', time.localtime(now)),
+                    int(now % 1 * 1000000))
+                os.rename(self.filename, rotated)
+                self._compressor().put(rotated)
+            self._open()
+        finally:
+            os.close(lock_fd) # releases the flock
+
+    def _compressor(self):
+        compressor = self.compressor
+        if compressor is None or compressor.pid != os.getpid():
+            compressor = self.compressor = Compressor(self)
+        return compressor
+
+    def backups(self):
+        """ Return the rotated files, oldest first.
+        """
+        dirname = os.path.dirname(self.filename)
+        names = sorted([name for name in os.listdir(dirname)
+                        if self._rotated.match(name)])
+        return [os.path.join(dirname, name) for name in names]
+
+    def prune(self):
+        """ Remove all but the newest ``backup_count`` rotated files.
+        """
+        backups = self.backups()
+        for filename in backups[:max(0, len(backups) - self.backup_count)]:
+            try:
+                os.remove(filename)
+            except OSError: # pragma: no cover (removed meanwhile)
+                pass
+
+    def flush(self):
+        """ Block until the pending rotated files are compressed.
+        """
+        compressor = self.compressor
+        if compressor is not None and compressor.pid == os.getpid():
+            compressor.join()
+
+    def close(self):
+        self.lock.acquire()
+        try:
+            if self.fd is not None:
+                os.close(self.fd)
+                self.fd = None
+        finally:
+            self.lock.release()
+
+class Compressor(object):
+    """ Gzip (and prune) the files rotated by an ``AppendFile`` on a
+    background thread, which exits once there is nothing left to do.
+    """
+    def __init__(self, append_file):
+        self.append_file = append_file
+        self.pending = []
+        self.lock = threading.Lock()
+        self.thread = None
+        self.pid = os.getpid()
+
+    def put(self, filename):
+        due = clock.now() + self.append_file.compress_delay
+        self.lock.acquire()
+        try:
+            self.pending.append((filename, due))
+            if self.thread is None:
+                self.thread = threading.Thread(
+                    target=self.run, name='repoze.debug log compressor')
+                self.thread.daemon = True
+                self.thread.start()
+        finally:
+            self.lock.release()
+
+    def run(self):
+        while True:
+            self.lock.acquire()
+            try:
+                if not self.pending:
+                    self.thread = None
+                    return
+                filename, due = self.pending.pop(0)
+            finally:
+                self.lock.release()
+            try:
+                delay = due - clock.now()
+                if delay > 0:
+                    time.sleep(delay)
+                if self.append_file.compress and gzip is not None:
+                    compress_file(filename)
+                self.append_file.prune()
+            except Exception:
+                traceback.print_exc(file=sys.stderr)
+
+    def join(self):
+        """ Wait for the pending files to be processed.
+        """
+        while True:
+            thread = self.thread
+            if thread is None:
+                return
+            thread.join()
+
+def compress_file(filename):
+    """ Replace ``filename`` with a gzipped copy, ``filename + '.gz'``.
+    """
+    tmp = filename + '.gz.tmp'
+    with open(filename, 'rb') as f:
+        out = gzip.open(tmp, 'wb')
+        try:
+            shutil.copyfileobj(f, out)
+        finally:
+            out.close()
+    os.rename(tmp, filename + '.gz')
+    os.remove(filename)
+
+class AppendLogHandler(logging.Handler):
+    """ A ``logging`` handler writing to an ``AppendFile``.
+
+    Each record (or batch of records joined by an ``AsyncLogWriter``) is
+    written as a single, newline-terminated ``os.write``.
+    """
+    def __init__(self, filename, max_bytes=0, backup_count=0, **kw):
+        logging.Handler.__init__(self)
+        self.file = AppendFile(filename, max_bytes, backup_count, **kw)
+
+    def emit(self, record):
+        try:
+            data = self.format(record) + '\n'
+            if not isinstance(data, bytes):
+                data = data.encode('utf-8')
+            self.file.refresh()
+            self.file.write(data)
+        except Exception:
+            self.handleError(record)
+
+    def close(self):
+        self.file.close()
+        logging.Handler.close(self)
@@ -0,0 +1,254 @@
+"""Live latency statistics, kept by the response logger.
+
+"""
+import bisect
+import math
+import re
+import threading
+
+# log-scaled buckets:  4 per doubling (about 19% apart), from 100us up to
+# about 20 minutes;  bucket 0 holds anything faster, the last bucket
+# anything slower
+MIN_LATENCY = 0.0001
+BUCKETS_PER_DOUBLING = 4
+BUCKETS = 94
+
+_SCALE = BUCKETS_PER_DOUBLING / math.log(2)
+_ID = re.compile(r'^(?:\d+'
+                 r'|[0-9a-fA-F]{8}-(?:[0-9a-fA-F]{4}-){3}[0-9a-fA-F]{12}'
+                 r'|(?=[^/]*\d)[0-9a-fA-F]{16,})$')
+MAX_ROUTE_LENGTH = 200
+OTHER_ROUTES = '(other)'
+
+def normalize_path(path):
+    """ Turn ``path`` into a route, replacing numbers and ids with '{id}'.
+    """
+    segments = path.split('/')
+    for i, segment in enumerate(segments):
+        if segment and _ID.match(segment):
+            segments[i] = '{id}'
+    return '/'.join(segments)[:MAX_ROUTE_LENGTH]
+
+def bucket_bound(index):
+    """ Upper bound, in seconds, of bucket ``index``.
+    """
+    return MIN_LATENCY * 2 ** (float(index) / BUCKETS_PER_DOUBLING)
+
+class LatencyHistogram(object):
+    """ Log-bucketed histogram of durations, in constant memory.
+
+    Percentiles are reported as the upper bound of the bucket they fall in
+    (so they are at most ~19% high), capped at the largest duration seen.
+    """
+    def __init__(self):
+        self.counts = [0] * (BUCKETS + 1)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def record(self, duration):
+        if duration > MIN_LATENCY:
+            index = int(math.ceil(math.log(duration / MIN_LATENCY) * _SCALE))
+            index = min(index, BUCKETS)
+        else:
+            index = 0
+        self.counts[index] += 1
+        self.count += 1
+        self.total += duration
+        if duration > self.max:
+            self.max = duration
+
+    def merge(self, other):
+        """ Add the durations recorded by ``other``.
+        """
+        self.counts = [x + y for x, y in zip(self.counts, other.counts)]
+        self.count += other.count
+        self.total += other.total
+        self.max = max(self.max, other.max)
+
+    def percentile(self, q):
+        """ Return the ``q``th (0 - 100) percentile, or None if empty.
+        """
+        if not self.count:
+            return None
+        rank = max(1, int(math.ceil(self.count * q / 100.0)))
+        seen = 0
+        for index, count in enumerate(self.counts):
+            seen += count
+            if seen >= rank:
+                if index == BUCKETS:
+                    return self.max
+                return min(bucket_bound(index), self.max)
+        return self.max # pragma: no cover
+
+    def summary(self):
+        return {'count': self.count,
+                'mean': self.count and self.total / self.count or 0.0,
+                'p50': self.percentile(50),
+                'p90': self.percentile(90),
+                'p99': self.percentile(99),
+                'max': self.max,
+               }
+
+class LatencyStats(object):
+    """ Latency histograms per (method, route).
+
+    At most ``max_routes`` routes are tracked;  requests to any further
+    routes are counted together under ``OTHER_ROUTES``, so that memory
+    stays bounded however many distinct paths are requested.
+    """
+    def __init__(self, max_routes=500):
+        self.max_routes = max_routes
+        self.histograms = {}
+        self.lock = threading.Lock()
+
+    def record(self, method, path, duration):
+        key = (method, normalize_path(path))
+        self.lock.acquire()
+        try:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                if len(self.histograms) >= self.max_routes:
+                    key = ('*', OTHER_ROUTES)
+                    histogram = self.histograms.get(key)
+                if histogram is None:
+                    histogram = self.histograms[key] = LatencyHistogram()
+            histogram.record(duration)
+        finally:
+            self.lock.release()
+
+    def summaries(self):
+        """ Return a list of per-route summaries, slowest (p99) first.
+        """
+        self.lock.acquire()
+        try:
+            result = []
+            for (method, route), histogram in self.histograms.items():
+                summary = histogram.summary()
+                summary['method'] = method
+                summary['route'] = route
+                result.append(summary)
+        finally:
+            self.lock.release()
+        result.sort(key=lambda x: (-x['p99'], x['route'], x['method']))
+        return result
+
+    def reset(self):
+        self.lock.acquire()
+        try:
+            self.histograms = {}
+        finally:
+            self.lock.release()
+
+def format_summaries(summaries):
+    """ Render ``summaries`` as a plain text table.
+    """
+    fmt = '%9s %9s %9s %9s %9s %9s  %-7s %s'
+    out = [fmt % ('Count', 'Mean', 'P50', 'P90', 'P99', 'Max', 'Method',
+                  'Route')]
+    for summary in summaries:
+        out.append(fmt % (
+            summary['count'],
+            '%.4f' % summary['mean'],
+            '%.4f' % summary['p50'],
+            '%.4f' % summary['p90'],
+            '%.4f' % summary['p99'],
+            '%.4f' % summary['max'],
+            summary['method'],
+            summary['route']))
+    return '\n'.join(out) + '\n'
+
+# bucket bounds (seconds) of the exported latency histogram
+PROMETHEUS_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5,
+                      5.0, 10.0)
+
+class RequestCounters(object):
+    """ Totals of the requests served, for the metrics endpoint.
+
+    Each request costs a couple of integer updates under a lock;  no
+    per-request data is kept.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.in_flight = 0
+        self.statuses = {}
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.buckets = [0] * (len(PROMETHEUS_BUCKETS) + 1)
+        self.duration_sum = 0.0
+        self.duration_count = 0
+
+    def begin(self):
+        self.lock.acquire()
+        try:
+            self.in_flight += 1
+        finally:
+            self.lock.release()
+
+    def end(self, status, bytes_in, bytes_out, duration):
+        status_class = '%sxx' % (status or '?')[:1]
+        index = bisect.bisect_left(PROMETHEUS_BUCKETS, duration)
+        self.lock.acquire()
+        try:
+            self.in_flight -= 1
+            self.statuses[status_class] = self.statuses.get(status_class,
+                                                            0) + 1
+            self.bytes_in += bytes_in or 0
+            self.bytes_out += bytes_out or 0
+            self.buckets[index] += 1
+            self.duration_sum += duration
+            self.duration_count += 1
+        finally:
+            self.lock.release()
+
+def _metric(out, name, kind, help, samples):
+    out.append('# HELP %s %s' % (name, help))
+    out.append('# TYPE %s %s' % (name, kind))
+    for labels, value in samples:
+        out.append('%s%s %s' % (name, labels, value))
+
+def render_prometheus(counters, entries=None, log_writer=None):
+    """ Render the metrics in the Prometheus text exposition format.
+
+    The cost only depends on the number of series, not on the number of
+    requests served or entries kept.
+    """
+    counters.lock.acquire()
+    try:
+        statuses = sorted(counters.statuses.items())
+        in_flight = counters.in_flight
+        bytes_in = counters.bytes_in
+        bytes_out = counters.bytes_out
+        buckets = list(counters.buckets)
+        duration_sum = counters.duration_sum
+        duration_count = counters.duration_count
+    finally:
+        counters.lock.release()
+    out = []
+    _metric(out, 'repoze_debug_requests_total', 'counter',
+            'Requests served, by status class.',
+            [('{status="%s"}' % status, count)
+             for status, count in statuses])
+    _metric(out, 'repoze_debug_requests_in_flight', 'gauge',
+            'Requests being served.', [('', in_flight)])
+    _metric(out, 'repoze_debug_request_bytes_total', 'counter',
+            'Request body bytes read by the application.', [('', bytes_in)])
+    _metric(out, 'repoze_debug_response_bytes_total', 'counter',
+            'Response body bytes sent.', [('', bytes_out)])
+    samples = []
+    seen = 0
+    for bound, count in zip(PROMETHEUS_BUCKETS + ('+Inf',), buckets):
+        seen += count
+        samples.append(('_bucket{le="%s"}' % (bound,), seen))
+    samples.append(('_sum', repr(duration_sum)))
+    samples.append(('_count', duration_count))
+    _metric(out, 'repoze_debug_request_duration_seconds', 'histogram',
+            'Request latency.', samples)
+    if entries is not None:
+        _metric(out, 'repoze_debug_entries_retained', 'gauge',
+                'Entries kept for the debug UI.', [('', len(entries))])
+    if log_writer is not None:
+        _metric(out, 'repoze_debug_log_records_dropped_total', 'counter',
+                'Log records dropped because the log queue was full.',
+                [('', log_writer.dropped)])
+    return '\n'.join(out) + '\n'
@@ -0,0 +1,143 @@
+"""Statistical profiler sampling the stacks of all threads.
+
+"""
+import sys
+import threading
+import time
+
+from repoze.debug import clock
+from repoze.debug._compat import thread
+
+MAX_DEPTH = 200
+
+def frame_label(code):
+    """ Name a function, for the reports:  'name (filename:line)'.
+    """
+    return '%s (%s:%d)' % (code.co_name, code.co_filename,
+                           code.co_firstlineno)
+
+class StackProfile(object):
+    """ Counts of the identical stacks sampled.
+
+    Stacks are keyed by their code objects, outermost first, so that
+    taking a sample formats nothing;  functions are only named when
+    rendering the reports.
+    """
+    def __init__(self):
+        self.stacks = {}
+        self.samples = 0   # sampling passes
+        self.duration = 0.0
+
+    def add(self, frame):
+        codes = []
+        while frame is not None and len(codes) < MAX_DEPTH:
+            codes.append(frame.f_code)
+            frame = frame.f_back
+        codes.reverse()
+        key = tuple(codes)
+        self.stacks[key] = self.stacks.get(key, 0) + 1
+
+    def sample(self, frames, exclude=()):
+        """ Add the stacks of ``frames`` (thread id: frame), but for the
+        threads in ``exclude``.
+        """
+        for thread_id, frame in frames.items():
+            if thread_id not in exclude:
+                self.add(frame)
+        self.samples += 1
+
+    def folded(self):
+        """ Render the stacks in the "folded" format read by flame graph
+        tools:  one 'outer;...;inner count' line per stack, the most
+        sampled first (then in order of their frames' labels).
+        """
+        labels = {}
+        stacks = []
+        for codes, count in self.stacks.items():
+            names = []
+            for code in codes:
+                label = labels.get(code)
+                if label is None:
+                    label = labels[code] = frame_label(code).replace(';',
+                                                                     ':')
+                names.append(label)
+            stacks.append((-count, names))
+        stacks.sort()
+        return ''.join(['%s %d\n' % (';'.join(names), -count)
+                        for count, names in stacks])
+
+    def functions(self):
+        """ Return (label, self, total) sample counts by function, most
+        self samples first.
+
+        ``self`` counts the samples in which the function was running,
+        ``total`` those in which it was on the stack.
+        """
+        own = {}
+        total = {}
+        for codes, count in self.stacks.items():
+            if codes:
+                own[codes[-1]] = own.get(codes[-1], 0) + count
+            for code in set(codes):
+                total[code] = total.get(code, 0) + count
+        result = [(frame_label(code), own.get(code, 0), count)
+                  for code, count in total.items()]
+        result.sort(key=lambda x: (-x[1], -x[2], x[0]))
+        return result
+
+    def top(self, limit=30):
+        """ Render the ``limit`` functions with the most self samples as a
+        plain text table.
+        """
+        stacks = sum(self.stacks.values())
+        out = ['%d samples of %d stacks in %.2f seconds' % (
+            self.samples, stacks, self.duration), '']
+        stacks = stacks or 1
+        fmt = '%8s %7s %8s %7s  %s'
+        out.append(fmt % ('Self', 'Self%', 'Total', 'Total%', 'Function'))
+        for label, own, total in self.functions()[:limit]:
+            out.append(fmt % (own, '%.1f' % (100.0 * own / stacks), total,
+                              '%.1f' % (100.0 * total / stacks), label))
+        return '\n'.join(out) + '\n'
+
+def sample_stacks(seconds, hz, exclude=(), frames=sys._current_frames,
+                  sleep=time.sleep):
+    """ Sample the stacks of all threads, but the calling one and those in
+    ``exclude``, ``hz`` times per second for ``seconds``.
+
+    Return a :class:`StackProfile`.
+    """
+    exclude = set(exclude)
+    exclude.add(thread.get_ident())
+    profile = StackProfile()
+    interval = 1.0 / hz
+    start = clock.now()
+    deadline = start + seconds
+    due = start
+    while True:
+        profile.sample(frames(), exclude)
+        due += interval
+        now = clock.now()
+        if due >= deadline or now >= deadline:
+            break
+        if due > now:
+            sleep(due - now)
+        else:
+            due = now # fell behind:  don't try to catch up
+    profile.duration = clock.now() - start
+    return profile
+
+def profile(seconds, hz):
+    """ Sample the stacks of the other threads from a background thread,
+    waiting for the result.
+    """
+    result = []
+    caller = thread.get_ident()
+    sampler = threading.Thread(
+        target=lambda: result.append(
+            sample_stacks(seconds, hz, exclude=(caller,))),
+        name='repoze.debug profiler')
+    sampler.daemon = True
+    sampler.start()
+    sampler.join()
+    return result[0]
@@ -1,21 +1,53 @@
-import io
 import itertools
 import os
 import time
 import threading
+import traceback
 
+from repoze.debug import clock
 from repoze.debug.ui import is_gui_url
 from repoze.debug.ui import DebugGui
+from repoze.debug.entries import EntryStore
+from repoze.debug.entries import SharedEntryStore
+from repoze.debug.entries import plain_value
+from repoze.debug.inflight import default_registry
+from repoze.debug.logwriter import AppendLogHandler
+from repoze.debug.logwriter import AsyncLogWriter
+from repoze.debug.logwriter import format_record
+from repoze.debug.metrics import LatencyStats
+from repoze.debug.metrics import RequestCounters
+from repoze.debug.sampling import RequestSampler
+from repoze.debug.sampling import TailPolicy
+from repoze.debug.sampling import parse_path_rates
+from repoze.debug.tracelog import BinaryTraceLog
+from repoze.debug.watchdog import Watchdog
+from repoze.debug._compat import STRING_TYPES
 from repoze.debug._compat import quote
 
+DEFAULT_MAX_CAPTURE = 1024 * 1024
+
 class ResponseLoggingMiddleware(object):
-    def __init__(self, app, max_bodylen, keep, verbose_logger, trace_logger):
+    watchdog = None
+
+    def __init__(self, app, max_bodylen, keep, verbose_logger, trace_logger,
+                 log_writer=None, max_memory=0,
+                 max_capture=DEFAULT_MAX_CAPTURE, sampler=None, tail=None,
+                 entries=None, latency=None, counters=None, inflight=None):
         self.application = app
         self.max_bodylen = max_bodylen
+        self.max_capture = max_capture
         self.verbose_logger = verbose_logger
         self.trace_logger = trace_logger
+        self.log_writer = log_writer
+        self.sampler = sampler
+        self.tail = tail
         self.keep = keep
-        self.entries = []
+        if entries is None:
+            entries = EntryStore(keep, max_memory)
+        self.entries = entries
+        self.latency = latency
+        self.counters = counters
+        self.inflight = inflight
         self.lock = threading.Lock()
         self.first_request = True
         if hasattr(os, 'getpid'): # pragma: no cover
@@ -23,35 +55,65 @@ class ResponseLoggingMiddleware(object):
         else:
             self.pid = 0 # pragma: no cover
 
-    _now = None
     @property
-    def now(self):
+    def capture_limit(self):
+        """ Number of body bytes to capture;  0 means no limit.
+
+        ``max_capture`` is a hard ceiling, which also applies when
+        ``max_bodylen`` is 0 ("unlimited").
+        """
+        if self.max_capture:
+            if not self.max_bodylen or self.max_bodylen > self.max_capture:
+                return self.max_capture
+        return self.max_bodylen
+
+    _now = None # (seconds) fixed time, for testing
+    @property
+    def now_ns(self):
+        """ Current time, in integer nanoseconds since the epoch.
+
+        Read from a monotonic clock (see :mod:`repoze.debug.clock`), so that
+        durations aren't skewed by wall clock adjustments.  Request and
+        response times are kept as such, and only converted to seconds for
+        the verbose log, the statistics and the debug UI.
+        """
         if self._now is None:
-            return time.time()
-        return self._now
+            return clock.now_ns()
+        return clock.to_ns(self._now)
 
     def __call__(self, environ, start_response):
         if is_gui_url(environ):
             gui = DebugGui(self)
             return gui(environ, start_response)
 
+        if self.counters is not None:
+            self.counters.begin()
+
+        if self.watchdog is not None:
+            self.watchdog.ensure_started()
+
+        if self.sampler is not None and not self.sampler(environ):
+            return self.trace_only(environ, start_response)
+
         request_id = id(environ)
         request_info = self.get_request_info(environ)
-        request_info['begin'] = self.now
-        self.log_request_begin(request_id, request_info)
+        request_input = environ.get('wsgi.input')
+        request_info['begin'] = self.now_ns
+        if self.inflight is not None:
+            self.inflight.begin(request_id, request_info['method'],
+                                request_info, request_info['begin'] / 1e9)
+        if self.tail is None:
+            self.log_request_begin(request_id, request_info)
+        else:
+            # details are held back until we know whether to keep them
+            self.trace_request_begin(request_id, request_info)
 
         entry = {}
         entry['id'] = request_id
         entry['request'] = request_info
 
-        if self.keep:
-            self.lock.acquire()
-            try:
-                if len(self.entries) >= self.keep:
-                    self.entries.pop(0)
-                self.entries.append(entry)
-            finally:
-                self.lock.release()
+        if self.keep and self.tail is None:
+            self.entries.append(entry)
 
         catch_response = []
         written = []
@@ -61,8 +123,23 @@ class ResponseLoggingMiddleware(object):
             start_response(status, headers, exc_info)
             return written.append
 
-        app_iter = self.application(environ, replace_start_response)
-        received_response = self.now
+        try:
+            app_iter = self.application(environ, replace_start_response)
+        except Exception:
+            if catch_response:
+                status, headers = catch_response[0]
+            else:
+                status = '500 Exception Raised'
+                headers = []
+            response_info = self.get_response_info(status, headers)
+            response_info['begin'] = self.now_ns
+            response_info['body'] = b''
+            response_info['exception'] = traceback.format_exc()
+            entry['response'] = response_info
+            self.log_response_end(request_id, request_info, response_info,
+                                  0, entry, request_input)
+            raise
+        received_response = self.now_ns
 
         if catch_response:
             status, headers = catch_response[0]
@@ -75,78 +152,169 @@ class ResponseLoggingMiddleware(object):
 
         entry['response'] = response_info
 
+        if not written and is_file_wrapper(environ, app_iter):
+            return self.log_file_response(request_id, request_info,
+                                          response_info, app_iter, entry,
+                                          request_input)
+
         close = getattr(app_iter, 'close', None)
 
         body = itertools.chain(written, app_iter)
         body = self.log_response(request_id, request_info, response_info, body,
-                                 close)
+                                 close, entry, request_input)
 
         return body
 
     def get_request_info(self, environ):
-        info = {}
-        supplement = Supplement(self, environ)
-        request_data = supplement.extraData()
-        method = environ.get('REQUEST_METHOD', 'GET')
-        info['method'] = method
-        info['url'] = supplement.source_url
-        info['cgi_variables'] = []
-        info['wsgi_variables'] = []
-        info['body'] = ''
-        readargs = []
+        info = RequestInfo(self, environ)
+        info['method'] = environ.get('REQUEST_METHOD', 'GET')
+        info['path'] = request_path(environ)
+        info['body'] = b''
+        info['bodylen'] = 0
         if 'wsgi.input' in environ:
-            if 'CONTENT_LENGTH' in environ and environ['CONTENT_LENGTH']:
-                readargs.append(int(environ['CONTENT_LENGTH']))
-            info['body'] = environ['wsgi.input'].read(*readargs)
-            try:
-                environ['wsgi.input'].seek(0)
-            except AttributeError:
-                environ['wsgi.input'] = io.BytesIO(info['body'])
-        for k, v in sorted(request_data[('extra', 'CGI Variables')].items()):
-            info['cgi_variables'].append((k, v))
-        for k, v in sorted(request_data[('extra', 'WSGI Variables')].items()):
-            if not 'repoze.debug' in k:
-                info['wsgi_variables'].append((k, v))
+            # The body is captured as the application reads it.
+            environ['wsgi.input'] = TeeInput(environ['wsgi.input'],
+                                             self.capture_limit)
         return info
 
+    def log(self, logger, fmt, *args):
+        """ Write a record to ``logger``, formatting it via ``fmt``.
+
+        With a ``log_writer`` the raw record is queued and formatted on the
+        writer's thread;  otherwise it is written right away.
+        """
+        if logger is None:
+            return
+        if self.log_writer is not None:
+            self.log_writer.put(logger, fmt, args)
+        else:
+            logger.info(format_record(fmt, args))
+
+    def trace(self, code, request_id, when, *fields):
+        """ Write a record to the trace log.
+
+        The trace logger may provide its own ``format_trace`` (e.g. a
+        :class:`repoze.debug.tracelog.BinaryTraceLog`);  otherwise the
+        record is written as a line of text.
+        """
+        logger = self.trace_logger
+        if logger is None:
+            return
+        fmt = getattr(logger, 'format_trace', format_trace)
+        self.log(logger, fmt, code, self.pid, request_id, when, fields)
+
+    def trace_only(self, environ, start_response):
+        """ Serve a request which wasn't sampled.
+
+        Only the trace log is written:  no request details, bodies or
+        entries are captured.
+        """
+        if (self.trace_logger is None and self.latency is None and
+            self.counters is None and self.inflight is None):
+            return self.application(environ, start_response)
+
+        request_id = id(environ)
+        try:
+            bodylen = int(environ.get('CONTENT_LENGTH') or 0)
+        except ValueError:
+            bodylen = 0
+        request_info = {'method': environ.get('REQUEST_METHOD', 'GET'),
+                        'path': request_path(environ),
+                        'bodylen': bodylen,
+                        'begin': self.now_ns,
+                       }
+        if self.trace_logger is not None or self.inflight is not None:
+            request_info['url'] = construct_url(environ)
+        if self.trace_logger is not None:
+            self.trace_request_begin(request_id, request_info)
+        if self.inflight is not None:
+            self.inflight.begin(request_id, request_info['method'],
+                                request_info, request_info['begin'] / 1e9)
+
+        catch_response = []
+
+        def replace_start_response(status, headers, exc_info=None):
+            catch_response.append([status, headers])
+            return start_response(status, headers, exc_info)
+
+        try:
+            app_iter = self.application(environ, replace_start_response)
+        except Exception:
+            self.record_response(request_id, request_info,
+                                 '500 Exception Raised', 0, self.now_ns)
+            raise
+        received_response = self.now_ns
+
+        if catch_response:
+            status, headers = catch_response[0]
+        else:
+            status = '500 Start Response Not Called'
+            headers = []
+
+        response_info = self.get_response_info(status, headers)
+        response_info['begin'] = received_response
+
+        if is_file_wrapper(environ, app_iter):
+            self.log_response_begin(request_id, response_info)
+            bodylen = response_info['content-length']
+            def finish():
+                end = self.now_ns
+                self.record_response(request_id, request_info, status,
+                                     bodylen, end)
+                self.trace_response_end(request_id, end, bodylen)
+            if not call_on_close(app_iter, finish):
+                finish()
+            return app_iter
+
+        return self.trace_response(request_id, request_info, response_info,
+                                   app_iter)
+
+    def trace_response(self, request_id, request_info, response_info,
+                       app_iter):
+        self.log_response_begin(request_id, response_info)
+        counter = BodyCounter()
+        timer = ChunkTimer()
+
+        def feed(chunk):
+            if chunk and timer.tick(self.now_ns):
+                self.trace('F', request_id, timer.first)
+            counter.feed(chunk)
+
+        def finish(failed):
+            # also runs if the server closes us early, e.g. on a disconnect
+            try:
+                end = self.now_ns
+                self.record_response(request_id, request_info,
+                                     response_info['status'],
+                                     counter.bodylen, end)
+                if not failed:
+                    # an exception leaves the request unfinished in the
+                    # trace log
+                    self.trace_response_end(request_id, end, counter.bodylen,
+                                            timer.chunks, timer.max_gap)
+            finally:
+                close = getattr(app_iter, 'close', None)
+                if close is not None:
+                    close()
+
+        return ResponseIterator(app_iter, feed, finish)
+
     def log_request_begin(self, request_id, info):
-        out = []
+        self.log(self.verbose_logger, format_request, request_id, info)
+        self.trace_request_begin(request_id, info)
+
+    def trace_request_begin(self, request_id, info):
         begin = info['begin']
-        t = time.ctime(begin)
-        out.append('--- begin REQUEST for %s at %s ---' % (request_id, t))
-        info_url = info['url']
-        if isinstance(info_url, bytes):
-            info_url = info_url.decode('latin1')
-        method_and_url = '%s %s' % (info['method'], info_url)
-        out.append('URL: %s' % method_and_url)
-        out.append('CGI Variables')
-        for k, v in info['cgi_variables']:
-            # Just decode value if its type is "bytes".
-            # It looks like it's already Unicode in Python>=3.0.
-            if isinstance(v, bytes):
-                v = v.decode('latin1')
-            out.append('  %s: %s' % (k, v))
-        out.append('WSGI Variables')
-        for k, v in info['wsgi_variables']:
-            out.append('  %s: %s' % (k, v))
-        out.append('Body:')
-        out.append(info['body'].decode('latin1'))
-        out.append('Bodylen: %s' % len(info['body']))
-        out.append('--- end REQUEST for %s ---' % request_id)
-        self.verbose_logger and self.verbose_logger.info('\n'.join(out))
         self.lock.acquire()
         try:
             if self.first_request:
-                if self.trace_logger is not None:
-                    info = 'U %s %s %s' % (self.pid, request_id, begin)
-                    self.trace_logger.info(info)
+                self.trace('U', request_id, begin)
                 self.first_request = False
         finally:
             self.lock.release()
         if self.trace_logger is not None:
-            info = 'B %s %s %s %s' % (self.pid, request_id, begin,
-                                      method_and_url)
-            self.trace_logger.info(info)
+            self.trace('B', request_id, begin, info['method'],
+                       _text_url(info['url']))
 
     def get_response_info(self, status, headers):
         info = {}
@@ -160,55 +328,393 @@ class ResponseLoggingMiddleware(object):
         info['status'] = status
         return info
 
-    def log_response(self, request_id, request_info, response_info, body,close):
-        out = []
-        begin = response_info['begin']
-        t = time.ctime(begin)
+    def log_response_begin(self, request_id, response_info):
         status = response_info['status'].split(' ', 1)[0]
-        cl = response_info['content-length']
-        if self.trace_logger is not None:
-            info = 'A %s %s %s %s %s' % (self.pid, request_id, begin,
-                                         status, cl)
-            self.trace_logger.info(info)
-        out.append('--- begin RESPONSE for %s at %s ---' % (request_id, t))
-        request_info_url = request_info['url']
-        if isinstance(request_info_url, bytes):
-            request_info_url = request_info_url.decode('latin1')
-        out.append('URL: %s %s' % (request_info['method'], request_info_url))
-        out.append('Status: %s' % response_info['status'])
-        out.append('Response Headers')
-        for k, v in response_info['headers']:
-            out.append('  %s: %s' % (k, v))
-        bodyout = b''
-        bodylen = 0
-        remaining = None
-        for chunk in body:
-            if self.max_bodylen:
-                remaining = max(0, self.max_bodylen - len(bodyout))
-            bodyout += chunk[:remaining]
-            bodylen += len(chunk)
-            yield chunk
-        if bodylen > self.max_bodylen:
-            bodyout += (' ... (truncated at %s bytes)' % self.max_bodylen
-                       ).encode('ascii')
-        out.append('Body:\n' + bodyout.decode('ascii', 'replace'))
-        out.append('Bodylen: %s' % bodylen)
-        if cl is not None:
-            if bodylen != cl:
-                out.append(
-                    'WARNING-1: bodylen (%s) != Content-Length '
-                    'header value (%s)' % (bodylen, cl))
-        response_info['body'] = bodyout
-        end = response_info['end'] = self.now
-        duration = response_info['end'] - request_info['begin']
-        out.append('--- end RESPONSE for %s (%0.2f seconds) ---' % (
-            request_id, duration))
-        self.verbose_logger and self.verbose_logger.info('\n'.join(out))
-        if self.trace_logger is not None:
-            info = 'E %s %s %s %s' % (self.pid, request_id, end, bodylen)
-            self.trace_logger.info(info)
-        if close is not None:
-            close()
+        self.trace('A', request_id, response_info['begin'], status,
+                   response_info['content-length'])
+
+    def log_response(self, request_id, request_info, response_info, body,close,
+                     entry=None, request_input=None):
+        self.log_response_begin(request_id, response_info)
+        capture = BodyCapture(self.capture_limit)
+        timer = ChunkTimer()
+
+        def feed(chunk):
+            if chunk and timer.tick(self.now_ns):
+                self.trace('F', request_id, timer.first)
+            capture.feed(chunk)
+
+        def finish(failed):
+            # also runs if the server closes us early, e.g. on a disconnect
+            try:
+                if failed:
+                    response_info['exception'] = traceback.format_exc()
+                response_info['body'] = capture.logvalue()
+                response_info['first_byte'] = timer.first
+                response_info['chunks'] = timer.chunks
+                response_info['max_gap'] = timer.max_gap
+                self.log_response_end(request_id, request_info,
+                                      response_info, capture.bodylen, entry,
+                                      request_input)
+            finally:
+                if close is not None:
+                    close()
+
+        return ResponseIterator(body, feed, finish)
+
+    def log_file_response(self, request_id, request_info, response_info,
+                          app_iter, entry=None, request_input=None):
+        """ Log a ``wsgi.file_wrapper`` response without iterating it.
+
+        The wrapper is handed back to the server untouched, so that it can
+        still use sendfile() or similar;  the response is logged as finished
+        when the server closes it.
+        """
+        self.log_response_begin(request_id, response_info)
+        response_info['body'] = b'(wsgi.file_wrapper response: not captured)'
+        bodylen = response_info['content-length']
+        def finish():
+            self.log_response_end(request_id, request_info, response_info,
+                                  bodylen, entry, request_input)
+        if not call_on_close(app_iter, finish):
+            finish()
+        return app_iter
+
+    def log_response_end(self, request_id, request_info, response_info,
+                         bodylen, entry=None, request_input=None, end=None):
+        if isinstance(request_input, TeeInput):
+            request_info['body'] = request_input.capture.logvalue()
+            request_info['bodylen'] = request_input.capture.bodylen
+        if end is None:
+            end = self.now_ns
+        response_info['end'] = end
+        self.record_response(request_id, request_info,
+                             response_info['status'], bodylen, end)
+        if self.tail is not None:
+            duration = (end - request_info['begin']) / 1e9
+            if not self.tail(duration, response_info['status'],
+                             'exception' in response_info):
+                self.trace_response_end(request_id, end, bodylen,
+                                        response_info.get('chunks'),
+                                        response_info.get('max_gap'))
+                return
+            if self.keep and entry is not None:
+                # kept for long:  without holding on to the request's objects
+                request_info.release()
+                self.entries.append(entry)
+            self.log(self.verbose_logger, format_request, request_id,
+                     request_info)
+        elif self.keep and entry is not None:
+            request_info.release()
+            self.entries.update(entry)
+        self.log(self.verbose_logger, format_response, request_id,
+                 request_info, response_info, bodylen)
+        if 'exception' not in response_info:
+            # an exception leaves the request unfinished in the trace log
+            self.trace_response_end(request_id, end, bodylen,
+                                    response_info.get('chunks'),
+                                    response_info.get('max_gap'))
+
+    def record_response(self, request_id, request_info, status, bodylen,
+                        end):
+        """ Update the latency statistics and the request counters, and
+        unregister the request from the in-flight requests.
+        """
+        if self.inflight is not None:
+            self.inflight.end(request_id)
+        duration = (end - request_info['begin']) / 1e9
+        if self.latency is not None:
+            self.latency.record(request_info['method'], request_info['path'],
+                                duration)
+        if self.counters is not None:
+            self.counters.end(status, request_info['bodylen'], bodylen,
+                              duration)
+
+    def log_stuck_request(self, request, elapsed, stack):
+        """ Write the stack of a slow request to the verbose log.
+
+        Called by the :class:`repoze.debug.watchdog.Watchdog`.
+        """
+        self.log(self.verbose_logger, format_stuck_request,
+                 request.request_id, request.method, request.url,
+                 request.begin + elapsed, elapsed, request.thread_id, stack)
+
+    def trace_response_end(self, request_id, end, bodylen, chunks=None,
+                           max_gap=None):
+        if chunks is None:
+            # e.g. wsgi.file_wrapper responses, which we don't iterate
+            self.trace('E', request_id, end, bodylen)
+        else:
+            self.trace('E', request_id, end, bodylen, chunks, max_gap)
+
+def request_path(environ):
+    return environ.get('SCRIPT_NAME', '') + environ.get('PATH_INFO', '')
+
+def is_file_wrapper(environ, app_iter):
+    """ Is ``app_iter`` an instance of the server's ``wsgi.file_wrapper``?
+    """
+    file_wrapper = environ.get('wsgi.file_wrapper')
+    if file_wrapper is None:
+        return False
+    if isinstance(file_wrapper, type):
+        return isinstance(app_iter, file_wrapper)
+    # e.g. a factory function:  fall back to the conventional attribute
+    return hasattr(app_iter, 'filelike')
+
+def call_on_close(app_iter, callback):
+    """ Arrange for ``callback`` to run when ``app_iter`` is closed.
+
+    The object itself is left in place (its ``close`` is replaced on the
+    instance), so servers can still recognize it.  Return False if that
+    isn't possible.
+    """
+    close = getattr(app_iter, 'close', None)
+    def _close():
+        try:
+            if close is not None:
+                close()
+        finally:
+            callback()
+    try:
+        app_iter.close = _close
+    except (AttributeError, TypeError):
+        return False
+    return True
+
+def format_trace(code, pid, request_id, when, fields):
+    """ Render a trace log record as a line of text.
+
+    ``when`` is in integer nanoseconds since the epoch.
+    """
+    line = '%s %s %s %d' % (code, pid, request_id, when)
+    if fields:
+        line = '%s %s' % (line, ' '.join(['%s' % (x,) for x in fields]))
+    return line
+
+def _text_url(url):
+    if isinstance(url, bytes):
+        url = url.decode('latin1')
+    return url
+
+def format_request(request_id, info):
+    """ Render the verbose log block for a request.
+    """
+    out = []
+    t = time.ctime(info['begin'] / 1e9)
+    out.append('--- begin REQUEST for %s at %s ---' % (request_id, t))
+    out.append('URL: %s %s' % (info['method'], _text_url(info['url'])))
+    out.append('CGI Variables')
+    for k, v in info['cgi_variables']:
+        # Just decode value if its type is "bytes".
+        # It looks like it's already Unicode in Python>=3.0.
+        if isinstance(v, bytes):
+            v = v.decode('latin1')
+        out.append('  %s: %s' % (k, v))
+    out.append('WSGI Variables')
+    for k, v in info['wsgi_variables']:
+        out.append('  %s: %s' % (k, v))
+    out.append('--- end REQUEST for %s ---' % request_id)
+    return '\n'.join(out)
+
+def format_response(request_id, request_info, response_info, bodylen):
+    """ Render the verbose log block for a response.
+    """
+    out = []
+    t = time.ctime(response_info['begin'] / 1e9)
+    cl = response_info['content-length']
+    out.append('--- begin RESPONSE for %s at %s ---' % (request_id, t))
+    out.append('URL: %s %s' % (request_info['method'],
+                               _text_url(request_info['url'])))
+    out.append('Request Body:')
+    out.append(request_info['body'].decode('latin1'))
+    out.append('Request Bodylen: %s' % request_info['bodylen'])
+    out.append('Status: %s' % response_info['status'])
+    out.append('Response Headers')
+    for k, v in response_info['headers']:
+        out.append('  %s: %s' % (k, v))
+    out.append('Body:\n' + response_info['body'].decode('ascii', 'replace'))
+    out.append('Bodylen: %s' % bodylen)
+    if cl is not None:
+        if bodylen != cl:
+            out.append(
+                'WARNING-1: bodylen (%s) != Content-Length '
+                'header value (%s)' % (bodylen, cl))
+    if response_info.get('first_byte') is not None:
+        first_byte = response_info['first_byte'] - request_info['begin']
+        out.append('First byte after: %0.3f seconds (%s chunks, largest gap '
+                   '%0.3f seconds)' % (first_byte / 1e9,
+                                       response_info['chunks'],
+                                       response_info['max_gap'] / 1e9))
+    if 'exception' in response_info:
+        out.append('Exception:\n' + response_info['exception'])
+    duration = (response_info['end'] - request_info['begin']) / 1e9
+    out.append('--- end RESPONSE for %s (%0.2f seconds) ---' % (
+        request_id, duration))
+    return '\n'.join(out)
+
+def format_stuck_request(request_id, method, url, when, elapsed, thread_id,
+                         stack):
+    """ Render the verbose log block for the stack of a slow request.
+    """
+    out = []
+    t = time.ctime(when)
+    out.append('--- begin STACK for %s at %s ---' % (request_id, t))
+    out.append('URL: %s %s' % (method, _text_url(url)))
+    out.append('Running for: %0.2f seconds' % elapsed)
+    out.append('Thread: %s' % thread_id)
+    out.append(stack.rstrip('\n'))
+    out.append('--- end STACK for %s ---' % request_id)
+    return '\n'.join(out)
+
+class ResponseIterator(object):
+    """ Iterate over a response ``body``, passing each chunk to ``feed``.
+
+    ``finish(failed)`` is called once:  when the body is exhausted or
+    raises, or when the iterator is closed, even if the server closes it
+    without iterating it at all (as WSGI allows).
+    """
+    def __init__(self, body, feed, finish):
+        self.body = body
+        self.feed = feed
+        self.finish = finish
+        self.iterator = None
+        self.finished = False
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        if self.finished:
+            raise StopIteration
+        try:
+            if self.iterator is None:
+                self.iterator = iter(self.body)
+            chunk = next(self.iterator)
+        except StopIteration:
+            self._finish(False)
+            raise
+        except Exception:
+            self._finish(True)
+            raise
+        self.feed(chunk)
+        return chunk
+
+    next = __next__ # Python 2
+
+    def close(self):
+        self._finish(False)
+
+    def _finish(self, failed):
+        if not self.finished:
+            self.finished = True
+            self.finish(failed)
+
+class ChunkTimer(object):
+    """ Track when the (non-empty) chunks of a response body are produced,
+    in integer nanoseconds.
+    """
+    def __init__(self):
+        self.first = None
+        self.last = None
+        self.chunks = 0
+        self.max_gap = 0
+
+    def tick(self, now):
+        """ Record a chunk produced at ``now``;  return True for the first.
+        """
+        self.chunks += 1
+        last, self.last = self.last, now
+        if last is None:
+            self.first = now
+            return True
+        if now - last > self.max_gap:
+            self.max_gap = now - last
+        return False
+
+class BodyCapture(object):
+    """ Keep the leading ``limit`` bytes of a body which arrives in chunks.
+
+    Chunks are kept by reference and joined once, when the value is asked
+    for;  once the limit is reached, chunks are only counted, not copied.
+    A ``limit`` of 0 keeps the whole body.
+    """
+    def __init__(self, limit):
+        self.limit = limit
+        self.chunks = []
+        self.captured = 0
+        self.bodylen = 0
+        self.truncated = False
+
+    def feed(self, data):
+        size = len(data)
+        self.bodylen += size
+        if self.truncated or not size:
+            return
+        if self.limit:
+            remaining = self.limit - self.captured
+            if size > remaining:
+                self.truncated = True
+                if remaining > 0:
+                    self.chunks.append(data[:remaining])
+                    self.captured += remaining
+                return
+        self.chunks.append(data)
+        self.captured += size
+
+    def getvalue(self):
+        return b''.join(self.chunks)
+
+    def logvalue(self):
+        """ The captured bytes, noting any truncation.
+        """
+        value = self.getvalue()
+        if self.truncated:
+            value += (' ... (truncated at %s bytes)' % self.limit
+                     ).encode('ascii')
+        return value
+
+class BodyCounter(object):
+    """ Count the bytes of a body without keeping any.
+    """
+    def __init__(self):
+        self.bodylen = 0
+
+    def feed(self, data):
+        self.bodylen += len(data)
+
+    def logvalue(self):
+        return b''
+
+class TeeInput(object):
+    """ Wrap ``wsgi.input``, keeping a copy of what the application reads.
+
+    Data is passed through to the application as it is read;  only the
+    first ``max_bodylen`` bytes (all of them if ``max_bodylen`` is 0) are
+    kept for logging, while ``bodylen`` counts every byte read.
+    """
+    def __init__(self, stream, max_bodylen):
+        self.stream = stream
+        self.capture = BodyCapture(max_bodylen)
+
+    def _tee(self, data):
+        self.capture.feed(data)
+        return data
+
+    def read(self, *args):
+        return self._tee(self.stream.read(*args))
+
+    def readline(self, *args):
+        return self._tee(self.stream.readline(*args))
+
+    def readlines(self, *args):
+        return [self._tee(line) for line in self.stream.readlines(*args)]
+
+    def __iter__(self):
+        for line in self.stream:
+            yield self._tee(line)
+
+    def __getattr__(self, name):
+        return getattr(self.stream, name)
 
 class SuffixMultiplier:
     # d is a dictionary of suffixes to integer multipliers.  If no suffixes
@@ -236,6 +742,23 @@ byte_size = SuffixMultiplier({'kb': 1024,
                               'mb': 1024*1024,
                               'gb': 1024*1024*1024,})
 
+def asbool(value):
+    if isinstance(value, STRING_TYPES):
+        return value.strip().lower() in ('true', 'yes', 'on', 'y', 't', '1')
+    return bool(value)
+
+def optional(convert, value):
+    """ Convert an option's ``value``, or return None if it is unset
+    (None or an empty string).
+    """
+    if value is None:
+        return None
+    if isinstance(value, STRING_TYPES):
+        value = value.strip()
+        if not value:
+            return None
+    return convert(value)
+
 def make_middleware(app,
                     global_conf,
                     verbose_log=None,
@@ -244,30 +767,174 @@ def make_middleware(app,
                     max_logsize='100MB',
                     backup_count='10',
                     keep='100',
+                    log_queue_size='0',
+                    log_queue_overflow='drop',
+                    max_memory='0',
+                    max_capture='1MB',
+                    sample_rate='1',
+                    sample_paths='',
+                    sample_always_methods='',
+                    sample_always_urls='',
+                    tail_capture='false',
+                    tail_latency='',
+                    tail_status='500',
+                    trace_format='text',
+                    shared_entries='',
+                    shared_entry_size='64KB',
+                    latency_routes='0',
+                    metrics='false',
+                    watchdog_threshold='',
+                    watchdog_interval='1',
+                    watchdog_repeat='0',
+                    inflight='false',
                     ):
     """ Paste filter-app converter """
     backup_count = int(backup_count)
     max_bytes = byte_size(max_logsize)
     max_bodylen = byte_size(max_bodylen)
     keep = int(keep)
+    max_memory = byte_size(max_memory)
+    max_capture = byte_size(max_capture)
+    log_queue_size = int(log_queue_size)
+    if trace_format not in ('text', 'binary'):
+        raise ValueError('Unknown trace_format: %r' % trace_format)
     from logging import Logger
-    from logging.handlers import RotatingFileHandler
 
+    # several (forked) processes may share the logs:  write each record
+    # atomically, and let one process rotate a log for all of them
     if verbose_log:
-        handler = RotatingFileHandler(verbose_log, maxBytes=max_bytes,
-                                      backupCount=backup_count)
+        handler = AppendLogHandler(verbose_log, max_bytes, backup_count)
         verbose_log = Logger('repoze.debug.verboselogger')
         verbose_log.handlers = [handler]
 
-    if trace_log:
-        handler = RotatingFileHandler(trace_log, maxBytes=max_bytes,
-                                      backupCount=backup_count)
+    if trace_log and trace_format == 'binary':
+        trace_log = BinaryTraceLog.open(trace_log, max_bytes, backup_count)
+    elif trace_log:
+        handler = AppendLogHandler(trace_log, max_bytes, backup_count)
         trace_log = Logger('repoze.debug.tracelogger')
         trace_log.handlers = [handler]
 
-    return ResponseLoggingMiddleware(app, max_bodylen, keep, verbose_log,
-                                     trace_log)
+    log_writer = None
+    if log_queue_size:
+        log_writer = AsyncLogWriter(log_queue_size, log_queue_overflow)
+
+    sampler = None
+    sample_rate = int(sample_rate)
+    sample_paths = parse_path_rates(sample_paths)
+    if sample_rate != 1 or sample_paths:
+        sampler = RequestSampler(sample_rate, sample_paths,
+                                 sample_always_methods.split(),
+                                 sample_always_urls.split())
+
+    tail = None
+    if asbool(tail_capture):
+        tail = TailPolicy(optional(float, tail_latency),
+                          optional(int, tail_status))
+
+    entries = None
+    if shared_entries:
+        entries = SharedEntryStore(shared_entries, keep,
+                                   byte_size(shared_entry_size))
+
+    latency = None
+    latency_routes = int(latency_routes)
+    if latency_routes:
+        latency = LatencyStats(latency_routes)
+
+    counters = None
+    if asbool(metrics):
+        counters = RequestCounters()
+
+    if watchdog_threshold and not verbose_log:
+        raise ValueError('watchdog_threshold requires a verbose_log')
+    if watchdog_threshold or asbool(inflight):
+        # shared with the threads middleware, to annotate thread dumps
+        inflight = default_registry
+    else:
+        inflight = None
+
+    middleware = ResponseLoggingMiddleware(app, max_bodylen, keep,
+                                           verbose_log, trace_log, log_writer,
+                                           max_memory, max_capture, sampler,
+                                           tail, entries, latency, counters,
+                                           inflight)
+    if watchdog_threshold:
+        middleware.watchdog = Watchdog(inflight, float(watchdog_threshold),
+                                       middleware.log_stuck_request,
+                                       float(watchdog_interval),
+                                       float(watchdog_repeat))
+    return middleware
+
+
+class RequestInfo(dict):
+    """ Request details, captured from a shallow copy of the environ.
+
+    The URL and the (sorted) CGI and WSGI variables are only computed when
+    first looked up, e.g. to write the verbose log or to render the debug
+    UI.  Once the response is finished, ``release`` reduces them to plain
+    values, so that a kept entry doesn't hold on to the request's objects.
+    """
+    released = False
+
+    def __init__(self, middleware, environ):
+        dict.__init__(self)
+        self.middleware = middleware
+        self.environ = dict(environ)
+
+    def release(self):
+        """ Replace the objects in the request details by text (see
+        ``repoze.debug.entries.plain_value``).
+        """
+        # set first:  _compute_variables, if running on another thread
+        # meanwhile, then releases the variables it computes itself
+        self.released = True
+        environ = self.environ
+        if environ is not None:
+            self.environ = dict([(k, plain_value(v))
+                                 for k, v in environ.items()
+                                 if k not in _RELEASED_KEYS])
+        self._release_variables()
+
+    def _release_variables(self):
+        for key in ('cgi_variables', 'wsgi_variables'):
+            variables = dict.get(self, key)
+            if variables is not None:
+                self[key] = [(k, plain_value(v)) for k, v in variables]
+
+    def __missing__(self, key):
+        if key not in ('url', 'cgi_variables', 'wsgi_variables'):
+            raise KeyError(key)
+        environ = self.environ
+        if environ is not None:
+            if key == 'url':
+                self['url'] = construct_url(environ)
+            else:
+                self._compute_variables(environ)
+        # else, computed meanwhile by another thread
+        return dict.get(self, key)
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def _compute_variables(self, environ):
+        supplement = Supplement(self.middleware, environ)
+        request_data = supplement.extraData()
+        self.setdefault('url', supplement.source_url)
+        self['cgi_variables'] = sorted(
+            request_data[('extra', 'CGI Variables')].items())
+        self['wsgi_variables'] = [
+            (k, v) for k, v in sorted(
+                request_data[('extra', 'WSGI Variables')].items())
+            if not 'repoze.debug' in k]
+        self.environ = None # everything is computed;  drop the snapshot
+        if self.released:
+            self._release_variables()
 
+# not shown (see Supplement), and not needed for the variables
+_RELEASED_KEYS = ('wsgi.input', 'wsgi.errors', 'paste.config')
 
 class Supplement(object):
     """ Display standard WSGI information in the traceback.
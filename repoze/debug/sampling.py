@@ -0,0 +1,83 @@
+"""Choosing which requests the response logger captures in full.
+
+"""
+import itertools
+import re
+
+class RequestSampler(object):
+    """ Decide, up front, whether a request is captured in full.
+
+    ``rate`` captures one in every ``rate`` requests (1 captures all of
+    them, 0 none).  ``path_rates`` is a sequence of ``(prefix, rate)``
+    pairs overriding ``rate`` for paths starting with ``prefix`` (the
+    longest matching prefix wins).  Requests using one of
+    ``always_methods``, or whose path matches one of the regular
+    expressions in ``always_urls``, are always captured.
+    """
+    def __init__(self, rate=1, path_rates=(), always_methods=(),
+                 always_urls=()):
+        self.rate = rate
+        self.counter = itertools.count()
+        self.path_rates = [(prefix, rate, itertools.count())
+                           for prefix, rate in sorted(
+                               path_rates, key=lambda x: -len(x[0]))]
+        self.always_methods = frozenset([x.upper() for x in always_methods])
+        self.always_urls = [re.compile(x) for x in always_urls]
+
+    def __call__(self, environ):
+        if environ.get('REQUEST_METHOD', 'GET') in self.always_methods:
+            return True
+        path = environ.get('SCRIPT_NAME', '') + environ.get('PATH_INFO', '')
+        for pattern in self.always_urls:
+            if pattern.search(path):
+                return True
+        rate, counter = self.rate, self.counter
+        for prefix, prefix_rate, prefix_counter in self.path_rates:
+            if path.startswith(prefix):
+                rate, counter = prefix_rate, prefix_counter
+                break
+        if rate == 1:
+            return True
+        if rate <= 0:
+            return False
+        # next() on itertools.count is atomic, so no lock is needed
+        return next(counter) % rate == 0
+
+def parse_path_rates(value):
+    """ Parse 'prefix rate' pairs, one per line, into a list of tuples.
+    """
+    result = []
+    for line in value.splitlines():
+        line = line.strip()
+        if not line:
+            continue
+        try:
+            prefix, rate = line.split()
+            result.append((prefix, int(rate)))
+        except ValueError:
+            raise ValueError('Bad path sampling rule: %r' % line)
+    return result
+
+class TailPolicy(object):
+    """ Decide, once a response is finished, whether to keep its details.
+
+    A request is kept if it took at least ``latency`` seconds (unless
+    ``latency`` is None), if its status code is at least ``status`` (unless
+    ``status`` is None), or if the application raised an exception.
+    """
+    def __init__(self, latency=None, status=500):
+        self.latency = latency
+        self.status = status
+
+    def __call__(self, duration, status, exception=False):
+        if exception:
+            return True
+        if self.latency is not None and duration >= self.latency:
+            return True
+        if self.status is not None:
+            try:
+                code = int(status.split(' ', 1)[0])
+            except ValueError:
+                return True
+            return code >= self.status
+        return False
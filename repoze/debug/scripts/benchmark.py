@@ -0,0 +1,386 @@
+"""Measure the per-request overhead of the repoze.debug middleware
+
+Drives each middleware, and combinations of them, around a trivial and a
+streaming WSGI application, in-process, and reports the time, memory
+allocated and memory retained per request.
+"""
+import getopt
+import io
+import itertools
+import json
+import logging
+import os
+import platform
+import sys
+import threading
+import time
+
+try:
+    import tracemalloc
+except ImportError:  # pragma: no cover Python 2
+    tracemalloc = None
+
+from repoze.debug import clock
+from repoze.debug.canary import CanaryMiddleware
+from repoze.debug.logwriter import AsyncLogWriter
+from repoze.debug.pdbpm import PostMortemDebug
+from repoze.debug.responselogger import ResponseLoggingMiddleware
+from repoze.debug.sampling import RequestSampler
+from repoze.debug.threads import MonitoringMiddleware
+
+def trivial_app(environ, start_response):
+    start_response('200 OK', [('Content-Type', 'text/plain'),
+                              ('Content-Length', '12')])
+    return [b'Hello world!']
+
+STREAM_CHUNKS = 64
+STREAM_CHUNK = b'x' * 1024
+
+def streaming_app(environ, start_response):
+    start_response('200 OK', [('Content-Type', 'application/octet-stream')])
+    for i in range(STREAM_CHUNKS):
+        yield STREAM_CHUNK
+
+APPS = {'trivial': trivial_app,
+        'streaming': streaming_app,
+       }
+
+def _null_logger(name, closers):
+    stream = open(os.devnull, 'w')
+    closers.append(stream.close)
+    logger = logging.Logger(name)
+    logger.handlers = [logging.StreamHandler(stream)]
+    return logger
+
+def _responselogger(app, closers, max_bodylen=3072, keep=100, logs=False,
+                    log_writer=None, sampler=None):
+    verbose = trace = None
+    if logs:
+        verbose = _null_logger('repoze.debug.benchmark.verbose', closers)
+        trace = _null_logger('repoze.debug.benchmark.trace', closers)
+    if log_writer is not None:
+        closers.append(log_writer.close)
+    return ResponseLoggingMiddleware(app, max_bodylen, keep, verbose, trace,
+                                     log_writer, sampler=sampler)
+
+def _reading(app, closers, every=100):
+    # the entries are read, as by the debug UI, every ``every`` requests
+    middleware = _responselogger(app, closers)
+    counter = itertools.count(1)
+    def reading_app(environ, start_response):
+        if next(counter) % every == 0:
+            list(middleware.entries)
+        return middleware(environ, start_response)
+    return reading_app
+
+def _all(app, closers):
+    app = MonitoringMiddleware(PostMortemDebug(CanaryMiddleware(app)))
+    return _responselogger(app, closers, logs=True)
+
+# name, description, factory(app, closers)
+MIDDLEWARE = [
+    ('none', 'the application alone (baseline)',
+     lambda app, closers: app),
+    ('canary', 'canary', lambda app, closers: CanaryMiddleware(app)),
+    ('pdbpm', 'pdbpm', lambda app, closers: PostMortemDebug(app)),
+    ('threads', 'threads', lambda app, closers: MonitoringMiddleware(app)),
+    ('responselogger', 'responselogger, keeping 100 entries, no logs',
+     _responselogger),
+    ('responselogger-read', 'responselogger, keeping 100 entries, read '
+     'every 100 requests', _reading),
+    ('responselogger-nokeep', 'responselogger, no entries, no logs',
+     lambda app, closers: _responselogger(app, closers, 0, 0)),
+    ('responselogger-logs', 'responselogger, writing the verbose and trace '
+     'logs', lambda app, closers: _responselogger(app, closers, logs=True)),
+    ('responselogger-async', 'responselogger, queueing the logs to a '
+     'background writer',
+     lambda app, closers: _responselogger(app, closers, logs=True,
+                                          log_writer=AsyncLogWriter())),
+    ('responselogger-sampled', 'responselogger, writing the logs for 1 in '
+     '100 requests',
+     lambda app, closers: _responselogger(app, closers, logs=True,
+                                          sampler=RequestSampler(100))),
+    ('all', 'responselogger (with logs), threads, pdbpm and canary', _all),
+]
+
+def make_environ():
+    return {'REQUEST_METHOD': 'GET',
+            'SCRIPT_NAME': '',
+            'PATH_INFO': '/benchmark/1',
+            'QUERY_STRING': 'a=1',
+            'SERVER_NAME': 'localhost',
+            'SERVER_PORT': '80',
+            'SERVER_PROTOCOL': 'HTTP/1.1',
+            'HTTP_HOST': 'localhost',
+            'HTTP_USER_AGENT': 'wsgibenchmark',
+            'wsgi.input': io.BytesIO(),
+            'wsgi.errors': sys.stderr,
+            'wsgi.version': (1, 0),
+            'wsgi.url_scheme': 'http',
+            'wsgi.multithread': True,
+            'wsgi.multiprocess': False,
+            'wsgi.run_once': False,
+           }
+
+def _start_response(status, headers, exc_info=None):
+    return _write
+
+def _write(data):
+    pass
+
+def serve(app, count):
+    """ Serve ``count`` requests through ``app``.
+    """
+    for i in range(count):
+        app_iter = app(make_environ(), _start_response)
+        try:
+            for chunk in app_iter:
+                pass
+        finally:
+            close = getattr(app_iter, 'close', None)
+            if close is not None:
+                close()
+
+def time_requests(app, count, threads=1):
+    """ Return the wall-clock nanoseconds taken to serve ``count`` requests
+    from ``threads`` threads.
+    """
+    shares = [count // threads + (i < count % threads)
+              for i in range(threads)]
+    workers = [threading.Thread(target=serve, args=(app, share))
+               for share in shares]
+    start = clock.perf_counter_ns()
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    return clock.perf_counter_ns() - start
+
+def measure_memory(app, count):
+    """ Return the bytes allocated (at the peak) and the memory blocks
+    retained per request, and the peak traced memory, serving ``count``
+    requests;  or None if ``tracemalloc`` is unavailable.
+    """
+    if tracemalloc is None or not hasattr(tracemalloc, 'reset_peak'):
+        return None # pragma: no cover Python < 3.9
+    tracemalloc.start()
+    try:
+        blocks = sys.getallocatedblocks()
+        allocated = 0
+        for i in range(count):
+            current = tracemalloc.get_traced_memory()[0]
+            tracemalloc.reset_peak()
+            serve(app, 1)
+            allocated += tracemalloc.get_traced_memory()[1] - current
+        retained = sys.getallocatedblocks() - blocks
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+    return allocated // count, retained / float(count), peak
+
+def run_case(name, app_name, requests, threads=1, warmup=200,
+             memory_requests=200):
+    """ Benchmark middleware ``name`` around application ``app_name``.
+
+    Returns a dict of results.
+    """
+    factory = dict([(x[0], x[2]) for x in MIDDLEWARE])[name]
+    closers = []
+    app = factory(APPS[app_name], closers)
+    try:
+        serve(app, warmup)
+        elapsed = time_requests(app, requests, threads)
+        memory = None
+        if memory_requests:
+            memory = measure_memory(app, memory_requests)
+    finally:
+        for close in reversed(closers):
+            close()
+    result = {'middleware': name,
+              'app': app_name,
+              'threads': threads,
+              'requests': requests,
+              'ns_per_request': elapsed // requests,
+              'alloc_bytes_per_request': None,
+              'retained_blocks_per_request': None,
+              'peak_bytes': None,
+             }
+    if memory is not None:
+        (result['alloc_bytes_per_request'],
+         result['retained_blocks_per_request'],
+         result['peak_bytes']) = memory
+    return result
+
+def run(names, app_names, requests, threads=(1,), memory_requests=200):
+    """ Benchmark each of the middleware ``names`` around each of the
+    applications ``app_names``, from each number of ``threads``.
+
+    The overhead of each case is its time per request less that of the
+    application alone.
+    """
+    results = []
+    for app_name in app_names:
+        for count in threads:
+            baseline = run_case('none', app_name, requests, count,
+                                memory_requests=0)['ns_per_request']
+            for name in names:
+                result = run_case(name, app_name, requests, count,
+                                  memory_requests=memory_requests)
+                result['overhead_ns'] = result['ns_per_request'] - baseline
+                results.append(result)
+    return results
+
+def _version():
+    try:
+        from importlib.metadata import version
+    except ImportError:  # pragma: no cover Python < 3.8
+        try:
+            import pkg_resources
+            return pkg_resources.get_distribution('repoze.debug').version
+        except Exception:
+            return 'unknown'
+    try:
+        return version('repoze.debug')
+    except Exception:  # pragma: no cover not installed
+        return 'unknown'
+
+def make_report(results):
+    """ Wrap ``results`` with a description of the environment they were
+    measured in, for saving as JSON.
+    """
+    return {'version': _version(),
+            'python': sys.version.split()[0],
+            'implementation': platform.python_implementation(),
+            'platform': platform.platform(),
+            'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'results': results,
+           }
+
+def _key(result):
+    return (result['middleware'], result['app'], result['threads'])
+
+def _format(value, fmt):
+    if value is None:
+        return '-'
+    return fmt % value
+
+def format_results(results, previous=None):
+    """ Render ``results`` as a plain text table.
+
+    If ``previous`` results are passed, the change in time per request is
+    shown for each case measured in both.
+    """
+    fmt = '%-24s %-10s %7s %10s %10s %10s %9s %12s'
+    header = ('Middleware', 'App', 'Threads', 'ns/req', 'Overhead',
+              'Alloc/req', 'Kept/req', 'Peak bytes')
+    if previous is not None:
+        fmt += ' %8s'
+        header += ('Change',)
+        previous = dict([(_key(x), x) for x in previous])
+    out = [fmt % header]
+    for result in results:
+        row = (result['middleware'], result['app'], result['threads'],
+               result['ns_per_request'], result['overhead_ns'],
+               _format(result['alloc_bytes_per_request'], '%d'),
+               _format(result['retained_blocks_per_request'], '%.2f'),
+               _format(result['peak_bytes'], '%d'))
+        if previous is not None:
+            old = previous.get(_key(result))
+            change = None
+            if old is not None and old['ns_per_request']:
+                change = (100.0 * result['ns_per_request'] /
+                          old['ns_per_request'] - 100)
+            row += (_format(change, '%+.1f%%'),)
+        out.append(fmt % row)
+    return '\n'.join(out) + '\n'
+
+def usage():
+    return """
+Usage: %s [--middleware=name[,name...]]
+          [--app=trivial|streaming]
+          [--threads=n[,n...]]
+          [--requests=n]
+          [--json=filename]
+          [--compare=filename]
+          [--list]
+          [--help]
+
+Measures the overhead of the repoze.debug middleware, in-process:  the time
+per request (ns/req, and its excess over the application alone), the bytes
+allocated per request (at the peak), the memory blocks kept per request and
+the peak memory use while serving.
+
+  --middleware=names  Measure these middleware configurations (see --list;
+                      default: all of them).
+  --app=name          Wrap this application:  'trivial' returns a short
+                      body, 'streaming' %d chunks of %d bytes (default:
+                      both, in turn).
+  --threads=counts    Serve the requests from this many threads (default:
+                      1,4).  Memory is always measured single-threaded.
+  --requests=n        Time this many requests per case (default: 5000).
+  --json=filename     Save the results, and a description of the
+                      environment, as JSON.
+  --compare=filename  Show the change in time per request against results
+                      saved with --json, e.g. by a previous release.
+  --list              List the middleware configurations.
+""" % (sys.argv[0], STREAM_CHUNKS, len(STREAM_CHUNK))
+
+def main(argv=None):
+    if argv is None:
+        argv = sys.argv[1:]
+    names = [x[0] for x in MIDDLEWARE]
+    app_names = ['trivial', 'streaming']
+    threads = [1, 4]
+    requests = 5000
+    json_file = compare_file = None
+    try:
+        opts, args = getopt.getopt(argv, '', ['middleware=', 'app=',
+                                              'threads=', 'requests=',
+                                              'json=', 'compare=', 'list',
+                                              'help'])
+        for opt, val in opts:
+            if opt == '--middleware':
+                names = val.split(',')
+                unknown = set(names) - set([x[0] for x in MIDDLEWARE])
+                if unknown:
+                    raise ValueError('Unknown middleware: %s'
+                                     % ', '.join(sorted(unknown)))
+            elif opt == '--app':
+                if val not in APPS:
+                    raise ValueError('Unknown app: %s' % val)
+                app_names = [val]
+            elif opt == '--threads':
+                threads = [int(x) for x in val.split(',')]
+            elif opt == '--requests':
+                requests = int(val)
+            elif opt == '--json':
+                json_file = val
+            elif opt == '--compare':
+                compare_file = val
+            elif opt == '--list':
+                for name, description, factory in MIDDLEWARE:
+                    print('%-24s %s' % (name, description))
+                return 0
+            elif opt == '--help':
+                print(usage())
+                return 0
+        if args or requests < 1 or min(threads) < 1:
+            print(usage())
+            return 1
+        previous = None
+        if compare_file is not None:
+            with open(compare_file) as f:
+                previous = json.load(f)['results']
+    except (getopt.error, ValueError, IOError) as e:
+        sys.stderr.write('Error: %s\n' % e)
+        print(usage())
+        return 1
+    results = run(names, app_names, requests, threads)
+    sys.stdout.write(format_results(results, previous))
+    if json_file is not None:
+        with open(json_file, 'w') as f:
+            json.dump(make_report(results), f, indent=2, sort_keys=True)
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
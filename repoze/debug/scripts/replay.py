@@ -0,0 +1,444 @@
+"""Replay captured requests against a WSGI application
+
+Reads the requests recorded by the response logger, from its verbose log or
+from the debug UI's feed, and replays them in-process against an
+application loaded from a Paste configuration file, reporting throughput
+and latency percentiles.
+"""
+import getopt
+import io
+import os
+import re
+import sys
+import threading
+import time
+import traceback
+
+from xml.etree import ElementTree
+
+from repoze.debug import clock
+from repoze.debug._compat import gzip
+from repoze.debug._compat import unquote
+from repoze.debug._compat import urlopen
+from repoze.debug._compat import urlsplit
+from repoze.debug.metrics import LatencyHistogram
+
+class ReplayException(Exception):
+    pass
+
+class CapturedRequest(object):
+    """ A request, as captured by the response logger.
+    """
+    def __init__(self, method, url, cgi_variables=(), body=b'',
+                 truncated=False):
+        self.method = method
+        self.url = url
+        self.cgi_variables = list(cgi_variables)
+        self.body = body
+        self.truncated = truncated
+
+_BLOCK = re.compile(r'^--- begin (REQUEST|RESPONSE) for (\S+) at ')
+_TRUNCATED = re.compile(br' \.\.\. \(truncated at \d+ bytes\)$')
+
+def _body(text):
+    # bodies are logged as latin1 text, possibly truncated
+    body = text.encode('latin1')
+    match = _TRUNCATED.search(body)
+    if match is None:
+        return body, False
+    return body[:match.start()], True
+
+def parse_verbose_log(f):
+    """ Return the requests of the verbose log ``f``, in the order they
+    began.
+
+    Requests are taken from the REQUEST blocks;  their bodies from the
+    RESPONSE blocks, where they are logged.
+    """
+    requests = []
+    pending = {}
+    block = None
+    for line in f:
+        if isinstance(line, bytes):
+            line = line.decode('latin1')
+        line = line.rstrip('\r\n')
+        match = _BLOCK.match(line)
+        if match is not None:
+            kind, request_id = match.groups()
+            block = [kind, request_id, []]
+            continue
+        if block is None:
+            continue
+        kind, request_id, lines = block
+        if line.startswith('--- end %s for %s' % (kind, request_id)):
+            block = None
+            if kind == 'REQUEST':
+                request = _parse_request(lines)
+                if request is not None:
+                    pending[request_id] = request
+                    requests.append(request)
+            elif request_id in pending:
+                request = pending.pop(request_id)
+                request.body, request.truncated = _parse_request_body(lines)
+            continue
+        lines.append(line)
+    return requests
+
+def _parse_request(lines):
+    if not lines or not lines[0].startswith('URL: '):
+        return None
+    method, url = lines[0][5:].split(' ', 1)
+    cgi_variables = []
+    section = None
+    for line in lines[1:]:
+        if not line.startswith('  '):
+            section = line
+        elif section == 'CGI Variables':
+            name, value = line[2:].split(': ', 1)
+            cgi_variables.append((name, value))
+    return CapturedRequest(method, url, cgi_variables)
+
+def _parse_request_body(lines):
+    try:
+        start = lines.index('Request Body:') + 1
+    except ValueError:
+        return b'', False
+    for end in range(start, len(lines)):
+        if lines[end].startswith('Request Bodylen: '):
+            return _body('\n'.join(lines[start:end]))
+    return b'', False
+
+_RZ = '{http://repoze.org/namespace}'
+
+def parse_feed(data):
+    """ Return the requests of the debug UI's Atom feed ``data``.
+    """
+    try:
+        root = ElementTree.fromstring(data)
+    except ElementTree.ParseError as e:
+        raise ReplayException('Invalid feed: %s' % e)
+    requests = []
+    for element in root.iter(_RZ + 'request'):
+        cgi_variables = [(x.get('name'), x.text or '')
+                         for x in element.findall(_RZ + 'cgi_variable')]
+        body = element.findtext(_RZ + 'body') or ''
+        # the body is rendered between a newline and an indented newline
+        if body.startswith('\n'):
+            body = body[1:]
+        if body.endswith('\n  '):
+            body = body[:-3]
+        body, truncated = _body(body)
+        requests.append(CapturedRequest(element.findtext(_RZ + 'method'),
+                                        element.findtext(_RZ + 'url'),
+                                        cgi_variables, body, truncated))
+    return requests
+
+def read_requests(source):
+    """ Return the requests captured in ``source``:  a verbose log (which
+    may be gzipped), a saved feed, or the URL of a debug UI's feed.
+    """
+    if source.startswith('http://') or source.startswith('https://'):
+        f = urlopen(source)
+        try:
+            return parse_feed(f.read())
+        finally:
+            f.close()
+    if source[-3:] == '.gz':
+        if gzip is None:
+            raise ReplayException('No gzip support to ungzip %s' % source)
+        f = gzip.GzipFile(source, 'r')
+    else:
+        f = open(source, 'rb')
+    try:
+        if f.read(100).lstrip().startswith(b'<'):
+            f.seek(0)
+            return parse_feed(f.read())
+        f.seek(0)
+        return parse_verbose_log(f)
+    finally:
+        f.close()
+
+def make_environ(request, multithread=False, multiprocess=False):
+    """ Build a WSGI environ for replaying ``request``.
+    """
+    environ = dict(request.cgi_variables)
+    scheme, netloc, path, query, fragment = urlsplit(request.url)
+    host, port = netloc, scheme == 'https' and '443' or '80'
+    if ':' in netloc:
+        host, port = netloc.rsplit(':', 1)
+    environ.setdefault('REQUEST_METHOD', request.method)
+    environ.setdefault('SCRIPT_NAME', '')
+    environ.setdefault('PATH_INFO', unquote(path))
+    environ.setdefault('QUERY_STRING', query)
+    environ.setdefault('SERVER_NAME', host)
+    environ.setdefault('SERVER_PORT', port)
+    environ.setdefault('SERVER_PROTOCOL', 'HTTP/1.0')
+    if request.body or 'CONTENT_LENGTH' in environ:
+        environ['CONTENT_LENGTH'] = str(len(request.body))
+    environ['wsgi.input'] = io.BytesIO(request.body)
+    environ['wsgi.errors'] = sys.stderr
+    environ['wsgi.version'] = (1, 0)
+    environ['wsgi.url_scheme'] = scheme or 'http'
+    environ['wsgi.multithread'] = multithread
+    environ['wsgi.multiprocess'] = multiprocess
+    environ['wsgi.run_once'] = False
+    return environ
+
+class ReplayStats(object):
+    """ Outcome of a replay.
+    """
+    def __init__(self):
+        self.latency = LatencyHistogram()
+        self.statuses = {}
+        self.errors = 0
+        self.bytes_out = 0
+        self.elapsed = 0.0
+
+    def record(self, status, bytes_out, duration):
+        code = status.split(' ', 1)[0]
+        self.statuses[code] = self.statuses.get(code, 0) + 1
+        self.bytes_out += bytes_out
+        self.latency.record(duration)
+
+    def merge(self, other):
+        """ Add the outcome of a replay run alongside this one.
+        """
+        self.latency.merge(other.latency)
+        for code, count in other.statuses.items():
+            self.statuses[code] = self.statuses.get(code, 0) + count
+        self.errors += other.errors
+        self.bytes_out += other.bytes_out
+        self.elapsed = max(self.elapsed, other.elapsed)
+
+    def throughput(self):
+        return self.elapsed and self.latency.count / self.elapsed or 0.0
+
+class Replayer(object):
+    """ Replay requests against ``app`` from ``threads`` threads.
+
+    If ``rate`` (requests per second) is nonzero, request ``n`` is sent
+    ``n / rate`` seconds after the start, and its latency measured from
+    then:  an application which can't keep up shows growing latencies,
+    rather than the replay slowing down to its pace.
+    """
+    def __init__(self, app, requests, threads=1, rate=0.0,
+                 multiprocess=False, sleep=time.sleep):
+        self.app = app
+        self.requests = requests
+        self.threads = threads
+        self.rate = rate
+        self.multiprocess = multiprocess
+        self.sleep = sleep
+        self.lock = threading.Lock()
+
+    def run(self, count):
+        """ Send ``count`` requests, cycling through the captured ones.
+        """
+        stats = ReplayStats()
+        sequence = iter(range(count))
+        start = clock.now()
+        workers = [threading.Thread(target=self.worker,
+                                    args=(sequence, start, stats))
+                   for i in range(self.threads)]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+        stats.elapsed = clock.now() - start
+        return stats
+
+    def worker(self, sequence, start, stats):
+        while True:
+            self.lock.acquire()
+            try:
+                n = next(sequence, None)
+            finally:
+                self.lock.release()
+            if n is None:
+                return
+            request = self.requests[n % len(self.requests)]
+            if self.rate:
+                begin = start + n / self.rate
+                delay = begin - clock.now()
+                if delay > 0:
+                    self.sleep(delay)
+            else:
+                begin = clock.now()
+            try:
+                status, bytes_out = self.call(request)
+                error = False
+            except Exception:
+                traceback.print_exc()
+                status, bytes_out, error = '500 Exception Raised', 0, True
+            duration = clock.now() - begin
+            self.lock.acquire()
+            try:
+                stats.record(status, bytes_out, duration)
+                stats.errors += error
+            finally:
+                self.lock.release()
+
+    def call(self, request):
+        """ Serve ``request``;  return the status and the body length.
+        """
+        environ = make_environ(request, self.threads > 1, self.multiprocess)
+        started = []
+        written = []
+        def start_response(status, headers, exc_info=None):
+            started[:] = [status]
+            return written.append
+        app_iter = self.app(environ, start_response)
+        try:
+            bytes_out = 0
+            for chunk in app_iter:
+                bytes_out += len(chunk)
+        finally:
+            close = getattr(app_iter, 'close', None)
+            if close is not None:
+                close()
+        bytes_out += sum([len(x) for x in written])
+        return started and started[0] or '500 Start Response Not Called', \
+               bytes_out
+
+def load_app(config, name=None):
+    """ Load the WSGI application ``name`` from the Paste ``config`` file.
+    """
+    try:
+        from paste.deploy import loadapp
+    except ImportError:
+        raise ReplayException('Loading %s requires PasteDeploy' % config)
+    return loadapp('config:%s' % os.path.abspath(config), name=name)
+
+def _replay_process(args):
+    config, name, requests, threads, rate, count = args
+    replayer = Replayer(load_app(config, name), requests, threads, rate,
+                        multiprocess=True)
+    return replayer.run(count)
+
+def replay(config, name, requests, count, threads=1, processes=1, rate=0.0):
+    """ Replay ``count`` requests from ``processes`` processes of
+    ``threads`` threads each, at ``rate`` requests per second overall.
+    """
+    if processes == 1:
+        return Replayer(load_app(config, name), requests, threads,
+                        rate).run(count)
+    import multiprocessing
+    # each process replays every ``processes``th request, at its share of
+    # the rate
+    jobs = []
+    for i in range(processes):
+        share = [requests[n % len(requests)]
+                 for n in range(i, count, processes)]
+        jobs.append((config, name, share, threads, rate / processes,
+                     len(share)))
+    pool = multiprocessing.Pool(processes)
+    try:
+        results = pool.map(_replay_process, jobs)
+    finally:
+        pool.close()
+        pool.join()
+    stats = results[0]
+    for other in results[1:]:
+        stats.merge(other)
+    return stats
+
+def format_report(stats):
+    """ Render the outcome of a replay as plain text.
+    """
+    summary = stats.latency.summary()
+    out = []
+    out.append('Requests:    %d (%d errors)' % (summary['count'],
+                                                stats.errors))
+    out.append('Elapsed:     %.2f seconds' % stats.elapsed)
+    out.append('Throughput:  %.1f requests/second' % stats.throughput())
+    out.append('Sent:        %d bytes' % stats.bytes_out)
+    if summary['count']:
+        out.append('Latency:     mean %.4f  p50 %.4f  p90 %.4f  p99 %.4f  '
+                   'max %.4f seconds' % (summary['mean'], summary['p50'],
+                                         summary['p90'], summary['p99'],
+                                         summary['max']))
+    out.append('Statuses:    %s' % '  '.join(
+        ['%s: %d' % x for x in sorted(stats.statuses.items())]))
+    return '\n'.join(out) + '\n'
+
+def usage():
+    return """
+Usage: %s config.ini source1 [source2 ...]
+          [--app=name]
+          [--threads=n]
+          [--processes=n]
+          [--rate=n]
+          [--repeat=n]
+          [--help]
+
+Replays the requests captured by repoze.debug's response logger, in-process,
+against the WSGI application configured in the Paste configuration file
+'config.ini', then reports throughput and latency percentiles.
+
+Each source is a verbose log (which may be gzipped), a saved copy of the
+debug UI's feed (/__repoze.debug/feed.xml) or the URL of a running
+application's feed.  Requests are replayed in the order they were captured.
+
+  --app=name      Load the application 'name' of the configuration file
+                  (default: main).
+  --threads=n     Send requests from n threads (default: 1).
+  --processes=n   Run n processes, each loading the application and sending
+                  from --threads threads (default: 1).
+  --rate=n        Send n requests per second overall;  latencies are
+                  measured from when each request was due.  By default,
+                  requests are sent as fast as the application serves them.
+  --repeat=n      Replay the captured requests n times (default: 1).
+
+Latency percentiles are reported with the resolution of repoze.debug's
+latency histograms (within about 20%%).
+""" % sys.argv[0]
+
+def main(argv=None):
+    if argv is None:
+        argv = sys.argv[1:]
+    try:
+        opts, args = getopt.getopt(argv, '', ['app=', 'threads=',
+                                              'processes=', 'rate=',
+                                              'repeat=', 'help'])
+        name = None
+        threads = processes = repeat = 1
+        rate = 0.0
+        for opt, val in opts:
+            if opt == '--app':
+                name = val
+            elif opt == '--threads':
+                threads = int(val)
+            elif opt == '--processes':
+                processes = int(val)
+            elif opt == '--rate':
+                rate = float(val)
+            elif opt == '--repeat':
+                repeat = int(val)
+            elif opt == '--help':
+                print(usage())
+                return 0
+        if len(args) < 2 or min(threads, processes, repeat) < 1 or rate < 0:
+            print(usage())
+            return 1
+        requests = []
+        for source in args[1:]:
+            requests.extend(read_requests(source))
+        if not requests:
+            raise ReplayException('No requests found in %s'
+                                  % ', '.join(args[1:]))
+        truncated = len([x for x in requests if x.truncated])
+        if truncated:
+            sys.stderr.write('Warning: %d request bodies were truncated when '
+                             'captured;  they are replayed truncated\n'
+                             % truncated)
+        stats = replay(args[0], name, requests, len(requests) * repeat,
+                       threads, processes, rate)
+    except (getopt.error, ValueError, ReplayException) as e:
+        sys.stderr.write('Error: %s\n' % e)
+        print(usage())
+        return 1
+    sys.stdout.write(format_report(stats))
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
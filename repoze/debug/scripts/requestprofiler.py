@@ -21,6 +21,8 @@ import time
 from repoze.debug._compat import Pickler
 from repoze.debug._compat import Unpickler
 from repoze.debug._compat import gzip
+from repoze.debug.tracelog import BinaryTraceReader
+from repoze.debug.tracelog import is_binary_trace
 
 class ProfileException(Exception):
     pass
@@ -34,6 +36,9 @@ class Request(object):
         self.t_recdinput = None
         self.isize = 0
         self.t_recdoutput = None
+        self.t_firstbyte = None
+        self.chunks = None
+        self.maxgap = None
         self.osize = None
         self.httpcode = None
         self.t_end = None
@@ -41,7 +46,7 @@ class Request(object):
         self.active = 0
 
     def put(self, code, t, desc):
-        if code not in ('A', 'B', 'I', 'E'):
+        if code not in ('A', 'B', 'I', 'F', 'E'):
             raise ValueError("unknown request code %s" % code)
         if code == 'B':
             self.start = t
@@ -50,9 +55,16 @@ class Request(object):
             self.t_recdinput = t
             self.t_recdoutput = t
             self.httpcode, self.osize = desc.strip().split()
+        elif code == 'F':
+            self.t_firstbyte = t
         elif code == 'E':
             self.t_end = t
             self.elapsed = self.t_end - self.start
+            fields = desc.split()
+            if len(fields) >= 3:
+                # bodylen, chunks, largest gap between chunks
+                self.chunks = int(fields[1])
+                self.maxgap = parse_seconds(fields[2])
 
     def isfinished(self):
         return not self.elapsed is None
@@ -89,6 +101,18 @@ class Request(object):
         else:
             return -1
 
+    def ttfb(self):
+        if self.t_firstbyte is not None and self.start is not None:
+            return self.t_firstbyte - self.start
+        else:
+            return -1
+
+    def stall(self):
+        if self.maxgap is not None:
+            return self.maxgap
+        else:
+            return -1
+
     def endstage(self):
         if self.t_end is not None:
             stage = "E"
@@ -130,18 +154,18 @@ class Request(object):
             return "NA"
 
     def __str__(self):    # pragma: no cover
-        fmt = "%19s %5.2f %5.2f %5.2f %5.2f %1s %7s %4s %4s %s"
+        fmt = "%19s %5.2f %5.2f %5.2f %5.2f %5.2f %5.2f %1s %7s %4s %4s %s"
         body = (
             self.prettystart(), self.win(), self.wout(), self.wend(),
-            self.total(), self.endstage(), self.prettyosize(),
-            self.prettyhttpcode(), self.active, self.url
+            self.ttfb(), self.stall(), self.total(), self.endstage(),
+            self.prettyosize(), self.prettyhttpcode(), self.active, self.url
             )
         return fmt % body
 
     def getheader(self):  # pragma: no cover
-        fmt = "%19s %5s %5s %5s %5s %1s %7s %4s %4s %s"
-        body = ('Start', 'WIn', 'WOut', 'WEnd', 'Tot', 'S', 'OSize',
-                'Code', 'Act', 'URL')
+        fmt = "%19s %5s %5s %5s %5s %5s %5s %1s %7s %4s %4s %s"
+        body = ('Start', 'WIn', 'WOut', 'WEnd', 'TTFB', 'Stall', 'Tot', 'S',
+                'OSize', 'Code', 'Act', 'URL')
         return fmt % body
 
 class StartupRequest(Request):
@@ -216,6 +240,17 @@ class Cumulative:
     def total(self):
         return float(sum(self.times))
 
+def parse_seconds(value):
+    """ Parse a time or duration from a trace log, in seconds.
+
+    Current logs write integer nanoseconds;  older ones wrote (float)
+    seconds.
+    """
+    try:
+        return int(value) / 1e9
+    except ValueError:
+        return float(value)
+
 def parselogline(line):
     tup = line.split(None, 4)
     if len(tup) == 4:
@@ -232,6 +267,16 @@ def get_earliest_file_data(files):
     earliest = None
     retn = None
     for file in files:
+        if hasattr(file, 'peek'):
+            # binary trace log reader
+            tup = file.peek()
+            if tup is None:
+                continue
+            if earliest_fromepoch == 0 or tup[3] < earliest_fromepoch:
+                earliest_fromepoch = tup[3]
+                earliest = file
+                retn = tup
+            continue
         line = file.readline()
         if not line:
             continue
@@ -242,7 +287,7 @@ def get_earliest_file_data(files):
             continue
         code, pid, id, timestr, desc = tup
         timestr = timestr.strip()
-        fromepoch = float(timestr)
+        fromepoch = parse_seconds(timestr)
         temp[file] = linelen
         if earliest_fromepoch == 0 or fromepoch < earliest_fromepoch:
             earliest_fromepoch = fromepoch
@@ -252,9 +297,27 @@ def get_earliest_file_data(files):
     for file, linelen in temp.items():
         if file is not earliest:
             file.seek(file.tell() - linelen)
+    if earliest is not None and earliest not in temp:
+        earliest.advance()
 
     return retn
 
+def open_log(filename):
+    """ Open a trace log, which may be gzipped and / or binary.
+    """
+    if filename[-3:] == '.gz':
+        if gzip is None:
+            raise ValueError('No gzip support to ungzip %s' % filename)
+        f = gzip.GzipFile(filename, 'r')
+    else:
+        f = open(filename, 'rb')
+    if is_binary_trace(f):
+        return BinaryTraceReader(f)
+    if filename[-3:] == '.gz':
+        return f
+    f.close()
+    return open(filename)
+
 def get_requests(files, start=None, end=None, statsfname=None,
                  writestats=None, readstats=None):
     finished = []
@@ -582,6 +645,10 @@ For detailed (non-cumulative) reports, the following sort specs are accepted:
   'win'         -- the num of secs repoze.debug spent waiting for input
   'wout'        -- the secs repoze.debug spent waiting for output from app
   'wend'        -- the secs repoze.debug spent sending data to server
+  'ttfb'        -- the secs from the start of the request until the app
+                   produced the first byte of the response body
+  'stall'       -- the longest gap in secs between two chunks of the
+                   response body (streaming responses)
   'total'       -- the secs taken for the request from begin to end
   'endstage'    -- the last successfully completed request stage (B, I, A, E)
   'osize'       -- the size in bytes of output provided by repoze.debug
@@ -729,12 +796,7 @@ def main():
     i = 1
     for arg in sys.argv[1:]:
         if arg[:2] != '--':
-            if arg[-3:] == '.gz':
-                if gzip is None:
-                    raise ValueError('No gzip support to ungzip %s' % arg)
-                files.append(gzip.GzipFile(arg,'r'))
-            else:
-                files.append(open(arg))
+            files.append(open_log(arg))
             sys.argv.remove(arg)
             i = i + 1
 
@@ -801,7 +863,8 @@ def main():
 
         validcumsorts = ['url', 'hits', 'hangs', 'max', 'min', 'median',
                          'mean', 'total']
-        validdetsorts = ['start', 'win', 'wout', 'wend', 'total',
+        validdetsorts = ['start', 'win', 'wout', 'wend', 'ttfb', 'stall',
+                         'total',
                          'endstage', 'isize', 'osize', 'httpcode',
                          'active', 'url']
 
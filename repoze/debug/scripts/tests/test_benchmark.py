@@ -0,0 +1,192 @@
+import unittest
+
+
+class Test_serve(unittest.TestCase):
+
+    def _callFUT(self, app, count):
+        from ..benchmark import serve
+        return serve(app, count)
+
+    def test_closes_app_iter(self):
+        closed = []
+        class AppIter(list):
+            def close(self):
+                closed.append(True)
+        def app(environ, start_response):
+            start_response('200 OK', [])
+            return AppIter([b'abc'])
+        self._callFUT(app, 3)
+        self.assertEqual(closed, [True] * 3)
+
+
+class Test_time_requests(unittest.TestCase):
+
+    def _callFUT(self, app, count, threads):
+        from ..benchmark import time_requests
+        return time_requests(app, count, threads)
+
+    def test_shares_requests_between_threads(self):
+        seen = []
+        def app(environ, start_response):
+            seen.append(environ['PATH_INFO'])
+            start_response('200 OK', [])
+            return [b'']
+        elapsed = self._callFUT(app, 10, 3)
+        self.assertEqual(len(seen), 10)
+        self.assertTrue(elapsed > 0)
+
+
+class Test_run_case(unittest.TestCase):
+
+    def _callFUT(self, *arg, **kw):
+        from ..benchmark import run_case
+        return run_case(*arg, **kw)
+
+    def test_each_middleware(self):
+        from ..benchmark import MIDDLEWARE
+        for name, description, factory in MIDDLEWARE:
+            result = self._callFUT(name, 'streaming', 4, threads=2, warmup=1,
+                                   memory_requests=2)
+            self.assertEqual(result['middleware'], name)
+            self.assertEqual(result['app'], 'streaming')
+            self.assertEqual(result['threads'], 2)
+            self.assertEqual(result['requests'], 4)
+            self.assertTrue(result['ns_per_request'] > 0)
+
+    def test_memory(self):
+        from ..benchmark import tracemalloc
+        result = self._callFUT('canary', 'trivial', 2, warmup=1,
+                               memory_requests=2)
+        if tracemalloc is None or not hasattr(tracemalloc, 'reset_peak'):
+            self.assertEqual(result['peak_bytes'], None)
+        else:
+            self.assertTrue(result['alloc_bytes_per_request'] > 0)
+            self.assertTrue(result['peak_bytes'] > 0)
+
+    def test_wo_memory(self):
+        result = self._callFUT('none', 'trivial', 2, warmup=1,
+                               memory_requests=0)
+        self.assertEqual(result['alloc_bytes_per_request'], None)
+        self.assertEqual(result['retained_blocks_per_request'], None)
+        self.assertEqual(result['peak_bytes'], None)
+
+
+class Test_run(unittest.TestCase):
+
+    def _callFUT(self, *arg, **kw):
+        from ..benchmark import run
+        return run(*arg, **kw)
+
+    def test_it(self):
+        results = self._callFUT(['none', 'canary'], ['trivial', 'streaming'],
+                                2, threads=(1, 2), memory_requests=0)
+        self.assertEqual([(x['middleware'], x['app'], x['threads'])
+                          for x in results],
+                         [('none', 'trivial', 1), ('canary', 'trivial', 1),
+                          ('none', 'trivial', 2), ('canary', 'trivial', 2),
+                          ('none', 'streaming', 1),
+                          ('canary', 'streaming', 1),
+                          ('none', 'streaming', 2),
+                          ('canary', 'streaming', 2)])
+        for result in results:
+            self.assertTrue('overhead_ns' in result)
+
+
+class Test_format_results(unittest.TestCase):
+
+    def _callFUT(self, results, previous=None):
+        from ..benchmark import format_results
+        return format_results(results, previous)
+
+    def _makeResult(self, middleware='canary', ns_per_request=1500, **kw):
+        result = {'middleware': middleware, 'app': 'trivial', 'threads': 1,
+                  'requests': 10, 'ns_per_request': ns_per_request,
+                  'overhead_ns': 500, 'alloc_bytes_per_request': 800,
+                  'retained_blocks_per_request': 0.5, 'peak_bytes': 2000}
+        result.update(kw)
+        return result
+
+    def test_it(self):
+        lines = self._callFUT([self._makeResult(peak_bytes=None)]).splitlines()
+        self.assertEqual(len(lines), 2)
+        self.assertEqual(lines[1].split(),
+                         ['canary', 'trivial', '1', '1500', '500', '800',
+                          '0.50', '-'])
+
+    def test_compare(self):
+        lines = self._callFUT(
+            [self._makeResult(), self._makeResult('pdbpm')],
+            [self._makeResult(ns_per_request=1000)]).splitlines()
+        self.assertTrue(lines[0].endswith('Change'))
+        self.assertTrue(lines[1].endswith('+50.0%'))
+        self.assertTrue(lines[2].endswith('-'))
+
+
+class Test_main(unittest.TestCase):
+
+    def setUp(self):
+        import tempfile
+        self.tempdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        import shutil
+        shutil.rmtree(self.tempdir)
+
+    def _callFUT(self, argv):
+        import sys
+        from repoze.debug._compat import NativeStringIO as StringIO
+        from ..benchmark import main
+        saved = sys.stdout, sys.stderr
+        sys.stdout, sys.stderr = StringIO(), StringIO()
+        try:
+            result = main(argv)
+            return result, sys.stdout.getvalue(), sys.stderr.getvalue()
+        finally:
+            sys.stdout, sys.stderr = saved
+
+    def test_json_and_compare(self):
+        import json
+        import os
+        filename = os.path.join(self.tempdir, 'bench.json')
+        argv = ['--middleware=none,canary', '--app=trivial', '--threads=1',
+                '--requests=2']
+        result, out, err = self._callFUT(argv + ['--json=%s' % filename])
+        self.assertEqual(result, 0)
+        with open(filename) as f:
+            report = json.load(f)
+        self.assertEqual([x['middleware'] for x in report['results']],
+                         ['none', 'canary'])
+        for key in ('version', 'python', 'implementation', 'platform',
+                    'time'):
+            self.assertTrue(key in report)
+        result, out, err = self._callFUT(argv + ['--compare=%s' % filename])
+        self.assertEqual(result, 0)
+        self.assertTrue(out.splitlines()[0].endswith('Change'))
+
+    def test_list(self):
+        result, out, err = self._callFUT(['--list'])
+        self.assertEqual(result, 0)
+        self.assertTrue(out.startswith('none '))
+
+    def test_help(self):
+        result, out, err = self._callFUT(['--help'])
+        self.assertEqual(result, 0)
+        self.assertTrue('Usage:' in out)
+
+    def test_unknown_middleware(self):
+        result, out, err = self._callFUT(['--middleware=nonesuch'])
+        self.assertEqual(result, 1)
+        self.assertTrue('Unknown middleware: nonesuch' in err)
+
+    def test_unknown_app(self):
+        result, out, err = self._callFUT(['--app=nonesuch'])
+        self.assertEqual(result, 1)
+        self.assertTrue('Unknown app: nonesuch' in err)
+
+    def test_missing_compare_file(self):
+        result, out, err = self._callFUT(['--compare=/nonesuch.json'])
+        self.assertEqual(result, 1)
+
+    def test_bad_arguments(self):
+        result, out, err = self._callFUT(['--threads=0'])
+        self.assertEqual(result, 1)
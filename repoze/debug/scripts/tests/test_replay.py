@@ -0,0 +1,397 @@
+import unittest
+
+
+class Test_parse_verbose_log(unittest.TestCase):
+
+    def _callFUT(self, lines):
+        from ..replay import parse_verbose_log
+        return parse_verbose_log(lines)
+
+    def _log(self, request_id, method, url, body=b'', cgi_variables=(),
+             bodylen=None):
+        from repoze.debug.responselogger import format_request
+        from repoze.debug.responselogger import format_response
+        request_info = {'method': method, 'url': url, 'begin': 1.0,
+                        'cgi_variables': list(cgi_variables),
+                        'wsgi_variables': [('application', '<app>')],
+                        'body': body,
+                        'bodylen': bodylen is None and len(body) or bodylen,
+                       }
+        response_info = {'status': '200 OK', 'headers': [], 'body': b'ok',
+                         'content-length': None, 'begin': 1.5, 'end': 2.0}
+        return (format_request(request_id, request_info),
+                format_response(request_id, request_info, response_info, 2))
+
+    def _lines(self, *blocks):
+        return '\n'.join(blocks).splitlines(True)
+
+    def test_empty(self):
+        self.assertEqual(self._callFUT([]), [])
+
+    def test_requests(self):
+        first = self._log(1, 'GET', 'http://localhost/a?b=1',
+                          cgi_variables=[('HTTP_HOST', 'localhost'),
+                                         ('PATH_INFO', '/a')])
+        second = self._log(2, 'POST', 'http://localhost/b',
+                           body=b'x=1\ny: 2')
+        # responses may be logged in any order
+        requests = self._callFUT(self._lines(first[0], second[0], second[1],
+                                             first[1]))
+        self.assertEqual([x.method for x in requests], ['GET', 'POST'])
+        self.assertEqual(requests[0].url, 'http://localhost/a?b=1')
+        self.assertEqual(requests[0].cgi_variables,
+                         [('HTTP_HOST', 'localhost'), ('PATH_INFO', '/a')])
+        self.assertEqual(requests[0].body, b'')
+        self.assertEqual(requests[1].body, b'x=1\ny: 2')
+        self.assertFalse(requests[1].truncated)
+
+    def test_truncated_body(self):
+        blocks = self._log(1, 'POST', 'http://localhost/',
+                           body=b'abc ... (truncated at 3 bytes)', bodylen=10)
+        requests = self._callFUT(self._lines(*blocks))
+        self.assertEqual(requests[0].body, b'abc')
+        self.assertTrue(requests[0].truncated)
+
+    def test_response_not_logged(self):
+        request, response = self._log(1, 'GET', 'http://localhost/')
+        requests = self._callFUT(self._lines('garbage', request))
+        self.assertEqual(len(requests), 1)
+        self.assertEqual(requests[0].body, b'')
+
+    def test_bytes_lines(self):
+        blocks = self._log(1, 'POST', 'http://localhost/', body=b'\xe9')
+        lines = [x.encode('latin1') for x in self._lines(*blocks)]
+        self.assertEqual(self._callFUT(lines)[0].body, b'\xe9')
+
+
+class Test_parse_feed(unittest.TestCase):
+
+    def _callFUT(self, data):
+        from ..replay import parse_feed
+        return parse_feed(data)
+
+    def _feed(self, entries):
+        from repoze.debug.ui import DebugGui
+        class Middleware(object):
+            pid = 1234
+        middleware = Middleware()
+        middleware.entries = entries
+        return DebugGui(middleware).getFeed().body
+
+    def test_requests(self):
+        from repoze.debug.entries import StringTable
+        from repoze.debug.entries import compact_entry
+        entry = {'id': 1,
+                 'request': {'method': 'POST',
+                             'url': 'http://localhost/a?b=1&c=2',
+                             'begin': 1.0, 'body': b'<x>\n&amp;',
+                             'cgi_variables': [('HTTP_HOST', 'localhost')],
+                             'wsgi_variables': [('application', object())],
+                            },
+                 'response': {'status': '200 OK', 'headers': [],
+                              'content-length': None, 'body': b'ok',
+                              'begin': 1.5, 'end': 2.0},
+                }
+        compact_entry(entry, StringTable())
+        requests = self._callFUT(self._feed([entry]))
+        self.assertEqual(len(requests), 1)
+        request = requests[0]
+        self.assertEqual(request.method, 'POST')
+        self.assertEqual(request.url, 'http://localhost/a?b=1&c=2')
+        self.assertEqual(request.cgi_variables, [('HTTP_HOST', 'localhost')])
+        self.assertEqual(request.body, b'<x>\n&amp;')
+
+    def test_invalid(self):
+        from ..replay import ReplayException
+        self.assertRaises(ReplayException, self._callFUT, b'<atom:feed')
+
+
+class Test_read_requests(unittest.TestCase):
+
+    def setUp(self):
+        import tempfile
+        self.tempdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        import shutil
+        shutil.rmtree(self.tempdir)
+
+    def _callFUT(self, source):
+        from ..replay import read_requests
+        return read_requests(source)
+
+    def _write(self, name, data):
+        import os
+        from repoze.debug._compat import gzip
+        filename = os.path.join(self.tempdir, name)
+        if name.endswith('.gz'):
+            f = gzip.GzipFile(filename, 'wb')
+        else:
+            f = open(filename, 'wb')
+        f.write(data)
+        f.close()
+        return filename
+
+    def test_verbose_log(self):
+        data = (b'--- begin REQUEST for 1 at Mon Jun 30 13:37:51 2008 ---\n'
+                b'URL: GET http://localhost/\n'
+                b'--- end REQUEST for 1 ---\n')
+        for name in ('verbose.log', 'verbose.log.gz'):
+            requests = self._callFUT(self._write(name, data))
+            self.assertEqual([x.url for x in requests], ['http://localhost/'])
+
+    def test_feed(self):
+        data = (b'<?xml version="1.0" encoding="utf-8"?>\n'
+                b'<rz:request xmlns:rz="http://repoze.org/namespace">'
+                b'<rz:method>GET</rz:method>'
+                b'<rz:url>http://localhost/</rz:url></rz:request>')
+        requests = self._callFUT(self._write('feed.xml', data))
+        self.assertEqual([x.url for x in requests], ['http://localhost/'])
+
+
+class Test_make_environ(unittest.TestCase):
+
+    def _callFUT(self, request, **kw):
+        from ..replay import make_environ
+        return make_environ(request, **kw)
+
+    def _makeRequest(self, *arg, **kw):
+        from ..replay import CapturedRequest
+        return CapturedRequest(*arg, **kw)
+
+    def test_from_url(self):
+        request = self._makeRequest('GET', 'https://example.com:8443/a%20b?c=1')
+        environ = self._callFUT(request, multithread=True)
+        self.assertEqual(environ['REQUEST_METHOD'], 'GET')
+        self.assertEqual(environ['SCRIPT_NAME'], '')
+        self.assertEqual(environ['PATH_INFO'], '/a b')
+        self.assertEqual(environ['QUERY_STRING'], 'c=1')
+        self.assertEqual(environ['SERVER_NAME'], 'example.com')
+        self.assertEqual(environ['SERVER_PORT'], '8443')
+        self.assertEqual(environ['wsgi.url_scheme'], 'https')
+        self.assertEqual(environ['wsgi.multithread'], True)
+        self.assertEqual(environ['wsgi.multiprocess'], False)
+        self.assertFalse('CONTENT_LENGTH' in environ)
+        self.assertEqual(environ['wsgi.input'].read(), b'')
+
+    def test_cgi_variables_win(self):
+        request = self._makeRequest(
+            'POST', 'http://example.com/app/a',
+            [('SCRIPT_NAME', '/app'), ('PATH_INFO', '/a'),
+             ('CONTENT_LENGTH', '10'), ('HTTP_USER_AGENT', 'test')],
+            body=b'abc')
+        environ = self._callFUT(request)
+        self.assertEqual(environ['SCRIPT_NAME'], '/app')
+        self.assertEqual(environ['PATH_INFO'], '/a')
+        self.assertEqual(environ['SERVER_PORT'], '80')
+        self.assertEqual(environ['HTTP_USER_AGENT'], 'test')
+        self.assertEqual(environ['CONTENT_LENGTH'], '3')
+        self.assertEqual(environ['wsgi.input'].read(), b'abc')
+
+
+class ReplayStatsTests(unittest.TestCase):
+
+    def _makeOne(self):
+        from ..replay import ReplayStats
+        return ReplayStats()
+
+    def test_record_and_merge(self):
+        stats = self._makeOne()
+        stats.record('200 OK', 10, 0.5)
+        stats.elapsed = 2.0
+        other = self._makeOne()
+        other.record('200 OK', 5, 0.25)
+        other.record('404 Not Found', 0, 0.25)
+        other.errors = 1
+        other.elapsed = 4.0
+        stats.merge(other)
+        self.assertEqual(stats.statuses, {'200': 2, '404': 1})
+        self.assertEqual(stats.bytes_out, 15)
+        self.assertEqual(stats.errors, 1)
+        self.assertEqual(stats.elapsed, 4.0)
+        self.assertEqual(stats.latency.count, 3)
+        self.assertEqual(stats.throughput(), 0.75)
+
+    def test_throughput_empty(self):
+        self.assertEqual(self._makeOne().throughput(), 0.0)
+
+
+class ReplayerTests(unittest.TestCase):
+
+    def _makeOne(self, app, requests, **kw):
+        from ..replay import Replayer
+        return Replayer(app, requests, **kw)
+
+    def _makeRequests(self, *paths):
+        from ..replay import CapturedRequest
+        return [CapturedRequest('GET', 'http://localhost' + x) for x in paths]
+
+    def test_run(self):
+        seen = []
+        def app(environ, start_response):
+            seen.append(environ['PATH_INFO'])
+            start_response('200 OK', [])
+            return [b'abc', b'de']
+        replayer = self._makeOne(app, self._makeRequests('/a', '/b'),
+                                 threads=3)
+        stats = replayer.run(5)
+        self.assertEqual(sorted(seen), ['/a', '/a', '/a', '/b', '/b'])
+        self.assertEqual(stats.statuses, {'200': 5})
+        self.assertEqual(stats.bytes_out, 25)
+        self.assertEqual(stats.latency.count, 5)
+        self.assertTrue(stats.elapsed > 0)
+
+    def test_run_w_rate(self):
+        delays = []
+        replayer = self._makeOne(_app, self._makeRequests('/'), rate=10.0,
+                                 sleep=delays.append)
+        stats = replayer.run(3)
+        self.assertEqual(stats.latency.count, 3)
+        # the first request is due right away
+        self.assertEqual(len(delays), 2)
+        self.assertTrue(0.19 < delays[-1] <= 0.2)
+
+    def test_run_app_raises(self):
+        import sys
+        from repoze.debug._compat import NativeStringIO as StringIO
+        def app(environ, start_response):
+            raise ValueError('broken')
+        replayer = self._makeOne(app, self._makeRequests('/'))
+        saved, sys.stderr = sys.stderr, StringIO()
+        try:
+            stats = replayer.run(2)
+            printed = sys.stderr.getvalue()
+        finally:
+            sys.stderr = saved
+        self.assertEqual(stats.errors, 2)
+        self.assertEqual(stats.statuses, {'500': 2})
+        self.assertTrue('ValueError: broken' in printed)
+
+    def test_call_closes_app_iter(self):
+        closed = []
+        class AppIter(list):
+            def close(self):
+                closed.append(True)
+        def app(environ, start_response):
+            write = start_response('201 Created', [])
+            write(b'abc')
+            return AppIter([b'de'])
+        replayer = self._makeOne(app, self._makeRequests('/'))
+        self.assertEqual(replayer.call(replayer.requests[0]),
+                         ('201 Created', 5))
+        self.assertEqual(closed, [True])
+
+    def test_call_start_response_not_called(self):
+        replayer = self._makeOne(lambda environ, start_response: [],
+                                 self._makeRequests('/'))
+        self.assertEqual(replayer.call(replayer.requests[0]),
+                         ('500 Start Response Not Called', 0))
+
+
+class Test_format_report(unittest.TestCase):
+
+    def _callFUT(self, stats):
+        from ..replay import format_report
+        return format_report(stats)
+
+    def test_it(self):
+        from ..replay import ReplayStats
+        stats = ReplayStats()
+        stats.record('200 OK', 10, 0.5)
+        stats.record('404 Not Found', 0, 0.5)
+        stats.elapsed = 2.0
+        report = self._callFUT(stats)
+        self.assertTrue('Requests:    2 (0 errors)' in report)
+        self.assertTrue('Throughput:  1.0 requests/second' in report)
+        self.assertTrue('p99 0.5000' in report)
+        self.assertTrue('Statuses:    200: 1  404: 1' in report)
+
+    def test_empty(self):
+        from ..replay import ReplayStats
+        report = self._callFUT(ReplayStats())
+        self.assertFalse('Latency' in report)
+
+
+class Test_main(unittest.TestCase):
+
+    def setUp(self):
+        import tempfile
+        from .. import replay
+        self.tempdir = tempfile.mkdtemp()
+        self._saved = replay.load_app
+        self.loaded = []
+        def load_app(config, name=None):
+            self.loaded.append((config, name))
+            return _app
+        replay.load_app = load_app
+
+    def tearDown(self):
+        import shutil
+        from .. import replay
+        replay.load_app = self._saved
+        shutil.rmtree(self.tempdir)
+
+    def _callFUT(self, argv):
+        import sys
+        from repoze.debug._compat import NativeStringIO as StringIO
+        from ..replay import main
+        saved = sys.stdout, sys.stderr
+        sys.stdout, sys.stderr = StringIO(), StringIO()
+        try:
+            result = main(argv)
+            return result, sys.stdout.getvalue(), sys.stderr.getvalue()
+        finally:
+            sys.stdout, sys.stderr = saved
+
+    def _log(self):
+        import os
+        filename = os.path.join(self.tempdir, 'verbose.log')
+        with open(filename, 'w') as f:
+            f.write('--- begin REQUEST for 1 at Mon Jun 30 13:37:51 2008 ---\n'
+                    'URL: POST http://localhost/\n'
+                    '--- end REQUEST for 1 ---\n'
+                    '--- begin RESPONSE for 1 at Mon Jun 30 13:37:51 2008 ---\n'
+                    'Request Body:\n'
+                    'ab ... (truncated at 2 bytes)\n'
+                    'Request Bodylen: 5\n'
+                    '--- end RESPONSE for 1 (0.00 seconds) ---\n')
+        return filename
+
+    def test_replay(self):
+        result, out, err = self._callFUT(['--app=other', '--repeat=3',
+                                          '--threads=2', 'app.ini',
+                                          self._log()])
+        self.assertEqual(result, 0)
+        self.assertEqual(self.loaded, [('app.ini', 'other')])
+        self.assertTrue('Requests:    3 (0 errors)' in out)
+        self.assertTrue('1 request bodies were truncated' in err)
+
+    def test_help(self):
+        result, out, err = self._callFUT(['--help'])
+        self.assertEqual(result, 0)
+        self.assertTrue('Usage:' in out)
+
+    def test_missing_source(self):
+        result, out, err = self._callFUT(['app.ini'])
+        self.assertEqual(result, 1)
+        self.assertTrue('Usage:' in out)
+
+    def test_bad_option(self):
+        result, out, err = self._callFUT(['--threads=x', 'app.ini',
+                                          self._log()])
+        self.assertEqual(result, 1)
+        self.assertTrue(err.startswith('Error:'))
+
+    def test_no_requests(self):
+        import os
+        filename = os.path.join(self.tempdir, 'empty.log')
+        open(filename, 'w').close()
+        result, out, err = self._callFUT(['app.ini', filename])
+        self.assertEqual(result, 1)
+        self.assertTrue('No requests found' in err)
+
+
+def _app(environ, start_response):
+    environ['wsgi.input'].read()
+    start_response('200 OK', [('Content-Type', 'text/plain')])
+    return [b'ok']
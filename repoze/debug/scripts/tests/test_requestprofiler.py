@@ -17,6 +17,9 @@ class RequestTests(unittest.TestCase):
         self.assertEqual(request.t_recdinput, None)
         self.assertEqual(request.isize, 0)
         self.assertEqual(request.t_recdoutput, None)
+        self.assertEqual(request.t_firstbyte, None)
+        self.assertEqual(request.chunks, None)
+        self.assertEqual(request.maxgap, None)
         self.assertEqual(request.osize, None)
         self.assertEqual(request.httpcode, None)
         self.assertEqual(request.t_end, None)
@@ -58,6 +61,48 @@ class RequestTests(unittest.TestCase):
         request.put('E', 123, 'whatever')
         self.assertEqual(request.t_end, 123)
         self.assertEqual(request.elapsed, 23)
+        self.assertEqual(request.chunks, None)
+        self.assertEqual(request.maxgap, None)
+
+    def test_put_w_E_w_chunk_timings(self):
+        request = self._makeOne()
+        request.start = 100
+        request.put('E', 123, '4567 3 1.5')
+        self.assertEqual(request.elapsed, 23)
+        self.assertEqual(request.chunks, 3)
+        self.assertEqual(request.maxgap, 1.5)
+
+    def test_put_w_E_w_chunk_timings_ns(self):
+        request = self._makeOne()
+        request.start = 100
+        request.put('E', 123, '4567 3 1500000000')
+        self.assertEqual(request.chunks, 3)
+        self.assertEqual(request.maxgap, 1.5)
+
+    def test_put_w_F(self):
+        request = self._makeOne()
+        request.put('F', 123, '')
+        self.assertEqual(request.t_firstbyte, 123)
+
+    def test_ttfb_na(self):
+        request = self._makeOne()
+        self.assertEqual(request.ttfb(), -1)
+
+    def test_ttfb_w_first_byte(self):
+        request = self._makeOne()
+        request.put('B', 100, 'GET /')
+        request.put('F', 102.5, '')
+        self.assertEqual(request.ttfb(), 2.5)
+
+    def test_stall_na(self):
+        request = self._makeOne()
+        self.assertEqual(request.stall(), -1)
+
+    def test_stall_w_maxgap(self):
+        request = self._makeOne()
+        request.start = 100
+        request.put('E', 123, '4567 3 1.5')
+        self.assertEqual(request.stall(), 1.5)
 
     def test_is_finished_no_elapsed(self):
         request = self._makeOne()
@@ -288,6 +333,26 @@ class CumulativeTests(unittest.TestCase):
         self.assertEqual(cumulative.median(), 14)
 
 
+class Test_parse_seconds(unittest.TestCase):
+
+    def _callFUT(self, value):
+        from ..requestprofiler import parse_seconds
+        return parse_seconds(value)
+
+    def test_w_nanoseconds(self):
+        self.assertEqual(self._callFUT('1500000000'), 1.5)
+
+    def test_w_nanoseconds_keeps_microseconds(self):
+        seconds = self._callFUT('1400000000000001000')
+        self.assertAlmostEqual(seconds - 1400000000, 0.000001, places=6)
+
+    def test_w_seconds(self):
+        self.assertEqual(self._callFUT('123.45'), 123.45)
+
+    def test_w_bogus(self):
+        self.assertRaises(ValueError, self._callFUT, 'bogus')
+
+
 class Test_parselogline(unittest.TestCase):
 
     def _callFUT(self, line):
@@ -372,9 +437,93 @@ class Test_get_earliest_file_data(unittest.TestCase):
         self.assertEqual(buf1.tell(), 0)
         self.assertEqual(buf2.tell(), len(VALID2))
 
+    def test_w_nanosecond_times(self):
+        from io import StringIO
+        from ..._compat import TEXT
+        buf = StringIO(TEXT('B 1 2 123450000000 GET /'))
+        self.assertEqual(self._callFUT([buf])[3], 123.45)
+
+    def test_w_binary_and_text_files(self):
+        from io import StringIO
+        from ..._compat import TEXT
+        text = StringIO(TEXT('E 1 2 234.56 7\n'))
+        binary = _makeBinaryReader([('E', 3, 123.5, 8), ('E', 4, 345.5, 9)])
+        self.assertEqual(self._callFUT([text, binary]),
+                         ['E', '1', '3', 123.5, '8'])
+        self.assertEqual(text.tell(), 0)
+        self.assertEqual(self._callFUT([text, binary]),
+                         ['E', '1', '2', 234.56, '7'])
+        self.assertEqual(self._callFUT([text, binary]),
+                         ['E', '1', '4', 345.5, '9'])
+        self.assertEqual(self._callFUT([text, binary]), None)
+
+
+class Test_open_log(unittest.TestCase):
+
+    def _callFUT(self, filename):
+        from ..requestprofiler import open_log
+        return open_log(filename)
+
+    def setUp(self):
+        import tempfile
+        self.tmpdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        import shutil
+        shutil.rmtree(self.tmpdir)
+
+    def _write(self, name, data):
+        import os
+        fn = os.path.join(self.tmpdir, name)
+        with open(fn, 'wb') as f:
+            f.write(data)
+        return fn
+
+    def test_text(self):
+        fn = self._write('trace.log', b'U 1 0 1.5\n')
+        f = self._callFUT(fn)
+        try:
+            self.assertEqual(f.readline(), 'U 1 0 1.5\n')
+        finally:
+            f.close()
+
+    def test_binary(self):
+        from repoze.debug.tracelog import BinaryTraceReader
+        from repoze.debug.tracelog import MAGIC
+        fn = self._write('trace.log', MAGIC)
+        reader = self._callFUT(fn)
+        self.assertTrue(isinstance(reader, BinaryTraceReader))
+        self.assertEqual(reader.peek(), None)
+        reader.stream.close()
+
+    def test_gzipped_binary(self):
+        import gzip
+        from repoze.debug.tracelog import BinaryTraceReader
+        from repoze.debug.tracelog import MAGIC
+        import os
+        fn = os.path.join(self.tmpdir, 'trace.log.gz')
+        f = gzip.GzipFile(fn, 'wb')
+        f.write(MAGIC)
+        f.close()
+        reader = self._callFUT(fn)
+        self.assertTrue(isinstance(reader, BinaryTraceReader))
+        reader.stream.close()
+
 
 class Test_get_requests(unittest.TestCase):
 
+    def test_wo_readstats_w_binary_file(self):
+        reader = _makeBinaryReader([('B', 1, 1.0, 'GET', '/a'),
+                                    ('A', 1, 1.25, '200', 5),
+                                    ('E', 1, 1.5, 5)])
+        requests = self._callFUT([reader])
+        self.assertEqual(len(requests), 1)
+        request = requests[0]
+        self.assertEqual(request.method, 'GET')
+        self.assertEqual(request.url, '/a')
+        self.assertEqual(request.httpcode, '200')
+        self.assertEqual(request.elapsed, 0.5)
+
     def _callFUT(self, files, *args, **kw):
         from ..requestprofiler import get_requests
         return get_requests(files, *args, **kw)
@@ -395,3 +544,16 @@ class Test_get_requests(unittest.TestCase):
         VALID = TEXT('CODE PID ID 234.56 DESC')
         buf = StringIO(VALID)
         self.assertEqual(self._callFUT([buf], end=123.45), [])
+
+
+def _makeBinaryReader(records):
+    import io
+    from repoze.debug.clock import to_ns
+    from repoze.debug.tracelog import BinaryTraceLog
+    from repoze.debug.tracelog import BinaryTraceReader
+    log = BinaryTraceLog(io.BytesIO())
+    for record in records:
+        code, request_id, when = record[:3]
+        log.info(log.format_trace(code, 1, request_id, to_ns(when),
+                                  record[3:]))
+    return BinaryTraceReader(io.BytesIO(log.stream.getvalue()))
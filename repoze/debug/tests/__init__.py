@@ -1 +1,23 @@
 # tests package
+import sys
+
+try:
+    from setuptools.command.test import ScanningLoader
+except ImportError: # pragma: no cover
+    ScanningLoader = None
+
+# modules using async / await, a SyntaxError before Python 3.5
+PY35_MODULES = ('repoze.debug.asgi',
+                'repoze.debug.tests.test_asgi',
+               )
+
+if ScanningLoader is not None:
+
+    class TestLoader(ScanningLoader):
+        """ The ``setup.py test`` loader, which imports every module of the
+        package:  skip those older Pythons can't compile.
+        """
+        def loadTestsFromName(self, name, module=None):
+            if sys.version_info < (3, 5) and name in PY35_MODULES:
+                return self.suiteClass()
+            return ScanningLoader.loadTestsFromName(self, name, module)
@@ -0,0 +1,284 @@
+# Python 3.5+ only:  skipped by repoze.debug.tests.TestLoader before that
+import unittest
+
+
+class ASGIResponseLoggingMiddlewareTests(unittest.TestCase):
+
+    def _getTargetClass(self):
+        from repoze.debug.asgi import ASGIResponseLoggingMiddleware
+        return ASGIResponseLoggingMiddleware
+
+    def _makeOne(self, app, max_bodylen=0, keep=10, verbose_logger=None,
+                 trace_logger=None, **kw):
+        from repoze.debug.logwriter import AsyncLogWriter
+        kw.setdefault('log_writer', AsyncLogWriter())
+        mw = self._getTargetClass()(app, max_bodylen, keep, verbose_logger,
+                                    trace_logger, **kw)
+        self.addCleanup(mw.log_writer.close)
+        return mw
+
+    def _run(self, mw, scope=None, body=b''):
+        import asyncio
+        if scope is None:
+            scope = _makeScope()
+        sent = []
+        messages = [{'type': 'http.request', 'body': body}]
+        async def receive():
+            return messages.pop(0)
+        async def send(message):
+            sent.append(message)
+        loop = asyncio.new_event_loop()
+        try:
+            loop.run_until_complete(mw(scope, receive, send))
+        finally:
+            loop.close()
+        mw.log_writer.flush()
+        return sent
+
+    def _traced(self, logger):
+        return [line for message in logger.logged
+                for line in message.splitlines()]
+
+    def test_ctor_creates_log_writer(self):
+        from repoze.debug.logwriter import AsyncLogWriter
+        mw = self._getTargetClass()(_echo_app, 0, 10, None, None)
+        self.assertTrue(isinstance(mw.log_writer, AsyncLogWriter))
+
+    def test_ctor_rejects_blocking_log_writer(self):
+        from repoze.debug.logwriter import AsyncLogWriter
+        self.assertRaises(ValueError, self._getTargetClass(), _echo_app, 0,
+                          10, None, None, AsyncLogWriter(overflow='block'))
+
+    def test_call(self):
+        tlogger = FakeLogger()
+        vlogger = FakeLogger()
+        mw = self._makeOne(_echo_app, verbose_logger=vlogger,
+                           trace_logger=tlogger)
+        sent = self._run(mw, body=b'hello')
+        self.assertEqual(sent[0]['status'], 200)
+        self.assertEqual(b''.join([x.get('body', b'') for x in sent[1:]]),
+                         b'echo: hello')
+        traced = self._traced(tlogger)
+        self.assertEqual([line[0] for line in traced],
+                         ['U', 'B', 'A', 'F', 'E'])
+        self.assertTrue(traced[1].endswith(
+            'GET http://example.com/foo?a=1'))
+        self.assertTrue(traced[2].endswith('200 11'))
+        self.assertEqual(traced[4].split(' ')[4:6], ['11', '2'])
+        verbose = '\n'.join(vlogger.logged)
+        self.assertTrue('HTTP_USER_AGENT: test' in verbose)
+        self.assertTrue('Request Bodylen: 5' in verbose)
+        self.assertTrue('Status: 200 OK' in verbose)
+
+    def test_call_keeps_entry(self):
+        mw = self._makeOne(_echo_app, max_bodylen=4)
+        self._run(mw, body=b'hello')
+        entry = mw.entries[0]
+        self.assertEqual(entry['request']['method'], 'GET')
+        self.assertEqual(entry['request']['url'],
+                         'http://example.com/foo?a=1')
+        self.assertEqual(entry['request']['body'],
+                         b'hell ... (truncated at 4 bytes)')
+        self.assertEqual(entry['response']['status'], '200 OK')
+        self.assertEqual(entry['response']['body'],
+                         b'echo ... (truncated at 4 bytes)')
+        self.assertEqual(entry['response']['content-length'], 11)
+        self.assertEqual(entry['response']['chunks'], 2)
+        self.assertTrue('end' in entry['response'])
+
+    def test_call_app_raises(self):
+        tlogger = FakeLogger()
+        mw = self._makeOne(_raising_app, trace_logger=tlogger)
+        self.assertRaises(ValueError, self._run, mw)
+        mw.log_writer.flush()
+        self.assertEqual([line[0] for line in self._traced(tlogger)],
+                         ['U', 'B'])
+        response = mw.entries[0]['response']
+        self.assertEqual(response['status'], '500 Exception Raised')
+        self.assertTrue('ValueError: broken' in response['exception'])
+
+    def test_call_response_not_started(self):
+        async def app(scope, receive, send):
+            pass
+        mw = self._makeOne(app)
+        self._run(mw)
+        response = mw.entries[0]['response']
+        self.assertEqual(response['status'], '500 Response Not Started')
+
+    def _runCancelled(self, mw):
+        import asyncio
+        started = []
+        async def app(scope, receive, send):
+            await send({'type': 'http.response.start', 'status': 200,
+                        'headers': []})
+            started.append(True)
+            await asyncio.Event().wait()
+        mw.application = app
+        async def receive():
+            return {'type': 'http.request', 'body': b''}
+        async def send(message):
+            pass
+        async def main():
+            task = asyncio.ensure_future(mw(_makeScope(), receive, send))
+            while not started:
+                await asyncio.sleep(0)
+            task.cancel()
+            try:
+                await task
+            except asyncio.CancelledError:
+                return True
+        loop = asyncio.new_event_loop()
+        try:
+            cancelled = loop.run_until_complete(main())
+        finally:
+            loop.close()
+        mw.log_writer.flush()
+        self.assertTrue(cancelled)
+
+    def test_call_cancelled(self):
+        tlogger = FakeLogger()
+        mw = self._makeOne(None, trace_logger=tlogger)
+        self._runCancelled(mw)
+        response = mw.entries[0]['response']
+        self.assertEqual(response['status'], '200 OK')
+        self.assertTrue('CancelledError' in response['exception'])
+
+    def test_call_not_sampled_cancelled(self):
+        from repoze.debug.metrics import RequestCounters
+        tlogger = FakeLogger()
+        counters = RequestCounters()
+        mw = self._makeOne(None, trace_logger=tlogger, counters=counters,
+                           sampler=lambda environ: False)
+        self._runCancelled(mw)
+        # aborted:  no E record
+        self.assertEqual([line[0] for line in self._traced(tlogger)],
+                         ['U', 'B', 'A'])
+        self.assertEqual(counters.in_flight, 0)
+
+    def test_call_not_sampled(self):
+        from repoze.debug.metrics import LatencyStats
+        tlogger = FakeLogger()
+        vlogger = FakeLogger()
+        latency = LatencyStats()
+        mw = self._makeOne(_echo_app, verbose_logger=vlogger,
+                           trace_logger=tlogger, latency=latency,
+                           sampler=lambda environ: False)
+        self._run(mw, body=b'hello')
+        self.assertEqual([line[0] for line in self._traced(tlogger)],
+                         ['U', 'B', 'A', 'F', 'E'])
+        self.assertEqual(vlogger.logged, [])
+        self.assertEqual(len(mw.entries), 0)
+        self.assertEqual([x['route'] for x in latency.summaries()], ['/foo'])
+
+    def test_call_w_counters(self):
+        from repoze.debug.metrics import RequestCounters
+        counters = RequestCounters()
+        mw = self._makeOne(_echo_app, counters=counters)
+        self._run(mw, body=b'hello')
+        self.assertEqual(counters.in_flight, 0)
+        self.assertEqual(counters.statuses, {'2xx': 1})
+        self.assertEqual(counters.bytes_in, 5)
+        self.assertEqual(counters.bytes_out, 11)
+
+    def test_call_w_tail(self):
+        from repoze.debug.sampling import TailPolicy
+        mw = self._makeOne(_echo_app, tail=TailPolicy(None, 500))
+        self._run(mw)
+        self.assertEqual(len(mw.entries), 0)
+        mw = self._makeOne(_raising_app, tail=TailPolicy(None, 500))
+        self.assertRaises(ValueError, self._run, mw)
+        self.assertEqual(len(mw.entries), 1)
+
+    def test_call_not_http(self):
+        scopes = []
+        async def app(scope, receive, send):
+            scopes.append(scope)
+        mw = self._makeOne(app)
+        scope = {'type': 'lifespan'}
+        self._run(mw, scope)
+        self.assertEqual(scopes, [scope])
+        self.assertEqual(len(mw.entries), 0)
+
+    def test_call_gui(self):
+        from repoze.debug.metrics import LatencyStats
+        latency = LatencyStats()
+        latency.record('GET', '/foo/1', 0.5)
+        mw = self._makeOne(_echo_app, latency=latency)
+        scope = _makeScope(path='/__repoze.debug/latency')
+        sent = self._run(mw, scope)
+        self.assertEqual(sent[0]['status'], 200)
+        self.assertTrue((b'content-type', b'text/plain; charset=UTF-8')
+                        in sent[0]['headers'])
+        self.assertTrue(b'/foo/{id}' in sent[1]['body'])
+        self.assertEqual(len(mw.entries), 0)
+
+
+class Test_scope_environ(unittest.TestCase):
+
+    def _callFUT(self, scope):
+        from repoze.debug.asgi import scope_environ
+        return scope_environ(scope)
+
+    def test_it(self):
+        from repoze.debug.responselogger import construct_url
+        environ = self._callFUT(_makeScope(root_path='/app'))
+        self.assertEqual(environ['REQUEST_METHOD'], 'GET')
+        self.assertEqual(environ['SCRIPT_NAME'], '/app')
+        self.assertEqual(environ['PATH_INFO'], '/foo')
+        self.assertEqual(environ['QUERY_STRING'], 'a=1')
+        self.assertEqual(environ['SERVER_PORT'], '80')
+        self.assertEqual(environ['REMOTE_ADDR'], '10.0.0.1')
+        self.assertEqual(environ['CONTENT_TYPE'], 'text/plain')
+        self.assertEqual(environ['HTTP_X_MULTI'], 'a,b')
+        self.assertEqual(construct_url(environ),
+                         'http://example.com/app/foo?a=1')
+
+    def test_minimal(self):
+        environ = self._callFUT({'type': 'http', 'method': 'GET',
+                                 'path': '/'})
+        self.assertEqual(environ['SERVER_NAME'], 'localhost')
+        self.assertEqual(environ['wsgi.url_scheme'], 'http')
+        self.assertFalse('REMOTE_ADDR' in environ)
+
+
+async def _echo_app(scope, receive, send):
+    message = await receive()
+    body = b'echo: ' + message['body']
+    await send({'type': 'http.response.start', 'status': 200,
+                'headers': [(b'content-length', str(len(body)).encode())]})
+    await send({'type': 'http.response.body', 'body': body[:6],
+                'more_body': True})
+    await send({'type': 'http.response.body', 'body': body[6:]})
+
+async def _raising_app(scope, receive, send):
+    raise ValueError('broken')
+
+def _makeScope(**kw):
+    scope = {'type': 'http',
+             'asgi': {'version': '3.0'},
+             'http_version': '1.1',
+             'method': 'GET',
+             'scheme': 'http',
+             'path': '/foo',
+             'root_path': '',
+             'query_string': b'a=1',
+             'headers': [(b'host', b'example.com'),
+                         (b'user-agent', b'test'),
+                         (b'content-type', b'text/plain'),
+                         (b'x-multi', b'a'),
+                         (b'x-multi', b'b'),
+                        ],
+             'client': ('10.0.0.1', 12345),
+             'server': ('example.com', 80),
+            }
+    scope.update(kw)
+    return scope
+
+
+class FakeLogger(object):
+
+    def __init__(self):
+        self.logged = []
+
+    def info(self, msg):
+        self.logged.append(msg)
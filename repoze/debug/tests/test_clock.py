@@ -0,0 +1,54 @@
+import unittest
+
+
+class Test_now_ns(unittest.TestCase):
+
+    def _callFUT(self):
+        from repoze.debug.clock import now_ns
+        return now_ns()
+
+    def test_close_to_wall_clock(self):
+        import time
+        self.assertTrue(abs(self._callFUT() / 1e9 - time.time()) < 5)
+
+    def test_monotonic(self):
+        first = self._callFUT()
+        second = self._callFUT()
+        self.assertTrue(isinstance(first, int))
+        self.assertTrue(second >= first)
+
+    def test_ignores_wall_clock_steps(self):
+        from repoze.debug import clock
+        saved = clock.time_ns
+        clock.time_ns = lambda: 0
+        try:
+            self.assertTrue(self._callFUT() > 10**18)
+        finally:
+            clock.time_ns = saved
+
+
+class Test_now(unittest.TestCase):
+
+    def _callFUT(self):
+        from repoze.debug.clock import now
+        return now()
+
+    def test_seconds(self):
+        import time
+        self.assertTrue(abs(self._callFUT() - time.time()) < 5)
+
+
+class Test_to_ns(unittest.TestCase):
+
+    def _callFUT(self, seconds):
+        from repoze.debug.clock import to_ns
+        return to_ns(seconds)
+
+    def test_float(self):
+        self.assertEqual(self._callFUT(1.5), 1500000000)
+
+    def test_rounds(self):
+        self.assertEqual(self._callFUT(0.0000000016), 2)
+
+    def test_int(self):
+        self.assertEqual(self._callFUT(2), 2000000000)
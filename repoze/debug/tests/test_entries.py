@@ -0,0 +1,473 @@
+import unittest
+
+
+class Test_estimate_size(unittest.TestCase):
+
+    def _callFUT(self, entry):
+        from repoze.debug.entries import estimate_size
+        return estimate_size(entry)
+
+    def test_empty(self):
+        self.assertEqual(self._callFUT({}), 64)
+
+    def test_grows_with_bodies(self):
+        small = _makeEntry(1, b'')
+        large = _makeEntry(2, b'x' * 1000)
+        self.assertEqual(self._callFUT(large) - self._callFUT(small), 1000)
+
+    def test_counts_variables_and_headers(self):
+        entry = _makeEntry(1, b'')
+        before = self._callFUT(entry)
+        entry['request']['cgi_variables'].append(('HTTP_HOST', 'example.com'))
+        entry['response']['headers'].append(('X-Foo', 'bar'))
+        self.assertEqual(self._callFUT(entry) - before,
+                         64 + 9 + 11 + 64 + 5 + 3)
+
+    def test_lazy_request_info_not_computed(self):
+        class LazyInfo(dict):
+            environ = {'HTTP_HOST': 'example.com'}
+            def __missing__(self, key):
+                raise AssertionError('computed %s' % key)
+        entry = {'request': LazyInfo(body=b'abc')}
+        self.assertEqual(self._callFUT(entry), 64 + 64 + 64 + 9 + 11 + 3)
+
+
+class Test_plain_value(unittest.TestCase):
+
+    def _callFUT(self, value):
+        from repoze.debug.entries import plain_value
+        return plain_value(value)
+
+    def test_plain(self):
+        for value in (None, True, 1, 1.5, (1, 0), 'abc'):
+            self.assertEqual(self._callFUT(value), value)
+
+    def test_object(self):
+        value = object()
+        self.assertEqual(self._callFUT(value), repr(value))
+        self.assertEqual(self._callFUT((1, value)), repr((1, value)))
+
+    def test_capped(self):
+        from repoze.debug.entries import MAX_VALUE_LENGTH
+        self.assertEqual(len(self._callFUT('x' * 2000)),
+                         MAX_VALUE_LENGTH + 3)
+
+
+class RecordTests(unittest.TestCase):
+
+    def _makeOne(self, info, strings=None):
+        from repoze.debug.entries import ResponseRecord
+        from repoze.debug.entries import StringTable
+        if strings is None:
+            strings = StringTable()
+        return ResponseRecord(info, strings)
+
+    def test_mapping(self):
+        record = self._makeOne({'status': '200 OK', 'content-length': 3,
+                                'headers': [('X-Foo', 'bar')],
+                                'body': b'abc', 'end': 2.0})
+        self.assertEqual(record['status'], '200 OK')
+        self.assertEqual(record['content-length'], 3)
+        self.assertEqual(record['headers'], (('X-Foo', 'bar'),))
+        self.assertEqual(record.get('exception'), None)
+        self.assertEqual(record.get('exception', 'x'), 'x')
+        self.assertRaises(KeyError, record.__getitem__, 'exception')
+        self.assertRaises(KeyError, record.__getitem__, 'nonesuch')
+        self.assertTrue('end' in record)
+        self.assertFalse('exception' in record)
+        self.assertFalse('nonesuch' in record)
+        self.assertEqual(sorted(record.keys()),
+                         ['body', 'content-length', 'end', 'headers',
+                          'status'])
+
+    def test_repr(self):
+        record = self._makeOne({'status': '200 OK'})
+        self.assertEqual(repr(record), "{'status': '200 OK'}")
+
+    def test_no_instance_dict(self):
+        record = self._makeOne({'status': '200 OK'})
+        self.assertFalse(hasattr(record, '__dict__'))
+        self.assertRaises(AttributeError, setattr, record, 'foo', 1)
+
+    def test_values_made_text_and_capped(self):
+        from repoze.debug.entries import MAX_VALUE_LENGTH
+        from repoze.debug.entries import RequestRecord
+        from repoze.debug.entries import StringTable
+        app = object()
+        record = RequestRecord(
+            {'wsgi_variables': [('application', app),
+                                ('long', 'x' * 5000)]}, StringTable())
+        variables = dict(record['wsgi_variables'])
+        self.assertEqual(variables['application'], repr(app))
+        self.assertEqual(len(variables['long']), MAX_VALUE_LENGTH + 3)
+
+    def test_size(self):
+        info = {'status': '200 OK', 'body': b'x' * 1000,
+                'headers': [('X-Foo', 'bar')]}
+        record = self._makeOne(info)
+        self.assertEqual(record.size, 64 + 6 + 1000 + 64 + 5 + 8)
+        self.assertEqual(record.size, self._makeOne(info).size)
+
+
+class StringTableTests(unittest.TestCase):
+
+    def _makeOne(self, *arg, **kw):
+        from repoze.debug.entries import StringTable
+        return StringTable(*arg, **kw)
+
+    def test_share(self):
+        table = self._makeOne()
+        first = ''.join(['exa', 'mple.com'])
+        second = ''.join(['example', '.com'])
+        self.assertFalse(first is second)
+        self.assertEqual(table.share(first), (first, True))
+        shared, flag = table.share(second)
+        self.assertTrue(shared is first)
+
+    def test_long_values_not_shared(self):
+        table = self._makeOne(max_length=3)
+        self.assertEqual(table.share('abcd'), ('abcd', False))
+        self.assertEqual(table.strings, {})
+
+    def test_bounded(self):
+        table = self._makeOne(max_strings=2)
+        for value in ('a', 'b', 'c'):
+            table.share(value)
+        self.assertEqual(table.strings, {'c': 'c'})
+
+
+class EntryStoreTests(unittest.TestCase):
+
+    def _getTargetClass(self):
+        from repoze.debug.entries import EntryStore
+        return EntryStore
+
+    def _makeOne(self, *arg, **kw):
+        return self._getTargetClass()(*arg, **kw)
+
+    def test_empty(self):
+        store = self._makeOne(10)
+        self.assertEqual(len(store), 0)
+        self.assertEqual(list(store), [])
+        self.assertEqual(store.memory, 0)
+
+    def test_append_evicts_oldest_over_keep(self):
+        store = self._makeOne(2)
+        entries = [_makeEntry(i) for i in range(3)]
+        for entry in entries:
+            store.append(entry)
+        self.assertEqual(list(store), entries[1:])
+        self.assertEqual(store[0] is entries[1], True)
+        self.assertEqual(store[-1] is entries[2], True)
+
+    def test_append_wo_max_memory_skips_accounting(self):
+        store = self._makeOne(2)
+        store.append(_makeEntry(1, b'x' * 1000))
+        self.assertEqual(store.memory, 0)
+
+    def test_append_evicts_over_max_memory(self):
+        store = self._makeOne(10, max_memory=2500)
+        entries = [_makeEntry(i, b'x' * 1000) for i in range(3)]
+        for entry in entries:
+            store.append(entry)
+        self.assertEqual(list(store), entries[1:])
+        self.assertTrue(store.memory <= 2500)
+
+    def test_append_keeps_newest_even_if_over_budget(self):
+        store = self._makeOne(10, max_memory=10)
+        entry = _makeEntry(1, b'x' * 1000)
+        store.append(entry)
+        self.assertEqual(list(store), [entry])
+
+    def test_update_reaccounts_grown_entry(self):
+        store = self._makeOne(10, max_memory=2500)
+        first = _makeEntry(1)
+        second = _makeEntry(2, finished=False)
+        store.append(first)
+        store.append(second)
+        second['response']['body'] = b'x' * 3000
+        second['response']['end'] = 2.0
+        store.update(second)
+        self.assertEqual(list(store), [second])
+
+    def test_update_evicted_entry_is_noop(self):
+        store = self._makeOne(1, max_memory=2500)
+        first = _makeEntry(1, finished=False)
+        store.append(first)
+        store.append(_makeEntry(2))
+        memory = store.memory
+        first['response']['body'] = b'x' * 3000
+        first['response']['end'] = 2.0
+        store.update(first)
+        self.assertEqual(store.memory, memory)
+
+    def test_finished_entries_compacted_when_read(self):
+        from repoze.debug.entries import RequestRecord
+        from repoze.debug.entries import ResponseRecord
+        store = self._makeOne(10)
+        running = _makeEntry(1, finished=False)
+        store.append(running)
+        running['response']['end'] = 2.0
+        store.update(running)
+        finished = _makeEntry(2)
+        store.append(finished)
+        unfinished = _makeEntry(3, finished=False)
+        store.append(unfinished)
+        for entry in (running, finished):
+            # not on the request's thread
+            self.assertFalse(isinstance(entry['request'], RequestRecord))
+        self.assertEqual(list(store), [running, finished, unfinished])
+        for entry in (running, finished):
+            self.assertTrue(isinstance(entry['request'], RequestRecord))
+            self.assertTrue(isinstance(entry['response'], ResponseRecord))
+        self.assertFalse(isinstance(unfinished['request'], RequestRecord))
+
+    def test_getitem_compacts_entry(self):
+        from repoze.debug.entries import RequestRecord
+        store = self._makeOne(10)
+        store.append(_makeEntry(1))
+        store.append(_makeEntry(2))
+        entry = store[-1]
+        self.assertTrue(isinstance(entry['request'], RequestRecord))
+        self.assertFalse(isinstance(store._entries[0]['request'],
+                                    RequestRecord))
+
+    def test_compaction_reaccounts_memory(self):
+        store = self._makeOne(10, max_memory=100000)
+        entry = _makeEntry(1)
+        entry['request']['cgi_variables'].extend(
+            [('HTTP_X_%d' % i, 'x' * 20) for i in range(10)])
+        store.append(entry)
+        before = store.memory
+        list(store)
+        self.assertTrue(store.memory < before)
+        self.assertEqual(store.memory, store._sizes[id(entry)])
+
+    def test_repeated_values_shared(self):
+        store = self._makeOne(10)
+        entries = []
+        for i in range(2):
+            entry = _makeEntry(i)
+            entry['request']['cgi_variables'].append(
+                ('HTTP_USER_AGENT', ''.join(['Mozilla', '/5.0'])))
+            store.append(entry)
+            entries.append(entry)
+        list(store)
+        first, second = [x['request']['cgi_variables'][0] for x in entries]
+        self.assertTrue(first[0] is second[0])
+        self.assertTrue(first[1] is second[1])
+
+    def test_iteration_uses_snapshot(self):
+        store = self._makeOne(10)
+        store.append(_makeEntry(1))
+        seen = []
+        for entry in store:
+            store.append(_makeEntry(2))
+            seen.append(entry['id'])
+        self.assertEqual(seen, [1])
+        self.assertEqual(len(store), 2)
+
+
+class Test_serialize_entry(unittest.TestCase):
+
+    def _callFUT(self, entry, pid):
+        from repoze.debug.entries import serialize_entry
+        return serialize_entry(entry, pid)
+
+    def test_tags_pid_and_decodes(self):
+        import json
+        entry = _makeEntry(1, b'caf\xc3\xa9')
+        entry['request']['wsgi_variables'].append(('application', object()))
+        record = self._callFUT(entry, 42)
+        json.dumps(record)
+        self.assertEqual(record['pid'], 42)
+        self.assertEqual(record['id'], 1)
+        self.assertEqual(record['response']['body'], b'caf\xc3\xa9'.decode(
+            'utf-8'))
+        self.assertEqual(record['response']['headers'], [])
+        name, value = record['request']['wsgi_variables'][0]
+        self.assertEqual(name, 'application')
+        self.assertTrue(value.startswith('<object'))
+
+    def test_computes_lazy_request_keys(self):
+        class LazyInfo(dict):
+            def __missing__(self, key):
+                return key.upper()
+        entry = {'id': 1, 'request': LazyInfo(method='GET')}
+        record = self._callFUT(entry, 42)
+        self.assertEqual(record['request'],
+                         {'method': 'GET', 'url': 'URL',
+                          'cgi_variables': 'CGI_VARIABLES',
+                          'wsgi_variables': 'WSGI_VARIABLES'})
+        self.assertFalse('response' in record)
+
+
+class SharedEntryStoreTests(unittest.TestCase):
+
+    def _getTargetClass(self):
+        from repoze.debug.entries import SharedEntryStore
+        return SharedEntryStore
+
+    def _makeOne(self, keep, slot_size=4096):
+        store = self._getTargetClass()(self.path, keep, slot_size)
+        self.stores.append(store)
+        return store
+
+    def setUp(self):
+        import os
+        import tempfile
+        self.tmpdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmpdir, 'entries')
+        self.stores = []
+
+    def tearDown(self):
+        import shutil
+        for store in self.stores:
+            store.close()
+        shutil.rmtree(self.tmpdir)
+
+    def test_empty(self):
+        store = self._makeOne(3)
+        self.assertEqual(len(store), 0)
+        self.assertEqual(list(store), [])
+        self.assertEqual(store.memory, 0)
+
+    def test_append_finished_entry(self):
+        import os
+        store = self._makeOne(3)
+        store.append(_makeEntry(1, b'body'))
+        self.assertEqual(len(store), 1)
+        entry = store[0]
+        self.assertEqual(entry['id'], 1)
+        self.assertEqual(entry['pid'], os.getpid())
+        self.assertEqual(entry['response']['body'], 'body')
+        self.assertEqual(entry['request']['url'], 'http://localhost/')
+
+    def test_append_unfinished_entry_waits_for_update(self):
+        store = self._makeOne(3)
+        entry = {'id': 1, 'request': {'url': '/'}}
+        store.append(entry)
+        self.assertEqual(len(store), 0)
+        entry['response'] = {'status': '200 OK', 'end': 2.0}
+        store.update(entry)
+        self.assertEqual([x['response']['status'] for x in store], ['200 OK'])
+        store.update(entry)
+        self.assertEqual(len(store), 1)
+
+    def test_update_unknown_entry_is_noop(self):
+        store = self._makeOne(3)
+        store.update(_makeEntry(1))
+        self.assertEqual(len(store), 0)
+
+    def test_ring_keeps_newest(self):
+        store = self._makeOne(2)
+        for i in range(5):
+            store.append(_makeEntry(i))
+        self.assertEqual(len(store), 2)
+        self.assertEqual([x['id'] for x in store], [3, 4])
+        self.assertEqual(store[-1]['id'], 4)
+
+    def test_shared_between_stores(self):
+        writer = self._makeOne(3)
+        reader = self._makeOne(3)
+        writer.append(_makeEntry(1))
+        reader.append(_makeEntry(2))
+        self.assertEqual([x['id'] for x in writer], [1, 2])
+        self.assertEqual([x['id'] for x in reader], [1, 2])
+
+    def test_shared_with_child_process(self):
+        import os
+        if not hasattr(os, 'fork'): # pragma: no cover
+            return
+        store = self._makeOne(3)
+        store.append(_makeEntry(1))
+        pid = os.fork()
+        if pid == 0: # pragma: no cover
+            try:
+                store.append(_makeEntry(2))
+            finally:
+                os._exit(0)
+        os.waitpid(pid, 0)
+        entries = list(store)
+        self.assertEqual([x['id'] for x in entries], [1, 2])
+        self.assertEqual(entries[1]['pid'], pid)
+
+    def test_reset_on_geometry_change(self):
+        store = self._makeOne(3)
+        store.append(_makeEntry(1))
+        other = self._makeOne(4)
+        self.assertEqual(len(other), 0)
+        self.assertEqual(len(self._makeOne(4)), 0)
+
+    def test_geometry_change_keeps_mapped_file(self):
+        import os
+        store = self._makeOne(100)
+        store.append(_makeEntry(1))
+        # e.g. a new worker, after a reload with a smaller "keep":  the file
+        # is replaced, not shrunk under the older process' mapping
+        other = self._makeOne(10)
+        self.assertEqual(os.path.getsize(self.path),
+                         store.HEADER.size + 10 * 4096)
+        self.assertEqual([x['id'] for x in store], [1])
+        store.append(_makeEntry(2))
+        self.assertEqual(len(store), 2)
+        other.append(_makeEntry(3))
+        self.assertEqual([x['id'] for x in other], [3])
+        self.assertEqual([x['id'] for x in self._makeOne(10)], [3])
+        self.assertEqual(os.listdir(self.tmpdir), ['entries'])
+
+    def test_file_shrunk_under_store(self):
+        import os
+        store = self._makeOne(3)
+        store.append(_makeEntry(1))
+        os.ftruncate(store.fd, store.HEADER.size)
+        self.assertRaises(ValueError, store.snapshot)
+        self.assertRaises(ValueError, len, store)
+        store.append(_makeEntry(2)) # dropped
+
+    def test_oversized_entry_loses_bodies(self):
+        store = self._makeOne(3, 1024)
+        store.append(_makeEntry(1, b'x' * 2000))
+        entry = store[0]
+        self.assertEqual(entry['response']['body'],
+                         '(not shared: entry too large)')
+        self.assertEqual(entry['response']['status'], '200 OK')
+
+    def test_oversized_entry_loses_variables(self):
+        store = self._makeOne(3, 1024)
+        entry = _makeEntry(1)
+        entry['request']['cgi_variables'].append(('HTTP_X', 'x' * 2000))
+        store.append(entry)
+        entry = store[0]
+        self.assertEqual(entry['request']['cgi_variables'], [])
+        self.assertEqual(entry['request']['url'], 'http://localhost/')
+
+    def test_oversized_entry_keeps_summary(self):
+        store = self._makeOne(3, 1024)
+        entry = _makeEntry(1)
+        entry['request']['url'] = '/' + 'x' * 2000
+        store.append(entry)
+        entry = store[0]
+        self.assertEqual(len(entry['request']['url']), 256)
+        self.assertFalse('response' in entry)
+
+    def test_slot_size_too_small(self):
+        self.assertRaises(ValueError, self._getTargetClass(), self.path, 3,
+                          512)
+
+
+def _makeEntry(id, body=b'', finished=True):
+    entry = {'id': id,
+             'request': {'url': 'http://localhost/',
+                         'body': b'',
+                         'cgi_variables': [],
+                         'wsgi_variables': [],
+                        },
+             'response': {'status': '200 OK',
+                          'headers': [],
+                          'body': body,
+                         },
+            }
+    if finished:
+        entry['response']['end'] = 2.0
+    return entry
@@ -0,0 +1,190 @@
+import unittest
+
+
+class InflightRegistryTests(unittest.TestCase):
+
+    def _getTargetClass(self):
+        from repoze.debug.inflight import InflightRegistry
+        return InflightRegistry
+
+    def _makeOne(self):
+        return self._getTargetClass()()
+
+    def test_begin_end(self):
+        from repoze.debug._compat import thread
+        registry = self._makeOne()
+        info = {'url': 'http://localhost/'}
+        request = registry.begin(1, 'GET', info, 10.0)
+        self.assertEqual(request.request_id, 1)
+        self.assertEqual(request.thread_id, thread.get_ident())
+        self.assertEqual(request.method, 'GET')
+        self.assertEqual(request.url, 'http://localhost/')
+        self.assertEqual(request.begin, 10.0)
+        self.assertEqual(request.reported, None)
+        self.assertTrue(registry.get(1) is request)
+        self.assertEqual(len(registry), 1)
+        registry.end(1)
+        self.assertEqual(registry.get(1), None)
+        self.assertEqual(len(registry), 0)
+
+    def test_end_unknown(self):
+        registry = self._makeOne()
+        registry.end(1)
+        self.assertEqual(len(registry), 0)
+
+    def test_snapshot_longest_running_first(self):
+        registry = self._makeOne()
+        registry.begin(1, 'GET', {}, 20.0)
+        registry.begin(2, 'GET', {}, 10.0)
+        registry.begin(3, 'GET', {}, 30.0)
+        self.assertEqual([x.request_id for x in registry.snapshot()],
+                         [2, 1, 3])
+
+    def test_by_thread(self):
+        from repoze.debug.inflight import InflightRequest
+        registry = self._makeOne()
+        for request_id, thread_id, begin in ((1, 100, 20.0), (2, 100, 10.0),
+                                             (3, 200, 30.0)):
+            registry.requests[request_id] = InflightRequest(
+                request_id, thread_id, 'GET', {}, begin)
+        by_thread = registry.by_thread()
+        self.assertEqual(sorted(by_thread), [100, 200])
+        self.assertEqual(by_thread[100].request_id, 2) # the earliest
+        self.assertEqual(by_thread[200].request_id, 3)
+
+    def test_clear(self):
+        registry = self._makeOne()
+        registry.begin(1, 'GET', {}, 20.0)
+        registry.clear()
+        self.assertEqual(registry.snapshot(), [])
+
+
+class EnvironInfoTests(unittest.TestCase):
+
+    def _makeOne(self, environ):
+        from repoze.debug.inflight import EnvironInfo
+        return EnvironInfo(environ)
+
+    def test_url_computed_lazily(self):
+        environ = {'wsgi.url_scheme': 'http', 'HTTP_HOST': 'localhost:8080',
+                   'SCRIPT_NAME': '', 'PATH_INFO': '/slow',
+                   'QUERY_STRING': 'a=1'}
+        info = self._makeOne(environ)
+        self.assertEqual(len(info), 0)
+        self.assertEqual(info.get('url'), 'http://localhost:8080/slow?a=1')
+        self.assertEqual(info['url'], 'http://localhost:8080/slow?a=1')
+        self.assertEqual(info.get('nonesuch'), None)
+        self.assertRaises(KeyError, info.__getitem__, 'nonesuch')
+
+
+class InflightMiddlewareTests(unittest.TestCase):
+
+    def _getTargetClass(self):
+        from repoze.debug.inflight import InflightMiddleware
+        return InflightMiddleware
+
+    def _makeOne(self, app, registry=None):
+        from repoze.debug.inflight import InflightRegistry
+        if registry is None:
+            registry = InflightRegistry()
+        return self._getTargetClass()(app, registry)
+
+    def _makeEnviron(self):
+        return {'REQUEST_METHOD': 'POST', 'wsgi.url_scheme': 'http',
+                'SERVER_NAME': 'localhost', 'SERVER_PORT': '80',
+                'PATH_INFO': '/slow'}
+
+    def test_ctor_default_registry(self):
+        from repoze.debug.inflight import default_registry
+        mw = self._getTargetClass()(None)
+        self.assertTrue(mw.registry is default_registry)
+
+    def test_registered_until_closed(self):
+        from repoze.debug._compat import thread
+        seen = []
+        def app(environ, start_response):
+            request, = mw.registry.snapshot()
+            seen.append(request)
+            return [b'body']
+        mw = self._makeOne(app)
+        environ = self._makeEnviron()
+        app_iter = mw(environ, None)
+        request = seen[0]
+        self.assertEqual(request.request_id, id(environ))
+        self.assertEqual(request.thread_id, thread.get_ident())
+        self.assertEqual(request.method, 'POST')
+        self.assertEqual(request.url, 'http://localhost/slow')
+        self.assertEqual(list(app_iter), [b'body'])
+        self.assertEqual(len(mw.registry), 1)
+        app_iter.close()
+        self.assertEqual(len(mw.registry), 0)
+
+    def test_app_iter_kept_when_possible(self):
+        closed = []
+        class AppIter(object):
+            def __iter__(self):
+                return iter([b'body'])
+            def close(self):
+                closed.append(True)
+        app_iter = AppIter()
+        mw = self._makeOne(lambda environ, start_response: app_iter)
+        result = mw(self._makeEnviron(), None)
+        self.assertTrue(result is app_iter)
+        self.assertEqual(len(mw.registry), 1)
+        result.close()
+        self.assertEqual(closed, [True])
+        self.assertEqual(len(mw.registry), 0)
+
+    def test_app_raises(self):
+        def app(environ, start_response):
+            raise ValueError
+        mw = self._makeOne(app)
+        self.assertRaises(ValueError, mw, self._makeEnviron(), None)
+        self.assertEqual(len(mw.registry), 0)
+
+    def test_already_registered(self):
+        from repoze.debug.inflight import InflightRegistry
+        registry = InflightRegistry()
+        environ = self._makeEnviron()
+        registry.begin(id(environ), 'GET', {}, 10.0)
+        app_iter = [b'body']
+        mw = self._makeOne(lambda environ, start_response: app_iter, registry)
+        self.assertTrue(mw(environ, None) is app_iter)
+        self.assertEqual(registry.get(id(environ)).begin, 10.0)
+
+
+class ClosingIteratorTests(unittest.TestCase):
+
+    def _makeOne(self, app_iter, callback, *args):
+        from repoze.debug.inflight import ClosingIterator
+        return ClosingIterator(app_iter, callback, *args)
+
+    def test_it(self):
+        called = []
+        closing = self._makeOne([b'a', b'b'], called.append, 1)
+        self.assertEqual(list(closing), [b'a', b'b'])
+        closing.close()
+        self.assertEqual(called, [1])
+
+    def test_close_raises(self):
+        called = []
+        class AppIter(list):
+            def close(self):
+                raise ValueError
+        closing = self._makeOne(AppIter(), called.append, 1)
+        self.assertRaises(ValueError, closing.close)
+        self.assertEqual(called, [1])
+
+
+class Test_make_middleware(unittest.TestCase):
+
+    def _callFUT(self, app, global_conf):
+        from repoze.debug.inflight import make_middleware
+        return make_middleware(app, global_conf)
+
+    def test_it(self):
+        from repoze.debug.inflight import default_registry
+        app = object()
+        mw = self._callFUT(app, {})
+        self.assertTrue(mw.app is app)
+        self.assertTrue(mw.registry is default_registry)
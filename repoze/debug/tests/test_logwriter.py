@@ -0,0 +1,426 @@
+import unittest
+
+
+class Test_format_record(unittest.TestCase):
+
+    def _callFUT(self, fmt, args):
+        from repoze.debug.logwriter import format_record
+        return format_record(fmt, args)
+
+    def test_w_format_string(self):
+        self.assertEqual(self._callFUT('%s %s', ('a', 1)), 'a 1')
+
+    def test_w_callable(self):
+        def fmt(a, b):
+            return '%s-%s' % (a, b)
+        self.assertEqual(self._callFUT(fmt, ('a', 1)), 'a-1')
+
+
+class AsyncLogWriterTests(unittest.TestCase):
+
+    def _getTargetClass(self):
+        from repoze.debug.logwriter import AsyncLogWriter
+        return AsyncLogWriter
+
+    def _makeOne(self, *arg, **kw):
+        writer = self._getTargetClass()(*arg, **kw)
+        self.addCleanup(writer.close)
+        return writer
+
+    def test_ctor_bad_overflow(self):
+        self.assertRaises(ValueError, self._getTargetClass(), 10, 'nonesuch')
+
+    def test_put_and_flush(self):
+        logger = FakeLogger()
+        writer = self._makeOne(10)
+        writer.put(logger, 'B %s', (1,))
+        writer.put(logger, 'E %s', (2,))
+        writer.flush()
+        self.assertEqual('\n'.join(logger.logged), 'B 1\nE 2')
+        self.assertEqual(writer.dropped, 0)
+
+    def test_close_writes_pending(self):
+        logger = FakeLogger()
+        writer = self._makeOne(10)
+        for i in range(5):
+            writer.put(logger, '%s', (i,))
+        writer.close()
+        self.assertEqual(writer.thread, None)
+        self.assertEqual('\n'.join(logger.logged), '0\n1\n2\n3\n4')
+
+    def test_close_not_started(self):
+        writer = self._makeOne(10)
+        writer.close()
+        self.assertEqual(writer.thread, None)
+
+    def test_overflow_drop(self):
+        logger = BlockingLogger()
+        writer = self._makeOne(1, 'drop')
+        writer.put(logger, '%s', (1,))
+        logger.entered.wait(5)
+        writer.put(logger, '%s', (2,))  # fills the queue
+        writer.put(logger, '%s', (3,))  # dropped
+        self.assertEqual(writer.dropped, 1)
+        logger.release.set()
+        writer.flush()
+        self.assertEqual(logger.logged, ['1', '2'])
+
+    def test_write_groups_by_logger(self):
+        logger1 = FakeLogger()
+        logger2 = FakeLogger()
+        writer = self._makeOne(10)
+        writer.write([(logger1, '%s', (1,)),
+                      (logger1, '%s', (2,)),
+                      (logger2, '%s', (3,)),
+                      (logger1, '%s', (4,)),
+                     ])
+        self.assertEqual(logger1.logged, ['1', '2', '4'])
+        self.assertEqual(logger2.logged, ['3'])
+
+    def test_write_joins_for_append_log_handler(self):
+        import logging
+        import os
+        import shutil
+        import tempfile
+        from repoze.debug.logwriter import AppendLogHandler
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        filename = os.path.join(tmpdir, 'trace.log')
+        handler = AppendLogHandler(filename)
+        self.addCleanup(handler.close)
+        logger = logging.Logger('test')
+        logger.handlers = [handler]
+        calls = []
+        info = logger.info
+        def record(msg):
+            calls.append(msg)
+            info(msg)
+        logger.info = record
+        writer = self._makeOne(10)
+        writer.write([(logger, '%s', (1,)), (logger, '%s', (2,))])
+        self.assertEqual(calls, ['1\n2'])
+        with open(filename) as f:
+            self.assertEqual(f.read(), '1\n2\n')
+
+    def test_write_one_record_per_message_for_other_loggers(self):
+        import logging
+        records = []
+        class Handler(logging.Handler):
+            def emit(self, record):
+                records.append(self.format(record))
+        handler = Handler()
+        handler.setFormatter(logging.Formatter('> %(message)s'))
+        logger = logging.Logger('test')
+        logger.handlers = [handler]
+        writer = self._makeOne(10)
+        writer.write([(logger, '%s', (1,)), (logger, '%s', (2,))])
+        self.assertEqual(records, ['> 1', '> 2'])
+
+    def test_write_non_text_messages_not_joined(self):
+        logger = FakeLogger()
+        writer = self._makeOne(10)
+        writer.write([(logger, lambda x: (x,), (1,)),
+                      (logger, lambda x: (x,), (2,)),
+                     ])
+        self.assertEqual(logger.logged, [(1,), (2,)])
+
+    def test_write_survives_bad_record(self):
+        import sys
+        logger = FakeLogger()
+        writer = self._makeOne(10)
+        stderr, sys.stderr = sys.stderr, FakeStream()
+        try:
+            writer.write([(logger, '%s %s', (1,)),
+                          (logger, '%s', (2,)),
+                         ])
+        finally:
+            sys.stderr = stderr
+        self.assertEqual(logger.logged, ['2'])
+
+
+class Test_joinable(unittest.TestCase):
+
+    def _callFUT(self, logger):
+        from repoze.debug.logwriter import joinable
+        return joinable(logger)
+
+    def _makeLogger(self, handler=None):
+        import logging
+        from repoze.debug.logwriter import AppendLogHandler
+        if handler is None:
+            handler = AppendLogHandler.__new__(AppendLogHandler)
+            logging.Handler.__init__(handler)
+        logger = logging.Logger('test')
+        logger.handlers = [handler]
+        return logger
+
+    def test_append_log_handler(self):
+        self.assertTrue(self._callFUT(self._makeLogger()))
+
+    def test_not_a_logger(self):
+        self.assertFalse(self._callFUT(FakeLogger()))
+
+    def test_no_handlers(self):
+        import logging
+        self.assertFalse(self._callFUT(logging.Logger('test')))
+
+    def test_other_handler(self):
+        import logging
+        logger = self._makeLogger(logging.StreamHandler(FakeStream()))
+        self.assertFalse(self._callFUT(logger))
+
+    def test_formatter(self):
+        import logging
+        logger = self._makeLogger()
+        logger.handlers[0].setFormatter(logging.Formatter('%(message)s'))
+        self.assertFalse(self._callFUT(logger))
+
+    def test_filters(self):
+        logger = self._makeLogger()
+        logger.addFilter(lambda record: True)
+        self.assertFalse(self._callFUT(logger))
+        logger = self._makeLogger()
+        logger.handlers[0].addFilter(lambda record: True)
+        self.assertFalse(self._callFUT(logger))
+
+    def test_propagates(self):
+        import logging
+        logger = self._makeLogger()
+        logger.parent = logging.getLogger()
+        self.assertFalse(self._callFUT(logger))
+        logger.propagate = False
+        self.assertTrue(self._callFUT(logger))
+
+
+class AppendFileTests(unittest.TestCase):
+
+    def setUp(self):
+        import tempfile
+        self.tmpdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        import shutil
+        shutil.rmtree(self.tmpdir)
+
+    def _getTargetClass(self):
+        from repoze.debug.logwriter import AppendFile
+        return AppendFile
+
+    def _makeOne(self, *arg, **kw):
+        import os
+        kw.setdefault('compress_delay', 0)
+        f = self._getTargetClass()(os.path.join(self.tmpdir, 'trace.log'),
+                                   *arg, **kw)
+        self.addCleanup(f.close)
+        return f
+
+    def _read(self, filename):
+        with open(filename, 'rb') as f:
+            return f.read()
+
+    def test_write_appends(self):
+        f = self._makeOne()
+        f.write(b'one\n')
+        other = self._makeOne()
+        other.write(b'two\n')
+        f.write(b'three\n')
+        self.assertEqual(self._read(f.filename), b'one\ntwo\nthree\n')
+        self.assertEqual(self._makeOne().tell(), 14)
+        self.assertEqual(f.generation, 1)
+
+    def test_header_only_in_new_file(self):
+        f = self._makeOne(header=b'HDR')
+        f.write(b'x')
+        self._makeOne(header=b'HDR').write(b'y')
+        self.assertEqual(self._read(f.filename), b'HDRxy')
+
+    def test_no_rotation_wo_backup_count(self):
+        f = self._makeOne(10, 0)
+        f.write(b'x' * 20)
+        self.assertEqual(f.backups(), [])
+        self.assertEqual(f.generation, 1)
+
+    def test_rotate(self):
+        f = self._makeOne(10, 2, header=b'H', compress=False)
+        f.write(b'x' * 10)
+        f.flush()
+        self.assertEqual(f.generation, 2)
+        backups = f.backups()
+        self.assertEqual(len(backups), 1)
+        self.assertEqual(self._read(backups[0]), b'H' + b'x' * 10)
+        self.assertEqual(self._read(f.filename), b'H')
+        f.write(b'y')
+        self.assertEqual(self._read(f.filename), b'Hy')
+
+    def test_rotate_compresses_and_prunes(self):
+        import gzip
+        import time
+        f = self._makeOne(5, 2)
+        for i in range(4):
+            f.write(('%d' % i).encode('ascii') * 5)
+            f.flush()
+            time.sleep(0.001) # distinct names
+        backups = f.backups()
+        self.assertEqual(len(backups), 2)
+        self.assertTrue(backups[0].endswith('.gz'))
+        out = gzip.open(backups[-1], 'rb')
+        try:
+            self.assertEqual(out.read(), b'33333')
+        finally:
+            out.close()
+
+    def test_rotated_by_other_process(self):
+        f = self._makeOne(10, 2, check_interval=0, compress=False)
+        other = self._makeOne(10, 2, check_interval=0, compress=False)
+        f.write(b'x' * 10)
+        f.flush()
+        # 'other' still writes to the rotated file until it checks
+        other.refresh()
+        self.assertEqual(other.generation, 2)
+        other.write(b'y')
+        self.assertEqual(self._read(f.filename), b'y')
+
+    def test_refresh_interval(self):
+        import os
+        f = self._makeOne(check_interval=3600)
+        os.rename(f.filename, f.filename + '.old')
+        f.refresh()
+        self.assertEqual(f.generation, 1)
+
+    def test_refresh_after_removal(self):
+        import os
+        f = self._makeOne(check_interval=0)
+        os.remove(f.filename)
+        f.refresh()
+        self.assertEqual(f.generation, 2)
+        self.assertTrue(os.path.exists(f.filename))
+
+    def test_reopen(self):
+        import os
+        f = self._makeOne()
+        os.rename(f.filename, f.filename + '.old')
+        f.reopen()
+        f.write(b'x')
+        self.assertEqual(self._read(f.filename), b'x')
+
+    def test_concurrent_processes_whole_lines(self):
+        import os
+        if not hasattr(os, 'fork'): # pragma: no cover
+            return
+        f = self._makeOne(2000, 100, compress=False, check_interval=0)
+        line = b'x' * 99 + b'\n'
+        pids = []
+        for i in range(4):
+            pid = os.fork()
+            if pid == 0: # pragma: no cover
+                try:
+                    for j in range(50):
+                        f.refresh()
+                        f.write(line)
+                finally:
+                    os._exit(0)
+            pids.append(pid)
+        for pid in pids:
+            os.waitpid(pid, 0)
+        data = b''.join([self._read(name)
+                         for name in f.backups() + [f.filename]])
+        self.assertEqual(data.count(line), 200)
+        self.assertEqual(len(data), 200 * len(line))
+
+
+class Test_compress_file(unittest.TestCase):
+
+    def _callFUT(self, filename):
+        from repoze.debug.logwriter import compress_file
+        return compress_file(filename)
+
+    def test_it(self):
+        import gzip
+        import os
+        import tempfile
+        fd, fn = tempfile.mkstemp()
+        os.write(fd, b'hello')
+        os.close(fd)
+        self._callFUT(fn)
+        try:
+            self.assertFalse(os.path.exists(fn))
+            out = gzip.open(fn + '.gz', 'rb')
+            try:
+                self.assertEqual(out.read(), b'hello')
+            finally:
+                out.close()
+        finally:
+            os.remove(fn + '.gz')
+
+
+class AppendLogHandlerTests(unittest.TestCase):
+
+    def _getTargetClass(self):
+        from repoze.debug.logwriter import AppendLogHandler
+        return AppendLogHandler
+
+    def test_emit(self):
+        import logging
+        import os
+        import tempfile
+        fn = tempfile.mktemp()
+        handler = self._getTargetClass()(fn)
+        try:
+            logger = logging.Logger('test')
+            logger.handlers = [handler]
+            logger.info('B 1\nE 2')
+            logger.info(b'caf\xc3\xa9'.decode('utf-8'))
+            handler.close()
+            with open(fn, 'rb') as f:
+                self.assertEqual(f.read(), b'B 1\nE 2\ncaf\xc3\xa9\n')
+        finally:
+            os.remove(fn)
+
+    def test_emit_error(self):
+        import logging
+        import os
+        import tempfile
+        fn = tempfile.mktemp()
+        handler = self._getTargetClass()(fn)
+        errors = []
+        handler.handleError = errors.append
+        handler.close()
+        try:
+            record = logging.LogRecord('test', logging.INFO, __file__, 1,
+                                       'x', (), None)
+            handler.emit(record)
+            self.assertEqual(errors, [record])
+        finally:
+            os.remove(fn)
+
+
+class FakeLogger(object):
+
+    def __init__(self):
+        self.logged = []
+
+    def info(self, msg):
+        self.logged.append(msg)
+
+
+class FakeStream(object):
+
+    def __init__(self):
+        self.written = []
+
+    def write(self, data):
+        self.written.append(data)
+
+
+class BlockingLogger(FakeLogger):
+
+    def __init__(self):
+        import threading
+        FakeLogger.__init__(self)
+        self.entered = threading.Event()
+        self.release = threading.Event()
+
+    def info(self, msg):
+        self.entered.set()
+        self.release.wait(5)
+        FakeLogger.info(self, msg)
@@ -0,0 +1,233 @@
+import unittest
+
+
+class Test_normalize_path(unittest.TestCase):
+
+    def _callFUT(self, path):
+        from repoze.debug.metrics import normalize_path
+        return normalize_path(path)
+
+    def test_static(self):
+        self.assertEqual(self._callFUT('/foo/bar/'), '/foo/bar/')
+
+    def test_numbers(self):
+        self.assertEqual(self._callFUT('/users/123/posts/4'),
+                         '/users/{id}/posts/{id}')
+
+    def test_uuid(self):
+        self.assertEqual(
+            self._callFUT('/doc/0f8fad5b-d9cb-469f-a165-70867728950e/edit'),
+            '/doc/{id}/edit')
+
+    def test_long_hex(self):
+        path = '/blob/3f786850e387550fdab836ed7e6dc88'
+        self.assertEqual(self._callFUT(path), '/blob/{id}')
+
+    def test_words_left_alone(self):
+        self.assertEqual(self._callFUT('/v2/deadbeefcafebabe/abc1'),
+                         '/v2/deadbeefcafebabe/abc1')
+
+    def test_long_path_truncated(self):
+        self.assertEqual(len(self._callFUT('/x' * 500)), 200)
+
+
+class LatencyHistogramTests(unittest.TestCase):
+
+    def _getTargetClass(self):
+        from repoze.debug.metrics import LatencyHistogram
+        return LatencyHistogram
+
+    def _makeOne(self):
+        return self._getTargetClass()()
+
+    def test_empty(self):
+        histogram = self._makeOne()
+        self.assertEqual(histogram.percentile(50), None)
+        summary = histogram.summary()
+        self.assertEqual(summary['count'], 0)
+        self.assertEqual(summary['mean'], 0.0)
+        self.assertEqual(summary['max'], 0.0)
+
+    def test_constant_memory(self):
+        from repoze.debug.metrics import BUCKETS
+        histogram = self._makeOne()
+        for i in range(1000):
+            histogram.record(i * 0.01)
+        self.assertEqual(len(histogram.counts), BUCKETS + 1)
+        self.assertEqual(histogram.count, 1000)
+
+    def test_merge(self):
+        first = self._makeOne()
+        second = self._makeOne()
+        first.record(0.5)
+        second.record(0.25)
+        second.record(2.0)
+        first.merge(second)
+        self.assertEqual(first.count, 3)
+        self.assertEqual(first.total, 2.75)
+        self.assertEqual(first.max, 2.0)
+        self.assertEqual(sum(first.counts), 3)
+        self.assertEqual(first.percentile(100), 2.0)
+
+    def test_percentiles_within_bucket_resolution(self):
+        histogram = self._makeOne()
+        for i in range(1, 101):
+            histogram.record(i / 100.0)
+        for q, expected in ((50, 0.5), (90, 0.9), (99, 0.99)):
+            value = histogram.percentile(q)
+            self.assertTrue(expected <= value <= expected * 1.19,
+                            (q, value))
+        self.assertEqual(histogram.percentile(100), 1.0)
+        self.assertEqual(histogram.max, 1.0)
+        self.assertAlmostEqual(histogram.summary()['mean'], 0.505)
+
+    def test_tiny_and_huge_durations(self):
+        histogram = self._makeOne()
+        histogram.record(0.0)
+        histogram.record(1e6)
+        self.assertEqual(histogram.counts[0], 1)
+        self.assertEqual(histogram.counts[-1], 1)
+        self.assertEqual(histogram.percentile(50), 0.0001)
+        self.assertEqual(histogram.percentile(100), 1e6)
+
+
+class LatencyStatsTests(unittest.TestCase):
+
+    def _getTargetClass(self):
+        from repoze.debug.metrics import LatencyStats
+        return LatencyStats
+
+    def _makeOne(self, *arg, **kw):
+        return self._getTargetClass()(*arg, **kw)
+
+    def test_record_groups_by_method_and_route(self):
+        stats = self._makeOne()
+        stats.record('GET', '/users/1', 0.1)
+        stats.record('GET', '/users/2', 0.3)
+        stats.record('POST', '/users/2', 2.0)
+        summaries = stats.summaries()
+        self.assertEqual([(x['method'], x['route'], x['count'])
+                          for x in summaries],
+                         [('POST', '/users/{id}', 1),
+                          ('GET', '/users/{id}', 2)])
+        self.assertEqual(summaries[1]['max'], 0.3)
+
+    def test_max_routes(self):
+        from repoze.debug.metrics import OTHER_ROUTES
+        stats = self._makeOne(2)
+        for path in ('/a', '/b', '/c', '/d', '/a'):
+            stats.record('GET', path, 0.1)
+        self.assertEqual(len(stats.histograms), 3)
+        counts = dict([(x['route'], x['count']) for x in stats.summaries()])
+        self.assertEqual(counts, {'/a': 2, '/b': 1, OTHER_ROUTES: 2})
+
+    def test_reset(self):
+        stats = self._makeOne()
+        stats.record('GET', '/a', 0.1)
+        stats.reset()
+        self.assertEqual(stats.summaries(), [])
+
+
+class Test_format_summaries(unittest.TestCase):
+
+    def _callFUT(self, summaries):
+        from repoze.debug.metrics import format_summaries
+        return format_summaries(summaries)
+
+    def test_it(self):
+        from repoze.debug.metrics import LatencyStats
+        stats = LatencyStats()
+        stats.record('GET', '/a', 0.25)
+        lines = self._callFUT(stats.summaries()).splitlines()
+        self.assertEqual(lines[0].split(),
+                         ['Count', 'Mean', 'P50', 'P90', 'P99', 'Max',
+                          'Method', 'Route'])
+        self.assertEqual(lines[1].split(),
+                         ['1', '0.2500', '0.2500', '0.2500', '0.2500',
+                          '0.2500', 'GET', '/a'])
+
+
+class RequestCountersTests(unittest.TestCase):
+
+    def _getTargetClass(self):
+        from repoze.debug.metrics import RequestCounters
+        return RequestCounters
+
+    def _makeOne(self):
+        return self._getTargetClass()()
+
+    def test_begin_end(self):
+        counters = self._makeOne()
+        counters.begin()
+        counters.begin()
+        self.assertEqual(counters.in_flight, 2)
+        counters.end('200 OK', 10, 20, 0.01)
+        counters.end('503 Service Unavailable', None, None, 20.0)
+        self.assertEqual(counters.in_flight, 0)
+        self.assertEqual(counters.statuses, {'2xx': 1, '5xx': 1})
+        self.assertEqual(counters.bytes_in, 10)
+        self.assertEqual(counters.bytes_out, 20)
+        self.assertEqual(counters.buckets[1], 1)
+        self.assertEqual(counters.buckets[-1], 1)
+        self.assertEqual(counters.duration_count, 2)
+        self.assertAlmostEqual(counters.duration_sum, 20.01)
+
+    def test_end_bucket_bounds_inclusive(self):
+        counters = self._makeOne()
+        counters.begin()
+        counters.end('200 OK', 0, 0, 0.005)
+        self.assertEqual(counters.buckets[0], 1)
+
+
+class Test_render_prometheus(unittest.TestCase):
+
+    def _callFUT(self, counters, entries=None, log_writer=None):
+        from repoze.debug.metrics import render_prometheus
+        return render_prometheus(counters, entries, log_writer)
+
+    def _makeCounters(self):
+        from repoze.debug.metrics import RequestCounters
+        counters = RequestCounters()
+        for status, duration in (('200 OK', 0.02), ('204 No Content', 0.3),
+                                 ('404 Not Found', 0.001)):
+            counters.begin()
+            counters.end(status, 3, 5, duration)
+        counters.begin()
+        return counters
+
+    def test_it(self):
+        text = self._callFUT(self._makeCounters(), [1, 2, 3],
+                             DummyLogWriter(4))
+        self.assertTrue(text.endswith('\n'))
+        lines = text.splitlines()
+        self.assertTrue('# TYPE repoze_debug_requests_total counter' in lines)
+        self.assertTrue('repoze_debug_requests_total{status="2xx"} 2' in lines)
+        self.assertTrue('repoze_debug_requests_total{status="4xx"} 1' in lines)
+        self.assertTrue('repoze_debug_requests_in_flight 1' in lines)
+        self.assertTrue('repoze_debug_request_bytes_total 9' in lines)
+        self.assertTrue('repoze_debug_response_bytes_total 15' in lines)
+        self.assertTrue('repoze_debug_entries_retained 3' in lines)
+        self.assertTrue('repoze_debug_log_records_dropped_total 4' in lines)
+
+    def test_histogram_cumulative(self):
+        lines = self._callFUT(self._makeCounters()).splitlines()
+        prefix = 'repoze_debug_request_duration_seconds'
+        self.assertTrue('# TYPE %s histogram' % prefix in lines)
+        self.assertTrue('%s_bucket{le="0.005"} 1' % prefix in lines)
+        self.assertTrue('%s_bucket{le="0.025"} 2' % prefix in lines)
+        self.assertTrue('%s_bucket{le="0.5"} 3' % prefix in lines)
+        self.assertTrue('%s_bucket{le="+Inf"} 3' % prefix in lines)
+        self.assertTrue('%s_count 3' % prefix in lines)
+        self.assertTrue(lines.index('%s_bucket{le="+Inf"} 3' % prefix) <
+                        lines.index('%s_count 3' % prefix))
+
+    def test_wo_entries_or_log_writer(self):
+        text = self._callFUT(self._makeCounters())
+        self.assertFalse('entries_retained' in text)
+        self.assertFalse('dropped' in text)
+
+
+class DummyLogWriter(object):
+
+    def __init__(self, dropped):
+        self.dropped = dropped
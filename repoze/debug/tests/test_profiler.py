@@ -0,0 +1,158 @@
+import unittest
+
+
+class StackProfileTests(unittest.TestCase):
+
+    def _getTargetClass(self):
+        from repoze.debug.profiler import StackProfile
+        return StackProfile
+
+    def _makeOne(self):
+        return self._getTargetClass()()
+
+    def test_empty(self):
+        profile = self._makeOne()
+        self.assertEqual(profile.folded(), '')
+        self.assertEqual(profile.functions(), [])
+        self.assertTrue(profile.top().startswith(
+            '0 samples of 0 stacks in 0.00 seconds'))
+
+    def test_sample(self):
+        profile = self._makeOne()
+        outer = _code('outer', 1)
+        inner = _code('inner', 10)
+        other = _code('other', 20)
+        frames = {1: _frame(inner, _frame(outer)),
+                  2: _frame(inner, _frame(outer)),
+                  3: _frame(other, _frame(outer)),
+                  4: _frame(other),
+                 }
+        profile.sample(frames, exclude=(4,))
+        profile.sample({1: _frame(outer)})
+        self.assertEqual(profile.samples, 2)
+        self.assertEqual(profile.stacks, {(outer, inner): 2,
+                                          (outer, other): 1,
+                                          (outer,): 1})
+        self.assertEqual(profile.folded().splitlines(),
+                         ['outer (app.py:1);inner (app.py:10) 2',
+                          'outer (app.py:1) 1',
+                          'outer (app.py:1);other (app.py:20) 1'])
+        self.assertEqual(profile.functions(),
+                         [('inner (app.py:10)', 2, 2),
+                          ('outer (app.py:1)', 1, 4),
+                          ('other (app.py:20)', 1, 1)])
+
+    def test_recursion_counted_once_in_total(self):
+        profile = self._makeOne()
+        recursive = _code('recursive', 1)
+        profile.sample({1: _frame(recursive, _frame(recursive))})
+        self.assertEqual(profile.functions(),
+                         [('recursive (app.py:1)', 1, 1)])
+
+    def test_max_depth(self):
+        from repoze.debug.profiler import MAX_DEPTH
+        profile = self._makeOne()
+        frame = None
+        for i in range(MAX_DEPTH + 10):
+            frame = _frame(_code('f%d' % i, i), frame)
+        profile.add(frame)
+        key, = profile.stacks.keys()
+        self.assertEqual(len(key), MAX_DEPTH)
+
+    def test_folded_escapes_separator(self):
+        profile = self._makeOne()
+        profile.add(_frame(_code('f', 1, 'a;b.py')))
+        self.assertEqual(profile.folded(), 'f (a:b.py:1) 1\n')
+
+    def test_top(self):
+        profile = self._makeOne()
+        outer = _code('outer', 1)
+        inner = _code('inner', 10)
+        profile.sample({1: _frame(inner, _frame(outer)),
+                        2: _frame(outer)})
+        profile.duration = 1.5
+        lines = profile.top(1).splitlines()
+        self.assertEqual(lines[0], '1 samples of 2 stacks in 1.50 seconds')
+        self.assertEqual(lines[2].split(),
+                         ['Self', 'Self%', 'Total', 'Total%', 'Function'])
+        self.assertEqual(len(lines), 4)
+        self.assertEqual(lines[3].split(),
+                         ['1', '50.0', '2', '100.0', 'outer', '(app.py:1)'])
+
+
+class Test_sample_stacks(unittest.TestCase):
+
+    def _callFUT(self, *arg, **kw):
+        from repoze.debug.profiler import sample_stacks
+        return sample_stacks(*arg, **kw)
+
+    def test_excludes_caller(self):
+        from repoze.debug._compat import thread
+        frames = {thread.get_ident(): _frame(_code('me', 1)),
+                  'other': _frame(_code('other', 1)),
+                  'excluded': _frame(_code('excluded', 1)),
+                 }
+        profile = self._callFUT(0.05, 100, exclude=('excluded',),
+                                frames=lambda: frames)
+        self.assertTrue(profile.samples >= 1)
+        self.assertEqual(list(profile.stacks.values()), [profile.samples])
+        self.assertEqual(profile.folded().split(' (')[0], 'other')
+        self.assertTrue(profile.duration > 0)
+
+    def test_rate(self):
+        slept = []
+        def sleep(seconds):
+            import time
+            slept.append(seconds)
+            time.sleep(seconds)
+        profile = self._callFUT(0.1, 50, frames=lambda: {}, sleep=sleep)
+        self.assertTrue(3 <= profile.samples <= 6)
+        for seconds in slept:
+            self.assertTrue(seconds <= 0.02)
+
+
+class Test_profile(unittest.TestCase):
+
+    def _callFUT(self, seconds, hz):
+        from repoze.debug.profiler import profile
+        return profile(seconds, hz)
+
+    def test_samples_other_threads(self):
+        import threading
+        stop = threading.Event()
+        def busy():
+            while not stop.is_set():
+                stop.wait(0.001)
+        worker = threading.Thread(target=busy)
+        worker.start()
+        try:
+            result = self._callFUT(0.05, 200)
+        finally:
+            stop.set()
+            worker.join()
+        folded = result.folded()
+        self.assertTrue('busy (' in folded)
+        self.assertFalse('test_samples_other_threads' in folded)
+        self.assertFalse('sample_stacks' in folded)
+
+
+class _Code(object):
+
+    def __init__(self, co_name, co_firstlineno, co_filename):
+        self.co_name = co_name
+        self.co_firstlineno = co_firstlineno
+        self.co_filename = co_filename
+
+
+class _Frame(object):
+
+    def __init__(self, f_code, f_back):
+        self.f_code = f_code
+        self.f_back = f_back
+
+
+def _code(name, line, filename='app.py'):
+    return _Code(name, line, filename)
+
+def _frame(code, back=None):
+    return _Frame(code, back)
@@ -90,11 +90,595 @@ class ResponseLoggingMiddlewareTests(unittest.TestCase):
         vlogger = FakeLogger()
         tlogger = FakeLogger()
         mw = self._makeOne(app, 1, 1, vlogger, tlogger)
-        mw.entries = ['a']
+        mw.entries.append({'id': 'a'})
         environ = _makeEnviron()
         start_response = FakeStartResponse()
         app_iter = mw(environ, start_response)
         self.assertEqual(len(mw.entries), 1)
+        self.assertEqual(mw.entries[0]['id'], id(environ))
+
+    def test_call_w_entries(self):
+        body = [b'thebody']
+        app = DummyApp(body, '200 OK', [])
+        entries = DummyEntries()
+        mw = self._makeOne(app, 0, 10, None, None, entries=entries)
+        self.assertTrue(mw.entries is entries)
+        b''.join(mw(_makeEnviron(), FakeStartResponse()))
+        self.assertEqual(len(entries.appended), 1)
+        self.assertTrue(entries.updated[0] is entries.appended[0])
+        self.assertEqual(entries.updated[0]['response']['body'], b'thebody')
+
+    def test_call_streaming_timings(self):
+        tlogger = FakeLogger()
+        vlogger = FakeLogger()
+        def app(environ, start_response):
+            start_response('200 OK', [])
+            def body():
+                mw._now = 1001.0
+                yield b'a'
+                yield b''
+                mw._now = 1004.0
+                yield b'b'
+                mw._now = 1004.5
+                yield b'c'
+            return body()
+        mw = self._makeOne(app, 0, 10, vlogger, tlogger)
+        mw._now = 1000.0
+        self.assertEqual(b''.join(mw(_makeEnviron(), FakeStartResponse())),
+                         b'abc')
+        first = [x for x in tlogger.logged if x.startswith('F ')][0]
+        self.assertEqual(first.split(' ')[3], '1001000000000')
+        self.assertEqual(tlogger.logged[-1].split(' ')[4:],
+                         ['3', '3', '3000000000'])
+        response = mw.entries[0]['response']
+        self.assertEqual(response['first_byte'], 1001 * 10**9)
+        self.assertEqual(response['chunks'], 3)
+        self.assertEqual(response['max_gap'], 3 * 10**9)
+        self.assertTrue('First byte after: 1.000 seconds (3 chunks, largest '
+                        'gap 3.000 seconds)' in vlogger.logged[1])
+
+    def test_call_empty_body_no_first_byte(self):
+        tlogger = FakeLogger()
+        vlogger = FakeLogger()
+        app = DummyApp([], '204 No Content', [])
+        mw = self._makeOne(app, 0, 10, vlogger, tlogger)
+        self.assertEqual(list(mw(_makeEnviron(), FakeStartResponse())), [])
+        self.assertEqual([line[0] for line in tlogger.logged],
+                         ['U', 'B', 'A', 'E'])
+        self.assertEqual(tlogger.logged[-1].split(' ')[4:], ['0', '0', '0'])
+        self.assertFalse('First byte' in vlogger.logged[1])
+
+    def test_call_records_latency(self):
+        from repoze.debug.metrics import LatencyStats
+        app = DummyApp([b'thebody'], '200 OK', [])
+        latency = LatencyStats()
+        mw = self._makeOne(app, 0, 10, None, None, latency=latency)
+        mw._now = 1000.0
+        def later(chunks):
+            for chunk in chunks:
+                mw._now = 1000.5
+                yield chunk
+        app.body = later([b'thebody'])
+        environ = _makeEnviron({'SCRIPT_NAME': '/app',
+                                'PATH_INFO': '/users/42'})
+        b''.join(mw(environ, FakeStartResponse()))
+        summary = latency.summaries()[0]
+        self.assertEqual(summary['route'], '/app/users/{id}')
+        self.assertEqual(summary['method'], 'GET')
+        self.assertEqual(summary['count'], 1)
+        self.assertEqual(summary['max'], 0.5)
+
+    def test_call_not_sampled_records_latency(self):
+        from repoze.debug.metrics import LatencyStats
+        app = DummyApp([b'thebody'], '200 OK', [])
+        latency = LatencyStats()
+        mw = self._makeOne(app, 0, 10, None, None, latency=latency,
+                           sampler=lambda environ: False)
+        environ = _makeEnviron({'PATH_INFO': '/foo'})
+        self.assertEqual(b''.join(mw(environ, FakeStartResponse())),
+                         b'thebody')
+        self.assertEqual([x['route'] for x in latency.summaries()], ['/foo'])
+
+    def test_call_not_sampled_file_wrapper_records_latency(self):
+        import io
+        from wsgiref.util import FileWrapper
+        from repoze.debug.metrics import LatencyStats
+        wrapper = FileWrapper(io.BytesIO(b'thebody'))
+        app = DummyApp(wrapper, '200 OK', [('Content-Length', '7')])
+        latency = LatencyStats()
+        mw = self._makeOne(app, 0, 10, None, None, latency=latency,
+                           sampler=lambda environ: False)
+        environ = _makeEnviron({'wsgi.file_wrapper': FileWrapper,
+                                'PATH_INFO': '/foo'})
+        app_iter = mw(environ, FakeStartResponse())
+        self.assertEqual(latency.summaries(), [])
+        app_iter.close()
+        self.assertEqual([x['count'] for x in latency.summaries()], [1])
+
+    def test_call_updates_counters(self):
+        from repoze.debug.metrics import RequestCounters
+        app = DummyReadingApp([b'thebody'], '404 Not Found', [])
+        counters = RequestCounters()
+        mw = self._makeOne(app, 0, 10, None, None, counters=counters)
+        app_iter = mw(_makeEnviron(), FakeStartResponse())
+        self.assertEqual(counters.in_flight, 1)
+        self.assertEqual(b''.join(app_iter), b'thebody')
+        self.assertEqual(counters.in_flight, 0)
+        self.assertEqual(counters.statuses, {'4xx': 1})
+        self.assertEqual(counters.bytes_in, 11)
+        self.assertEqual(counters.bytes_out, 7)
+        self.assertEqual(counters.duration_count, 1)
+
+    def test_call_app_raises_updates_counters(self):
+        from repoze.debug.metrics import RequestCounters
+        counters = RequestCounters()
+        mw = self._makeOne(DummyRaisingApp(), 0, 10, None, None,
+                           counters=counters)
+        self.assertRaises(ValueError, mw, _makeEnviron(), FakeStartResponse())
+        self.assertEqual(counters.in_flight, 0)
+        self.assertEqual(counters.statuses, {'5xx': 1})
+
+    def test_call_not_sampled_updates_counters(self):
+        from repoze.debug.metrics import RequestCounters
+        app = DummyApp([b'thebody'], '200 OK', [])
+        counters = RequestCounters()
+        mw = self._makeOne(app, 0, 10, None, None, counters=counters,
+                           sampler=lambda environ: False)
+        environ = _makeEnviron({'CONTENT_LENGTH': '11'})
+        self.assertEqual(b''.join(mw(environ, FakeStartResponse())),
+                         b'thebody')
+        self.assertEqual(counters.in_flight, 0)
+        self.assertEqual(counters.statuses, {'2xx': 1})
+        self.assertEqual(counters.bytes_in, 11)
+        self.assertEqual(counters.bytes_out, 7)
+
+    def test_call_not_sampled_app_raises_updates_counters(self):
+        from repoze.debug.metrics import RequestCounters
+        counters = RequestCounters()
+        mw = self._makeOne(DummyRaisingApp(), 0, 10, None, None,
+                           counters=counters, sampler=lambda environ: False)
+        environ = _makeEnviron({'CONTENT_LENGTH': 'bogus'})
+        self.assertRaises(ValueError, mw, environ, FakeStartResponse())
+        self.assertEqual(counters.in_flight, 0)
+        self.assertEqual(counters.statuses, {'5xx': 1})
+        self.assertEqual(counters.bytes_in, 0)
+
+    def test_call_registers_inflight(self):
+        from repoze.debug._compat import thread
+        from repoze.debug.inflight import InflightRegistry
+        inflight = InflightRegistry()
+        mw = self._makeOne(DummyApp([b'thebody'], '200 OK', []), 0, 10, None,
+                           None, inflight=inflight)
+        environ = _makeEnviron({'PATH_INFO': '/foo'})
+        app_iter = mw(environ, FakeStartResponse())
+        request, = inflight.snapshot()
+        self.assertEqual(request.request_id, id(environ))
+        self.assertEqual(request.thread_id, thread.get_ident())
+        self.assertEqual(request.method, 'GET')
+        self.assertEqual(request.url, 'http://localhost/foo')
+        self.assertEqual(b''.join(app_iter), b'thebody')
+        self.assertEqual(len(inflight), 0)
+
+    def test_call_app_raises_unregisters_inflight(self):
+        from repoze.debug.inflight import InflightRegistry
+        inflight = InflightRegistry()
+        for sampler in (None, lambda environ: False):
+            mw = self._makeOne(DummyRaisingApp(), 0, 10, None, None,
+                               sampler=sampler, inflight=inflight)
+            self.assertRaises(ValueError, mw, _makeEnviron(),
+                              FakeStartResponse())
+            self.assertEqual(len(inflight), 0)
+
+    def test_call_not_sampled_registers_inflight(self):
+        from repoze.debug.inflight import InflightRegistry
+        inflight = InflightRegistry()
+        mw = self._makeOne(DummyApp([b'thebody'], '200 OK', []), 0, 10, None,
+                           None, sampler=lambda environ: False,
+                           inflight=inflight)
+        app_iter = mw(_makeEnviron({'PATH_INFO': '/foo'}),
+                      FakeStartResponse())
+        request, = inflight.snapshot()
+        self.assertEqual(request.url, 'http://localhost/foo')
+        self.assertEqual(b''.join(app_iter), b'thebody')
+        self.assertEqual(len(inflight), 0)
+
+    def test_call_starts_watchdog(self):
+        class DummyWatchdog(object):
+            started = 0
+            def ensure_started(self):
+                self.started += 1
+        mw = self._makeOne(DummyApp([b'thebody'], '200 OK', []), 0, 10, None,
+                           None)
+        mw.watchdog = DummyWatchdog()
+        list(mw(_makeEnviron(), FakeStartResponse()))
+        self.assertEqual(mw.watchdog.started, 1)
+
+    def test_log_stuck_request(self):
+        from repoze.debug.inflight import InflightRequest
+        vlogger = FakeLogger()
+        mw = self._makeOne(None, 0, 10, vlogger, None)
+        request = InflightRequest(1234, 5678, 'POST',
+                                  {'url': 'http://localhost/foo'}, 1.0)
+        mw.log_stuck_request(request, 12.5, '  File "x.py", line 1\n')
+        lines = vlogger.logged[0].splitlines()
+        self.assertTrue(lines[0].startswith('--- begin STACK for 1234 at '))
+        self.assertEqual(lines[1:], ['URL: POST http://localhost/foo',
+                                     'Running for: 12.50 seconds',
+                                     'Thread: 5678',
+                                     '  File "x.py", line 1',
+                                     '--- end STACK for 1234 ---'])
+
+    def test_call_over_max_memory(self):
+        body = [b'x' * 1000]
+        app = DummyApp(body, '200 OK', [('Content-Length', '1000')])
+        mw = self._makeOne(app, 0, 10, None, None, max_memory=1500)
+        for i in range(3):
+            start_response = FakeStartResponse()
+            b''.join(mw(_makeEnviron(), start_response))
+        self.assertEqual(len(mw.entries), 1)
+        self.assertTrue(mw.entries.memory > 1000)
+
+    def test_call_unlimited_maxbodylen_not_truncated(self):
+        body = [b'the', b'body']
+        app = DummyApp(body, '200 OK', [])
+        vlogger = FakeLogger()
+        mw = self._makeOne(app, 0, 10, vlogger, None)
+        start_response = FakeStartResponse()
+        app_iter = mw(_makeEnviron(), start_response)
+        self.assertEqual(b''.join(app_iter), b'thebody')
+        self.assertEqual(mw.entries[0]['response']['body'], b'thebody')
+        self.assertFalse('truncated' in vlogger.logged[1])
+
+    def test_call_unlimited_maxbodylen_hits_max_capture(self):
+        body = [b'the', b'body']
+        app = DummyApp(body, '200 OK', [])
+        mw = self._makeOne(app, 0, 10, None, None, max_capture=4)
+        start_response = FakeStartResponse()
+        app_iter = mw(_makeEnviron(), start_response)
+        self.assertEqual(b''.join(app_iter), b'thebody')
+        self.assertEqual(mw.entries[0]['response']['body'],
+                         b'theb ... (truncated at 4 bytes)')
+
+    def test_call_file_wrapper_passed_through(self):
+        import io
+        from wsgiref.util import FileWrapper
+        f = io.BytesIO(b'thebody')
+        wrapper = FileWrapper(f)
+        app = DummyApp(wrapper, '200 OK', [('Content-Length', '7')])
+        vlogger = FakeLogger()
+        tlogger = FakeLogger()
+        mw = self._makeOne(app, 0, 10, vlogger, tlogger)
+        environ = _makeEnviron({'wsgi.file_wrapper': FileWrapper})
+        start_response = FakeStartResponse()
+        app_iter = mw(environ, start_response)
+        self.assertTrue(app_iter is wrapper)
+        self.assertEqual([line[0] for line in tlogger.logged],
+                         ['U', 'B', 'A'])
+        self.assertEqual(len(vlogger.logged), 1)
+        self.assertEqual(b''.join(app_iter), b'thebody')
+        app_iter.close()
+        self.assertTrue(f.closed)
+        self.assertEqual(tlogger.logged[3].split(' ')[0], 'E')
+        self.assertEqual(tlogger.logged[3].split(' ')[4], '7')
+        self.assertEqual(len(vlogger.logged), 2)
+        self.assertFalse('WARNING-1' in vlogger.logged[1])
+        response = mw.entries[0]['response']
+        self.assertEqual(response['status'], '200 OK')
+        self.assertEqual(response['content-length'], 7)
+        self.assertTrue('end' in response)
+
+    def test_call_file_wrapper_factory(self):
+        import io
+        from wsgiref.util import FileWrapper
+        wrapper = FileWrapper(io.BytesIO(b'thebody'))
+        app = DummyApp(wrapper, '200 OK', [])
+        tlogger = FakeLogger()
+        mw = self._makeOne(app, 0, 10, None, tlogger)
+        environ = _makeEnviron({'wsgi.file_wrapper': lambda f, *a: None})
+        start_response = FakeStartResponse()
+        self.assertTrue(mw(environ, start_response) is wrapper)
+
+    def test_call_file_wrapper_not_closable(self):
+        class Wrapper(object):
+            __slots__ = ('filelike',)
+            def __init__(self, filelike):
+                self.filelike = filelike
+            def __iter__(self):
+                return iter([self.filelike])
+        wrapper = Wrapper(b'thebody')
+        app = DummyApp(wrapper, '200 OK', [])
+        tlogger = FakeLogger()
+        mw = self._makeOne(app, 0, 10, None, tlogger)
+        environ = _makeEnviron({'wsgi.file_wrapper': Wrapper})
+        start_response = FakeStartResponse()
+        self.assertTrue(mw(environ, start_response) is wrapper)
+        self.assertEqual([line[0] for line in tlogger.logged],
+                         ['U', 'B', 'A', 'E'])
+
+    def test_call_not_file_wrapper(self):
+        from wsgiref.util import FileWrapper
+        body = [b'thebody']
+        app = DummyApp(body, '200 OK', [])
+        mw = self._makeOne(app, 0, 10, None, None)
+        environ = _makeEnviron({'wsgi.file_wrapper': FileWrapper})
+        start_response = FakeStartResponse()
+        app_iter = mw(environ, start_response)
+        self.assertFalse(app_iter is body)
+        self.assertEqual(b''.join(app_iter), b'thebody')
+
+    def test_call_not_sampled(self):
+        import io
+        body = [b'the', b'body']
+        app = DummyReadingApp(body, '200 OK', [('Content-Length', '7')])
+        vlogger = FakeLogger()
+        tlogger = FakeLogger()
+        mw = self._makeOne(app, 0, 10, vlogger, tlogger,
+                           sampler=lambda environ: False)
+        stream = io.BytesIO(b'hello world')
+        environ = _makeEnviron({'wsgi.input': stream})
+        start_response = FakeStartResponse()
+        app_iter = mw(environ, start_response)
+        self.assertTrue(environ['wsgi.input'] is stream)
+        self.assertEqual(b''.join(app_iter), b'thebody')
+        self.assertEqual(start_response.status, '200 OK')
+        self.assertEqual(vlogger.logged, [])
+        self.assertEqual(len(mw.entries), 0)
+        self.assertEqual([line.split(' ') for line in tlogger.logged[1:]],
+                         [['B', str(mw.pid), str(id(environ)),
+                           tlogger.logged[1].split(' ')[3],
+                           'GET', 'http://localhost'],
+                          ['A', str(mw.pid), str(id(environ)),
+                           tlogger.logged[2].split(' ')[3], '200', '7'],
+                          ['F', str(mw.pid), str(id(environ)),
+                           tlogger.logged[3].split(' ')[3]],
+                          ['E', str(mw.pid), str(id(environ)),
+                           tlogger.logged[4].split(' ')[3], '7', '2',
+                           tlogger.logged[4].split(' ')[6]],
+                         ])
+
+    def test_call_closed_without_iterating(self):
+        # e.g. a HEAD request, or the server failing before sending a body
+        from repoze.debug.inflight import InflightRegistry
+        from repoze.debug.metrics import RequestCounters
+        iterable = DummyClosingIterable([b'the', b'body'])
+        app = DummyApp(iterable, '200 OK', [])
+        tlogger = FakeLogger()
+        counters = RequestCounters()
+        inflight = InflightRegistry()
+        mw = self._makeOne(app, 0, 10, None, tlogger, counters=counters,
+                           inflight=inflight)
+        app_iter = mw(_makeEnviron(), FakeStartResponse())
+        app_iter.close()
+        self.assertTrue(iterable.closed)
+        self.assertEqual(counters.in_flight, 0)
+        self.assertEqual(len(inflight), 0)
+        self.assertEqual(tlogger.logged[-1].split(' ')[0], 'E')
+        self.assertEqual(tlogger.logged[-1].split(' ')[4], '0')
+        self.assertTrue('end' in mw.entries[0]['response'])
+        # closing again, or iterating after the close, is harmless
+        app_iter.close()
+        self.assertEqual(list(app_iter), [])
+        self.assertEqual(counters.duration_count, 1)
+
+    def test_call_not_sampled_closed_without_iterating(self):
+        from repoze.debug.inflight import InflightRegistry
+        from repoze.debug.metrics import RequestCounters
+        iterable = DummyClosingIterable([b'the', b'body'])
+        app = DummyApp(iterable, '200 OK', [])
+        tlogger = FakeLogger()
+        counters = RequestCounters()
+        inflight = InflightRegistry()
+        mw = self._makeOne(app, 0, 10, None, tlogger, counters=counters,
+                           inflight=inflight, sampler=lambda environ: False)
+        app_iter = mw(_makeEnviron(), FakeStartResponse())
+        app_iter.close()
+        self.assertTrue(iterable.closed)
+        self.assertEqual(counters.in_flight, 0)
+        self.assertEqual(len(inflight), 0)
+        self.assertEqual(tlogger.logged[-1].split(' ')[0], 'E')
+        self.assertEqual(tlogger.logged[-1].split(' ')[4], '0')
+
+    def test_call_not_sampled_closed_early(self):
+        from repoze.debug.inflight import InflightRegistry
+        from repoze.debug.metrics import RequestCounters
+        iterable = DummyClosingIterable([b'the', b'body'])
+        app = DummyApp(iterable, '200 OK', [])
+        tlogger = FakeLogger()
+        counters = RequestCounters()
+        inflight = InflightRegistry()
+        mw = self._makeOne(app, 0, 10, None, tlogger, counters=counters,
+                           inflight=inflight, sampler=lambda environ: False)
+        app_iter = mw(_makeEnviron(), FakeStartResponse())
+        self.assertEqual(next(iter(app_iter)), b'the')
+        app_iter.close()
+        self.assertTrue(iterable.closed)
+        self.assertEqual(counters.in_flight, 0)
+        self.assertEqual(len(inflight), 0)
+        self.assertEqual(tlogger.logged[-1].split(' ')[0], 'E')
+        self.assertEqual(tlogger.logged[-1].split(' ')[4], '3')
+
+    def test_call_not_sampled_app_iter_raises(self):
+        from repoze.debug.metrics import RequestCounters
+        class RaisingIterable(DummyClosingIterable):
+            def __iter__(self):
+                yield b'the'
+                raise ValueError('broken')
+        iterable = RaisingIterable(None)
+        app = DummyApp(iterable, '200 OK', [])
+        tlogger = FakeLogger()
+        counters = RequestCounters()
+        mw = self._makeOne(app, 0, 10, None, tlogger, counters=counters,
+                           sampler=lambda environ: False)
+        app_iter = mw(_makeEnviron(), FakeStartResponse())
+        self.assertRaises(ValueError, list, app_iter)
+        self.assertTrue(iterable.closed)
+        self.assertEqual(counters.in_flight, 0)
+        # the request is left unfinished in the trace log
+        self.assertEqual([line.split(' ')[0] for line in tlogger.logged],
+                         ['U', 'B', 'A', 'F'])
+
+    def test_call_not_sampled_wo_trace_logger(self):
+        body = [b'thebody']
+        app = DummyApp(body, '200 OK', [])
+        mw = self._makeOne(app, 0, 10, FakeLogger(), None,
+                           sampler=lambda environ: False)
+        start_response = FakeStartResponse()
+        self.assertTrue(mw(_makeEnviron(), start_response) is body)
+
+    def test_call_not_sampled_start_response_not_called(self):
+        body = [b'thebody']
+        app = DummyBrokenApp(body, '200 OK', [])
+        tlogger = FakeLogger()
+        mw = self._makeOne(app, 0, 10, None, tlogger,
+                           sampler=lambda environ: False)
+        start_response = FakeStartResponse()
+        list(mw(_makeEnviron(), start_response))
+        self.assertTrue(tlogger.logged[2].endswith(' 500 None'))
+
+    def test_call_not_sampled_file_wrapper(self):
+        import io
+        from wsgiref.util import FileWrapper
+        wrapper = FileWrapper(io.BytesIO(b'thebody'))
+        app = DummyApp(wrapper, '200 OK', [('Content-Length', '7')])
+        tlogger = FakeLogger()
+        mw = self._makeOne(app, 0, 10, None, tlogger,
+                           sampler=lambda environ: False)
+        environ = _makeEnviron({'wsgi.file_wrapper': FileWrapper})
+        start_response = FakeStartResponse()
+        app_iter = mw(environ, start_response)
+        self.assertTrue(app_iter is wrapper)
+        self.assertEqual(len(tlogger.logged), 3)
+        app_iter.close()
+        self.assertTrue(tlogger.logged[3].startswith('E '))
+        self.assertTrue(tlogger.logged[3].endswith(' 7'))
+
+    def test_call_sampled(self):
+        body = [b'thebody']
+        app = DummyApp(body, '200 OK', [])
+        vlogger = FakeLogger()
+        mw = self._makeOne(app, 0, 10, vlogger, None,
+                           sampler=lambda environ: True)
+        start_response = FakeStartResponse()
+        b''.join(mw(_makeEnviron(), start_response))
+        self.assertEqual(len(vlogger.logged), 2)
+        self.assertEqual(len(mw.entries), 1)
+
+    def test_call_app_raises(self):
+        app = DummyRaisingApp()
+        vlogger = FakeLogger()
+        tlogger = FakeLogger()
+        mw = self._makeOne(app, 0, 10, vlogger, tlogger)
+        environ = _makeEnviron()
+        start_response = FakeStartResponse()
+        self.assertRaises(ValueError, mw, environ, start_response)
+        self.assertEqual(len(vlogger.logged), 2)
+        self.assertTrue('Exception:\nTraceback' in vlogger.logged[1])
+        response = mw.entries[0]['response']
+        self.assertEqual(response['status'], '500 Exception Raised')
+        self.assertTrue('ValueError' in response['exception'])
+        # the request remains unfinished in the trace log
+        self.assertEqual([line[0] for line in tlogger.logged], ['U', 'B'])
+
+    def test_call_app_iter_raises(self):
+        def app(environ, start_response):
+            start_response('200 OK', [])
+            def body():
+                yield b'the'
+                raise ValueError('broken')
+            return body()
+        vlogger = FakeLogger()
+        tlogger = FakeLogger()
+        mw = self._makeOne(app, 0, 10, vlogger, tlogger)
+        start_response = FakeStartResponse()
+        app_iter = mw(_makeEnviron(), start_response)
+        self.assertEqual(next(app_iter), b'the')
+        self.assertRaises(ValueError, next, app_iter)
+        response = mw.entries[0]['response']
+        self.assertEqual(response['status'], '200 OK')
+        self.assertEqual(response['body'], b'the')
+        self.assertTrue('broken' in response['exception'])
+        self.assertTrue('Exception:\nTraceback' in vlogger.logged[1])
+        self.assertEqual([line[0] for line in tlogger.logged],
+                         ['U', 'B', 'A', 'F'])
+
+    def test_call_app_iter_closed_early(self):
+        iterable = DummyClosingIterable([b'1', b'2'])
+        app = DummyApp(iterable, '200 OK', [])
+        tlogger = FakeLogger()
+        mw = self._makeOne(app, 0, 10, None, tlogger)
+        start_response = FakeStartResponse()
+        app_iter = mw(_makeEnviron(), start_response)
+        self.assertEqual(next(app_iter), b'1')
+        app_iter.close()
+        self.assertEqual(iterable.closed, True)
+        self.assertEqual(tlogger.logged[-1].split(' ')[0], 'E')
+        self.assertEqual(tlogger.logged[-1].split(' ')[4], '1')
+
+    def test_call_tail_fast_ok_not_kept(self):
+        from repoze.debug.sampling import TailPolicy
+        body = [b'thebody']
+        app = DummyApp(body, '200 OK', [])
+        vlogger = FakeLogger()
+        tlogger = FakeLogger()
+        mw = self._makeOne(app, 0, 10, vlogger, tlogger,
+                           tail=TailPolicy(60))
+        start_response = FakeStartResponse()
+        self.assertEqual(b''.join(mw(_makeEnviron(), start_response)),
+                         b'thebody')
+        self.assertEqual(vlogger.logged, [])
+        self.assertEqual(len(mw.entries), 0)
+        self.assertEqual([line[0] for line in tlogger.logged],
+                         ['U', 'B', 'A', 'F', 'E'])
+        self.assertEqual(tlogger.logged[-1].split(' ')[4:6], ['7', '1'])
+
+    def test_call_tail_error_status_kept(self):
+        from repoze.debug.sampling import TailPolicy
+        body = [b'thebody']
+        app = DummyReadingApp(body, '503 Service Unavailable', [])
+        vlogger = FakeLogger()
+        mw = self._makeOne(app, 0, 10, vlogger, None, tail=TailPolicy(60))
+        start_response = FakeStartResponse()
+        b''.join(mw(_makeEnviron(), start_response))
+        self.assertEqual(len(vlogger.logged), 2)
+        self.assertTrue('--- begin REQUEST' in vlogger.logged[0])
+        self.assertTrue('Request Body:\nhello world' in vlogger.logged[1])
+        self.assertEqual(len(mw.entries), 1)
+        self.assertEqual(mw.entries[0]['request']['body'], b'hello world')
+
+    def test_call_tail_slow_kept(self):
+        from repoze.debug.sampling import TailPolicy
+        body = [b'thebody']
+        app = DummyApp(body, '200 OK', [])
+        vlogger = FakeLogger()
+        mw = self._makeOne(app, 0, 10, vlogger, None, tail=TailPolicy(1.0))
+        start_response = FakeStartResponse()
+        mw._now = 1000.0
+        app_iter = mw(_makeEnviron(), start_response)
+        mw._now = 1002.0
+        b''.join(app_iter)
+        self.assertEqual(len(vlogger.logged), 2)
+        self.assertEqual(mw.entries[0]['response']['end'], 1002 * 10**9)
+
+    def test_call_tail_exception_kept(self):
+        from repoze.debug.sampling import TailPolicy
+        app = DummyRaisingApp()
+        vlogger = FakeLogger()
+        mw = self._makeOne(app, 0, 10, vlogger, None,
+                           tail=TailPolicy(60, None))
+        start_response = FakeStartResponse()
+        self.assertRaises(ValueError, mw, _makeEnviron(), start_response)
+        self.assertEqual(len(vlogger.logged), 2)
+        self.assertEqual(len(mw.entries), 1)
+
+    def test_capture_limit(self):
+        mw = self._makeOne(None, 0, 10, None, None, max_capture=100)
+        self.assertEqual(mw.capture_limit, 100)
+        mw.max_bodylen = 10
+        self.assertEqual(mw.capture_limit, 10)
+        mw.max_bodylen = 1000
+        self.assertEqual(mw.capture_limit, 100)
+        mw.max_capture = 0
+        self.assertEqual(mw.capture_limit, 1000)
 
     def test_call_keep_zero_doesnt_append_entry(self):
         body = [b'thebody']
@@ -162,6 +746,34 @@ class ResponseLoggingMiddlewareTests(unittest.TestCase):
         self.assertEqual(len(vlogger.logged), 2)
         self.assertFalse('WARNING-1' in vlogger.logged[1])
 
+    def test_call_input_captured_lazily(self):
+        body = [b'thebody']
+        app = DummyReadingApp(body, '200 OK', [])
+        vlogger = FakeLogger()
+        mw = self._makeOne(app, 5, 10, vlogger, None)
+        environ = _makeEnviron()
+        start_response = FakeStartResponse()
+        app_iter = mw(environ, start_response)
+        self.assertEqual(app.read, b'hello world')
+        self.assertEqual(b''.join(app_iter), b'thebody')
+        request = mw.entries[0]['request']
+        self.assertEqual(request['body'],
+                         b'hello ... (truncated at 5 bytes)')
+        self.assertEqual(request['bodylen'], 11)
+        self.assertTrue('Request Bodylen: 11' in vlogger.logged[1])
+
+    def test_call_input_not_read_by_app(self):
+        body = [b'thebody']
+        app = DummyApp(body, '200 OK', [])
+        mw = self._makeOne(app, 0, 10, None, None)
+        environ = _makeEnviron()
+        start_response = FakeStartResponse()
+        app_iter = mw(environ, start_response)
+        self.assertEqual(b''.join(app_iter), b'thebody')
+        self.assertEqual(environ['wsgi.input'].stream.tell(), 0)
+        self.assertEqual(mw.entries[0]['request']['body'], b'')
+        self.assertEqual(mw.entries[0]['request']['bodylen'], 0)
+
     def test_call_contentlengthmissing(self):
         import io
         body = [b'thebody']
@@ -203,9 +815,27 @@ class ResponseLoggingMiddlewareTests(unittest.TestCase):
         self.assertEqual(len(vlogger.logged), 2)
         self.assertTrue('URL: GET http://localhost' in vlogger.logged[1])
 
+    def test_entry_releases_request_objects(self):
+        import gc
+        import weakref
+        class Held(object):
+            pass
+        app = DummyApp([b'thebody'], '200 OK', [])
+        mw = self._makeOne(app, 0, 10, None, None)
+        held = Held()
+        ref = weakref.ref(held)
+        environ = _makeEnviron({'wsgi.held': held})
+        b''.join(mw(environ, FakeStartResponse()))
+        del held, environ
+        gc.collect()
+        self.assertEqual(ref(), None)
+        entry = mw.entries._entries[0]
+        self.assertTrue(entry['request'].environ['wsgi.held']
+                        .startswith('<'))
+
     def test_entry_created(self):
         body = [b'thebody']
-        app = DummyApp(body, '200 OK', [('Content-Length', '1')])
+        app = DummyReadingApp(body, '200 OK', [('Content-Length', '1')])
         vlogger = FakeLogger()
         tlogger = FakeLogger()
         mw = self._makeOne(app, 1, 10, vlogger, tlogger)
@@ -216,20 +846,33 @@ class ResponseLoggingMiddlewareTests(unittest.TestCase):
         self.assertEqual(len(mw.entries), 1)
         entry = mw.entries[0]
         self.assertEqual(entry['response']['status'], '200 OK')
-        self.assertTrue(isinstance(entry['request']['begin'], float))
-        self.assertTrue(isinstance(entry['response']['begin'], float))
-        self.assertTrue(isinstance(entry['response']['end'], float))
+        self.assertTrue(isinstance(entry['request']['begin'], int))
+        self.assertTrue(isinstance(entry['response']['begin'], int))
+        self.assertTrue(isinstance(entry['response']['end'], int))
         self.assertEqual(entry['response']['headers'],
-                         [('Content-Length', '1')])
+                         (('Content-Length', '1'),))
         self.assertEqual(entry['request']['url'], 'http://localhost')
-        self.assertEqual(entry['request']['body'], b'hello world')
+        self.assertEqual(entry['request']['body'],
+                         b'h ... (truncated at 1 bytes)')
+        self.assertEqual(entry['request']['bodylen'], 11)
         self.assertEqual(entry['response']['content-length'], 1)
         self.assertEqual(len(entry['request']['cgi_variables']), 2)
         self.assertEqual(len(entry['request']['wsgi_variables']), 2)
         self.assertEqual(entry['id'], id(environ))
 
+    def test_now_ns(self):
+        from repoze.debug import clock
+        mw = self._makeOne(None, 1, 10, None, None)
+        before = clock.now_ns()
+        now = mw.now_ns
+        self.assertTrue(isinstance(now, int))
+        self.assertTrue(before <= now <= clock.now_ns())
+        mw._now = 1000.25
+        self.assertEqual(mw.now_ns, 1000250000000)
+
     def test_trace_logging(self):
         import time
+        from repoze.debug.clock import to_ns
         body = [b'thebody']
         app = DummyApp(body, '200 OK', [('Content-Length', '7')])
         vlogger = FakeLogger()
@@ -241,12 +884,12 @@ class ResponseLoggingMiddlewareTests(unittest.TestCase):
         mw._now = now = time.time()
         app_iter = mw(environ, start_response)
         self.assertEqual(b''.join(app_iter), b'thebody')
-        self.assertEqual(len(tlogger.logged), 4)
+        self.assertEqual(len(tlogger.logged), 5)
         logged = tlogger.logged
         entry = mw.entries[0]
         rid = entry['id']
         begin = entry['request']['begin']
-        self.assertEqual(begin, now)
+        self.assertEqual(begin, to_ns(now))
 
         result = logged[0].split(' ', 4)
         self.assertEqual(result[0], 'U')
@@ -269,18 +912,46 @@ class ResponseLoggingMiddlewareTests(unittest.TestCase):
         self.assertEqual(result[4], '200 7')
 
         result = logged[3].split(' ', 4)
+        self.assertEqual(result[0], 'F')
+        self.assertEqual(result[1], str(mw.pid))
+        self.assertEqual(result[2], str(rid))
+        self.assertEqual(result[3], str(begin))
+
+        result = logged[4].split(' ', 4)
         self.assertEqual(result[0], 'E')
         self.assertEqual(result[1], str(mw.pid))
         self.assertEqual(result[2], str(rid))
         self.assertEqual(result[3], str(begin))
-        self.assertEqual(result[4], '7')
+        # bodylen, chunks, largest gap between chunks
+        self.assertEqual(result[4], '7 1 0')
+
+    def test_call_w_log_writer(self):
+        from repoze.debug.logwriter import AsyncLogWriter
+        body = [b'thebody']
+        app = DummyApp(body, '200 OK', [('Content-Length', '7')])
+        vlogger = FakeLogger()
+        tlogger = FakeLogger()
+        writer = AsyncLogWriter(100)
+        self.addCleanup(writer.close)
+        mw = self._makeOne(app, 0, 10, vlogger, tlogger, writer)
+        environ = _makeEnviron()
+        start_response = FakeStartResponse()
+        app_iter = mw(environ, start_response)
+        self.assertEqual(b''.join(app_iter), b'thebody')
+        writer.close()
+        verbose = '\n'.join(vlogger.logged)
+        self.assertTrue('--- begin REQUEST for' in verbose)
+        self.assertTrue('--- end RESPONSE for' in verbose)
+        lines = '\n'.join(tlogger.logged).splitlines()
+        self.assertEqual([line[0] for line in lines],
+                         ['U', 'B', 'A', 'F', 'E'])
 
 
 class Test_make_middleware(unittest.TestCase):
 
-    def _callFUT(self, app, global_conf, *args):
+    def _callFUT(self, app, global_conf, *args, **kw):
         from repoze.debug.responselogger import make_middleware
-        return make_middleware(app, global_conf, *args)
+        return make_middleware(app, global_conf, *args, **kw)
 
     def test_make_middleware_defaults(self):
         import tempfile
@@ -291,6 +962,12 @@ class Test_make_middleware(unittest.TestCase):
         self.assertEqual(mw.verbose_logger, None)
         self.assertEqual(mw.max_bodylen, 3072)
         self.assertEqual(mw.keep, 100)
+        self.assertEqual(mw.entries.keep, 100)
+        self.assertEqual(mw.entries.max_memory, 0)
+        self.assertEqual(mw.max_capture, 1024 * 1024)
+        self.assertEqual(mw.sampler, None)
+        self.assertEqual(mw.tail, None)
+        self.assertEqual(mw.latency, None)
 
     def test_make_middleware_nondefaults(self):
         import tempfile
@@ -306,6 +983,436 @@ class Test_make_middleware(unittest.TestCase):
         mw.verbose_logger.handlers[0].close()
         mw.trace_logger.handlers[0].close()
 
+    def test_make_middleware_w_log_queue(self):
+        from repoze.debug.logwriter import AsyncLogWriter
+        app = DummyApp(None, None, None)
+        mw = self._callFUT(
+            app, {}, None, None, '3KB', '100MB', '10', '100', '500', 'block')
+        self.assertTrue(isinstance(mw.log_writer, AsyncLogWriter))
+        self.assertEqual(mw.log_writer.queue.maxsize, 500)
+        self.assertEqual(mw.log_writer.overflow, 'block')
+
+    def test_make_middleware_w_sampling(self):
+        from repoze.debug.sampling import RequestSampler
+        app = DummyApp(None, None, None)
+        mw = self._callFUT(app, {}, None, None, '3KB', '100MB', '10', '100',
+                           '0', 'drop', '0', '1MB', '10',
+                           '/static 0\n/api 2', 'POST PUT',
+                           '^/admin/\n\\.json$')
+        sampler = mw.sampler
+        self.assertTrue(isinstance(sampler, RequestSampler))
+        self.assertEqual(sampler.rate, 10)
+        self.assertEqual([x[:2] for x in sampler.path_rates],
+                         [('/static', 0), ('/api', 2)])
+        self.assertEqual(sampler.always_methods, frozenset(['POST', 'PUT']))
+        self.assertEqual([x.pattern for x in sampler.always_urls],
+                         ['^/admin/', '\\.json$'])
+
+    def test_make_middleware_w_tail_capture(self):
+        from repoze.debug.sampling import TailPolicy
+        app = DummyApp(None, None, None)
+        mw = self._callFUT(app, {}, None, None, '3KB', '100MB', '10', '100',
+                           '0', 'drop', '0', '1MB', '1', '', '', '',
+                           'true', '0.5', '400')
+        self.assertTrue(isinstance(mw.tail, TailPolicy))
+        self.assertEqual(mw.tail.latency, 0.5)
+        self.assertEqual(mw.tail.status, 400)
+
+    def test_make_middleware_w_tail_capture_wo_latency(self):
+        app = DummyApp(None, None, None)
+        mw = self._callFUT(app, {}, None, None, '3KB', '100MB', '10', '100',
+                           '0', 'drop', '0', '1MB', '1', '', '', '', 'yes')
+        self.assertEqual(mw.tail.latency, None)
+        self.assertEqual(mw.tail.status, 500)
+
+    def test_make_middleware_w_tail_capture_empty_status_zero_latency(self):
+        app = DummyApp(None, None, None)
+        mw = self._callFUT(app, {}, None, None, '3KB', '100MB', '10', '100',
+                           '0', 'drop', '0', '1MB', '1', '', '', '',
+                           'true', '0', ' ')
+        self.assertEqual(mw.tail.latency, 0.0)
+        self.assertEqual(mw.tail.status, None)
+
+    def test_make_middleware_w_max_memory(self):
+        app = DummyApp(None, None, None)
+        mw = self._callFUT(app, {}, None, None, '3KB', '100MB', '10', '100',
+                           '0', 'drop', '10MB')
+        self.assertEqual(mw.entries.max_memory, 10 * 1024 * 1024)
+
+    def test_make_middleware_wo_log_queue(self):
+        app = DummyApp(None, None, None)
+        mw = self._callFUT(app, {})
+        self.assertEqual(mw.log_writer, None)
+
+    def test_make_middleware_w_binary_trace_format(self):
+        import os
+        import tempfile
+        from repoze.debug.tracelog import BinaryTraceLog
+        from repoze.debug.tracelog import MAGIC
+        app = DummyApp(None, None, None)
+        tfn = tempfile.mktemp()
+        try:
+            mw = self._callFUT(app, {}, None, tfn, trace_format='binary')
+            self.assertTrue(isinstance(mw.trace_logger, BinaryTraceLog))
+            mw.trace_logger.close()
+            with open(tfn, 'rb') as f:
+                self.assertEqual(f.read(), MAGIC)
+        finally:
+            os.remove(tfn)
+
+    def test_make_middleware_w_shared_entries(self):
+        import os
+        import tempfile
+        from repoze.debug.entries import SharedEntryStore
+        app = DummyApp(None, None, None)
+        fn = tempfile.mktemp()
+        try:
+            mw = self._callFUT(app, {}, keep='5', shared_entries=fn,
+                               shared_entry_size='8KB')
+            self.assertTrue(isinstance(mw.entries, SharedEntryStore))
+            self.assertEqual(mw.entries.keep, 5)
+            self.assertEqual(mw.entries.slot_size, 8192)
+            mw.entries.close()
+        finally:
+            os.remove(fn)
+
+    def test_make_middleware_w_latency_routes(self):
+        app = DummyApp(None, None, None)
+        mw = self._callFUT(app, {}, latency_routes='20')
+        self.assertEqual(mw.latency.max_routes, 20)
+
+    def test_make_middleware_wo_latency(self):
+        app = DummyApp(None, None, None)
+        mw = self._callFUT(app, {}, latency_routes='0')
+        self.assertEqual(mw.latency, None)
+
+    def test_make_middleware_not_sampled_passes_through(self):
+        body = [b'thebody']
+        app = DummyApp(body, '200 OK', [])
+        mw = self._callFUT(app, {}, sample_rate='0')
+        self.assertTrue(mw(_makeEnviron(), FakeStartResponse()) is body)
+
+    def test_make_middleware_w_metrics(self):
+        from repoze.debug.metrics import RequestCounters
+        app = DummyApp(None, None, None)
+        self.assertEqual(self._callFUT(app, {}).counters, None)
+        mw = self._callFUT(app, {}, metrics='true')
+        self.assertTrue(isinstance(mw.counters, RequestCounters))
+
+    def test_make_middleware_w_watchdog(self):
+        import os
+        import tempfile
+        from repoze.debug.inflight import default_registry
+        app = DummyApp(None, None, None)
+        mw = self._callFUT(app, {})
+        self.assertEqual(mw.inflight, None)
+        self.assertEqual(mw.watchdog, None)
+        tempdir = tempfile.mkdtemp()
+        mw = self._callFUT(app, {}, os.path.join(tempdir, 'verbose.log'),
+                           watchdog_threshold='30', watchdog_interval='2',
+                           watchdog_repeat='60')
+        try:
+            self.assertTrue(mw.inflight is default_registry)
+            watchdog = mw.watchdog
+            self.assertTrue(watchdog.registry is mw.inflight)
+            self.assertEqual(watchdog.threshold, 30.0)
+            self.assertEqual(watchdog.interval, 2.0)
+            self.assertEqual(watchdog.repeat, 60.0)
+            self.assertEqual(watchdog.report, mw.log_stuck_request)
+            self.assertEqual(watchdog.thread, None) # started lazily
+        finally:
+            mw.verbose_logger.handlers[0].close()
+            import shutil
+            shutil.rmtree(tempdir)
+
+    def test_make_middleware_w_inflight(self):
+        from repoze.debug.inflight import default_registry
+        app = DummyApp(None, None, None)
+        mw = self._callFUT(app, {}, inflight='true')
+        self.assertTrue(mw.inflight is default_registry)
+        self.assertEqual(mw.watchdog, None)
+
+    def test_make_middleware_w_watchdog_wo_verbose_log(self):
+        app = DummyApp(None, None, None)
+        self.assertRaises(ValueError, self._callFUT, app, {},
+                          watchdog_threshold='30')
+
+    def test_make_middleware_w_bad_trace_format(self):
+        app = DummyApp(None, None, None)
+        self.assertRaises(ValueError, self._callFUT, app, {},
+                          trace_format='xml')
+
+
+class ResponseIteratorTests(unittest.TestCase):
+
+    def _getTargetClass(self):
+        from repoze.debug.responselogger import ResponseIterator
+        return ResponseIterator
+
+    def _makeOne(self, body):
+        self.fed = []
+        self.finished = []
+        return self._getTargetClass()(body, self.fed.append,
+                                      self.finished.append)
+
+    def test_exhausted(self):
+        app_iter = self._makeOne([b'a', b'b'])
+        self.assertEqual(list(app_iter), [b'a', b'b'])
+        self.assertEqual(self.fed, [b'a', b'b'])
+        self.assertEqual(self.finished, [False])
+        app_iter.close()
+        self.assertEqual(self.finished, [False])
+
+    def test_raises(self):
+        def body():
+            yield b'a'
+            raise ValueError('broken')
+        app_iter = self._makeOne(body())
+        self.assertRaises(ValueError, list, app_iter)
+        self.assertEqual(self.fed, [b'a'])
+        self.assertEqual(self.finished, [True])
+
+    def test_close_before_iterating(self):
+        body = DummyClosingIterable([b'a'])
+        app_iter = self._makeOne(body)
+        app_iter.close()
+        self.assertEqual(self.finished, [False])
+        self.assertEqual(list(app_iter), [])
+        self.assertEqual(self.fed, [])
+
+
+class Test_optional(unittest.TestCase):
+
+    def _callFUT(self, convert, value):
+        from repoze.debug.responselogger import optional
+        return optional(convert, value)
+
+    def test_unset(self):
+        for value in (None, '', '  '):
+            self.assertEqual(self._callFUT(int, value), None)
+
+    def test_set(self):
+        self.assertEqual(self._callFUT(int, ' 0 '), 0)
+        self.assertEqual(self._callFUT(float, 0), 0.0)
+        self.assertRaises(ValueError, self._callFUT, int, 'bogus')
+
+
+class ChunkTimerTests(unittest.TestCase):
+
+    def _getTargetClass(self):
+        from repoze.debug.responselogger import ChunkTimer
+        return ChunkTimer
+
+    def _makeOne(self):
+        return self._getTargetClass()()
+
+    def test_ctor(self):
+        timer = self._makeOne()
+        self.assertEqual(timer.first, None)
+        self.assertEqual(timer.chunks, 0)
+        self.assertEqual(timer.max_gap, 0.0)
+
+    def test_tick(self):
+        timer = self._makeOne()
+        self.assertTrue(timer.tick(10.0))
+        self.assertFalse(timer.tick(10.5))
+        self.assertFalse(timer.tick(12.5))
+        self.assertFalse(timer.tick(13.0))
+        self.assertEqual(timer.first, 10.0)
+        self.assertEqual(timer.chunks, 4)
+        self.assertEqual(timer.max_gap, 2.0)
+
+
+class BodyCaptureTests(unittest.TestCase):
+
+    def _getTargetClass(self):
+        from repoze.debug.responselogger import BodyCapture
+        return BodyCapture
+
+    def _makeOne(self, limit):
+        return self._getTargetClass()(limit)
+
+    def test_unlimited(self):
+        capture = self._makeOne(0)
+        for chunk in (b'abc', b'', b'def'):
+            capture.feed(chunk)
+        self.assertEqual(capture.getvalue(), b'abcdef')
+        self.assertEqual(capture.logvalue(), b'abcdef')
+        self.assertEqual(capture.bodylen, 6)
+        self.assertFalse(capture.truncated)
+
+    def test_limited_keeps_whole_chunks_by_reference(self):
+        chunk = b'abc'
+        capture = self._makeOne(4)
+        capture.feed(chunk)
+        self.assertTrue(capture.chunks[0] is chunk)
+
+    def test_limited_stops_copying_at_cap(self):
+        capture = self._makeOne(4)
+        for chunk in (b'abc', b'def', b'ghi'):
+            capture.feed(chunk)
+        self.assertEqual(capture.chunks, [b'abc', b'd'])
+        self.assertEqual(capture.captured, 4)
+        self.assertEqual(capture.bodylen, 9)
+        self.assertTrue(capture.truncated)
+        self.assertEqual(capture.logvalue(),
+                         b'abcd ... (truncated at 4 bytes)')
+
+    def test_limited_exact(self):
+        capture = self._makeOne(3)
+        capture.feed(b'abc')
+        capture.feed(b'')
+        self.assertFalse(capture.truncated)
+        self.assertEqual(capture.logvalue(), b'abc')
+
+
+class TeeInputTests(unittest.TestCase):
+
+    def _getTargetClass(self):
+        from repoze.debug.responselogger import TeeInput
+        return TeeInput
+
+    def _makeOne(self, data, max_bodylen):
+        import io
+        return self._getTargetClass()(io.BytesIO(data), max_bodylen)
+
+    def test_read_unlimited(self):
+        tee = self._makeOne(b'hello world', 0)
+        self.assertEqual(tee.read(5), b'hello')
+        self.assertEqual(tee.read(), b' world')
+        self.assertEqual(tee.capture.getvalue(), b'hello world')
+        self.assertEqual(tee.capture.bodylen, 11)
+        self.assertFalse(tee.capture.truncated)
+
+    def test_read_capped(self):
+        tee = self._makeOne(b'hello world', 4)
+        self.assertEqual(tee.read(3), b'hel')
+        self.assertEqual(tee.read(3), b'lo ')
+        self.assertEqual(tee.read(), b'world')
+        self.assertEqual(tee.capture.getvalue(), b'hell')
+        self.assertEqual(tee.capture.bodylen, 11)
+        self.assertTrue(tee.capture.truncated)
+
+    def test_read_exactly_cap(self):
+        tee = self._makeOne(b'hello', 5)
+        self.assertEqual(tee.read(), b'hello')
+        self.assertEqual(tee.read(), b'')
+        self.assertFalse(tee.capture.truncated)
+
+    def test_readline_readlines_and_iter(self):
+        tee = self._makeOne(b'a\nb\nc\nd\n', 0)
+        self.assertEqual(tee.readline(), b'a\n')
+        self.assertEqual(tee.readlines(1), [b'b\n'])
+        self.assertEqual(list(tee), [b'c\n', b'd\n'])
+        self.assertEqual(tee.capture.getvalue(), b'a\nb\nc\nd\n')
+        self.assertEqual(tee.capture.bodylen, 8)
+
+    def test_delegates_other_attributes(self):
+        tee = self._makeOne(b'hello', 0)
+        tee.read()
+        tee.seek(0)
+        self.assertEqual(tee.stream.tell(), 0)
+
+
+class RequestInfoTests(unittest.TestCase):
+
+    def _getTargetClass(self):
+        from repoze.debug.responselogger import RequestInfo
+        return RequestInfo
+
+    def _makeOne(self, middleware, environ):
+        klass = self._getTargetClass()
+        return klass(middleware, environ)
+
+    def test_ctor_copies_environ(self):
+        environ = _makeEnviron({'PATH_INFO': '/'})
+        info = self._makeOne(DummyMiddleware(object()), environ)
+        environ['PATH_INFO'] = '/changed'
+        self.assertEqual(info.environ['PATH_INFO'], '/')
+        self.assertEqual(len(info), 0)
+
+    def test_url_computed_on_demand(self):
+        info = self._makeOne(DummyMiddleware(object()), _makeEnviron())
+        self.assertFalse('url' in info)
+        self.assertEqual(info['url'], 'http://localhost')
+        self.assertTrue('url' in info)
+        self.assertFalse('cgi_variables' in info)
+        self.assertTrue(info.environ is not None)
+
+    def test_variables_computed_on_demand(self):
+        app = object()
+        environ = _makeEnviron({'HTTP_HOST': 'example.com',
+                                'repoze.debug.foo': 1,
+                                'wsgi.foo': 2})
+        info = self._makeOne(DummyMiddleware(app), environ)
+        wsgi_variables = info['wsgi_variables']
+        self.assertEqual(wsgi_variables,
+                         [('application', app),
+                          ('wsgi process', 'Multithreaded'),
+                          ('wsgi.foo', 2)])
+        cgi_variables = info.get('cgi_variables')
+        self.assertEqual([x[0] for x in cgi_variables],
+                         sorted([x[0] for x in cgi_variables]))
+        self.assertTrue(('HTTP_HOST', 'example.com') in cgi_variables)
+        self.assertEqual(info['url'], 'http://example.com')
+        self.assertEqual(info.environ, None)
+        self.assertTrue(info['cgi_variables'] is cgi_variables)
+
+    def test_release_environ(self):
+        held = object()
+        environ = _makeEnviron({'HTTP_HOST': 'example.com',
+                                'paste.config': {'a': 1},
+                                'wsgi.foo': held})
+        info = self._makeOne(DummyMiddleware(object()), environ)
+        info.release()
+        self.assertEqual(info.environ['HTTP_HOST'], 'example.com')
+        self.assertEqual(info.environ['wsgi.foo'], repr(held))
+        self.assertEqual(info.environ['wsgi.version'], (1, 0))
+        self.assertFalse('wsgi.input' in info.environ)
+        self.assertFalse('paste.config' in info.environ)
+        self.assertTrue(('wsgi.foo', repr(held)) in info['wsgi_variables'])
+
+    def test_release_computed_variables(self):
+        held = object()
+        info = self._makeOne(DummyMiddleware(object()),
+                             _makeEnviron({'wsgi.foo': held}))
+        info['wsgi_variables']
+        info.release()
+        self.assertTrue(('wsgi.foo', repr(held)) in info['wsgi_variables'])
+
+    def test_release_while_computing(self):
+        # another thread computes the variables from the environ it read
+        # before the release
+        held = object()
+        info = self._makeOne(DummyMiddleware(object()),
+                             _makeEnviron({'wsgi.foo': held}))
+        environ = info.environ
+        info.release()
+        info._compute_variables(environ)
+        self.assertTrue(('wsgi.foo', repr(held)) in info['wsgi_variables'])
+
+    def test_other_keys(self):
+        info = self._makeOne(DummyMiddleware(object()), _makeEnviron())
+        self.assertRaises(KeyError, info.__getitem__, 'headers')
+        self.assertEqual(info.get('headers'), None)
+        self.assertEqual(info.get('headers', ()), ())
+
+    def test_not_computed_wo_loggers_or_entries(self):
+        app = DummyApp([b'thebody'], '200 OK', [])
+        from repoze.debug.responselogger import ResponseLoggingMiddleware
+        mw = ResponseLoggingMiddleware(app, 0, 0, None, None)
+        environ = _makeEnviron()
+        infos = []
+        orig = mw.get_request_info
+        def get_request_info(environ):
+            info = orig(environ)
+            infos.append(info)
+            return info
+        mw.get_request_info = get_request_info
+        b''.join(mw(environ, FakeStartResponse()))
+        for key in ('url', 'cgi_variables', 'wsgi_variables'):
+            self.assertFalse(key in infos[0])
+
 
 class SupplementTests(unittest.TestCase):
 
@@ -653,6 +1760,33 @@ class DummyApp(object):
         return self.body
 
 
+class DummyReadingApp(DummyApp):
+
+    def __call__(self, environ, start_response):
+        self.read = environ['wsgi.input'].read()
+        return DummyApp.__call__(self, environ, start_response)
+
+
+class DummyRaisingApp(object):
+
+    def __call__(self, environ, start_response):
+        raise ValueError('broken')
+
+
+class DummyClosingIterable(object):
+
+    closed = False
+
+    def __init__(self, data):
+        self.data = data
+
+    def __iter__(self):
+        return iter(self.data)
+
+    def close(self):
+        self.closed = True
+
+
 class DummyBrokenApp(DummyApp):
 
     def __call__(self,environ, start_response):
@@ -660,6 +1794,19 @@ class DummyBrokenApp(DummyApp):
         return self.body
 
 
+class DummyEntries(object):
+
+    def __init__(self):
+        self.appended = []
+        self.updated = []
+
+    def append(self, entry):
+        self.appended.append(entry)
+
+    def update(self, entry):
+        self.updated.append(entry)
+
+
 class DummyMiddleware(object):
 
     def __init__(self, application):
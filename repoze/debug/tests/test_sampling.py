@@ -0,0 +1,115 @@
+import unittest
+
+
+class RequestSamplerTests(unittest.TestCase):
+
+    def _getTargetClass(self):
+        from repoze.debug.sampling import RequestSampler
+        return RequestSampler
+
+    def _makeOne(self, *arg, **kw):
+        return self._getTargetClass()(*arg, **kw)
+
+    def _sample(self, sampler, n, **environ):
+        environ.setdefault('PATH_INFO', '/')
+        return [sampler(environ) for i in range(n)]
+
+    def test_defaults_capture_everything(self):
+        sampler = self._makeOne()
+        self.assertEqual(self._sample(sampler, 3), [True, True, True])
+
+    def test_rate_zero_captures_nothing(self):
+        sampler = self._makeOne(0)
+        self.assertEqual(self._sample(sampler, 3), [False, False, False])
+
+    def test_one_in_n(self):
+        sampler = self._makeOne(3)
+        self.assertEqual(self._sample(sampler, 7),
+                         [True, False, False, True, False, False, True])
+
+    def test_path_rates_longest_prefix_wins(self):
+        sampler = self._makeOne(1, [('/api', 2), ('/api/health', 0)])
+        self.assertEqual(self._sample(sampler, 2, PATH_INFO='/api/health'),
+                         [False, False])
+        self.assertEqual(self._sample(sampler, 4, PATH_INFO='/api/users'),
+                         [True, False, True, False])
+        self.assertEqual(self._sample(sampler, 2, PATH_INFO='/other'),
+                         [True, True])
+
+    def test_path_rates_include_script_name(self):
+        sampler = self._makeOne(1, [('/app/static', 0)])
+        self.assertEqual(self._sample(sampler, 1, SCRIPT_NAME='/app',
+                                      PATH_INFO='/static/x.css'), [False])
+
+    def test_always_methods(self):
+        sampler = self._makeOne(0, always_methods=['post'])
+        self.assertEqual(self._sample(sampler, 2, REQUEST_METHOD='POST'),
+                         [True, True])
+        self.assertEqual(self._sample(sampler, 1, REQUEST_METHOD='GET'),
+                         [False])
+
+    def test_always_urls(self):
+        sampler = self._makeOne(0, always_urls=[r'^/admin/', r'\.json$'])
+        self.assertEqual(self._sample(sampler, 1, PATH_INFO='/admin/users'),
+                         [True])
+        self.assertEqual(self._sample(sampler, 1, PATH_INFO='/a/b.json'),
+                         [True])
+        self.assertEqual(self._sample(sampler, 1, PATH_INFO='/a/b.html'),
+                         [False])
+
+
+class Test_parse_path_rates(unittest.TestCase):
+
+    def _callFUT(self, value):
+        from repoze.debug.sampling import parse_path_rates
+        return parse_path_rates(value)
+
+    def test_empty(self):
+        self.assertEqual(self._callFUT(''), [])
+
+    def test_multiple_lines(self):
+        self.assertEqual(self._callFUT('\n  /static 0\n\n  /api 10\n'),
+                         [('/static', 0), ('/api', 10)])
+
+    def test_bad_line(self):
+        self.assertRaises(ValueError, self._callFUT, '/static')
+        self.assertRaises(ValueError, self._callFUT, '/static often')
+
+
+class TailPolicyTests(unittest.TestCase):
+
+    def _getTargetClass(self):
+        from repoze.debug.sampling import TailPolicy
+        return TailPolicy
+
+    def _makeOne(self, *arg, **kw):
+        return self._getTargetClass()(*arg, **kw)
+
+    def test_defaults(self):
+        policy = self._makeOne()
+        self.assertFalse(policy(100.0, '200 OK'))
+        self.assertFalse(policy(0.1, '404 Not Found'))
+        self.assertTrue(policy(0.1, '500 Internal Server Error'))
+        self.assertTrue(policy(0.1, '503 Service Unavailable'))
+
+    def test_exception(self):
+        policy = self._makeOne(status=None)
+        self.assertTrue(policy(0.1, '200 OK', True))
+
+    def test_latency(self):
+        policy = self._makeOne(1.5)
+        self.assertFalse(policy(1.4, '200 OK'))
+        self.assertTrue(policy(1.5, '200 OK'))
+
+    def test_status(self):
+        policy = self._makeOne(status=400)
+        self.assertFalse(policy(0.1, '302 Found'))
+        self.assertTrue(policy(0.1, '404 Not Found'))
+
+    def test_status_disabled(self):
+        policy = self._makeOne(status=None)
+        self.assertFalse(policy(0.1, '500 Internal Server Error'))
+
+    def test_bogus_status(self):
+        policy = self._makeOne()
+        self.assertTrue(policy(0.1, 'bogus'))
@@ -64,6 +64,271 @@ class Test_dump_threads(_Base):
                 """ in publish\\n']""")
         self.assertEqual(lines[4], "End of dump")
 
+    def test_w_inflight_longest_running_first(self):
+        import re
+        import threading
+        from repoze.debug import clock
+        from repoze.debug.inflight import InflightRegistry
+        from repoze.debug.inflight import InflightRequest
+        event = threading.Event()
+        threads = [threading.Thread(target=event.wait) for i in range(3)]
+        for t in threads:
+            t.start()
+        registry = InflightRegistry()
+        now = clock.now()
+        for request_id, t, elapsed in ((1, threads[0], 5), (2, threads[1], 50)):
+            registry.requests[request_id] = InflightRequest(
+                request_id, t.ident, 'GET',
+                {'url': 'http://localhost/%d' % request_id}, now - elapsed)
+        try:
+            dump = self._dump(registry)
+        finally:
+            event.set()
+            for t in threads:
+                t.join()
+        headers = [line for line in dump.splitlines()
+                   if line.startswith('Thread ')]
+        self.assertTrue(re.match(
+            r'Thread %s \(request 2:  GET http://localhost/2, running for '
+            r'50\.\d\d seconds\):$' % threads[1].ident, headers[0]))
+        self.assertTrue(re.match(
+            r'Thread %s \(request 1:  GET http://localhost/1, running for '
+            r'5\.\d\d seconds\):$' % threads[0].ident, headers[1]))
+        self.assertTrue('Thread %s:' % threads[2].ident in headers)
+
+    def _dump(self, inflight):
+        from ..threads import dump_threads
+        return dump_threads(inflight=inflight)
+
+
+class _Frame(object):
+
+    def __init__(self, filename, name, lineno, back=None):
+        self.f_code = _Code(filename, name)
+        self.f_lineno = lineno
+        self.f_back = back
+
+class _Code(object):
+    # code objects compare by identity, like the real ones in one frame walk
+    _codes = {}
+
+    def __new__(cls, filename, name):
+        code = cls._codes.get((filename, name))
+        if code is None:
+            code = cls._codes[(filename, name)] = object.__new__(cls)
+            code.co_filename = filename
+            code.co_name = name
+        return code
+
+def _dummyFrames():
+    def worker():
+        return _Frame('/usr/lib/python3/threading.py', 'wait', 300,
+                      _Frame('/usr/lib/python3/queue.py', 'get', 170,
+                             _Frame('/srv/app/pool.py', 'work', 12)))
+    busy = _Frame('/srv/app/views.py', 'render', 88,
+                  _Frame('/srv/app/pool.py', 'work', 14))
+    return {1: worker(), 2: busy, 3: worker(), 4: worker(), 9: object()}
+
+
+class Test_walk_stack(unittest.TestCase):
+
+    def _callFUT(self, frame):
+        from ..threads import walk_stack
+        return walk_stack(frame)
+
+    def test_outermost_first(self):
+        frame = _Frame('b.py', 'inner', 2, _Frame('a.py', 'outer', 1))
+        stack = self._callFUT(frame)
+        self.assertEqual([(code.co_name, lineno) for code, lineno in stack],
+                         [('outer', 1), ('inner', 2)])
+
+    def test_real_frame(self):
+        import sys
+        stack = self._callFUT(sys._getframe())
+        self.assertEqual(stack[-1][0].co_name, 'test_real_frame')
+
+    def test_max_depth(self):
+        from ..profiler import MAX_DEPTH
+        frame = None
+        for i in range(MAX_DEPTH + 10):
+            frame = _Frame('a.py', 'f', i, frame)
+        stack = self._callFUT(frame)
+        self.assertEqual(len(stack), MAX_DEPTH)
+        self.assertEqual(stack[-1][1], MAX_DEPTH + 9)
+
+
+class StackGroupTests(unittest.TestCase):
+
+    def _makeOne(self, frame):
+        from ..threads import StackGroup
+        from ..threads import walk_stack
+        return StackGroup(walk_stack(frame))
+
+    def test_idle(self):
+        self.assertTrue(self._makeOne(_dummyFrames()[1]).idle)
+        self.assertFalse(self._makeOne(_dummyFrames()[2]).idle)
+        self.assertFalse(self._makeOne(None).idle)
+
+    def test_frames(self):
+        group = self._makeOne(_dummyFrames()[2])
+        self.assertEqual(group.frames(),
+                         [('/srv/app/pool.py', 14, 'work'),
+                          ('/srv/app/views.py', 88, 'render')])
+
+
+class Test_group_threads(unittest.TestCase):
+
+    def _callFUT(self, frames=None, thread_id=None, names=None):
+        from ..threads import group_threads
+        return group_threads(frames, thread_id, names)
+
+    def test_groups_identical_stacks(self):
+        groups = self._callFUT(_dummyFrames(), 9, {1: 'Worker-1', 2: 'W2'})
+        self.assertEqual(len(groups), 2)
+        self.assertEqual(groups[0].threads,
+                         [(1, 'Worker-1'), (3, None), (4, None)])
+        self.assertTrue(groups[0].idle)
+        self.assertEqual(groups[1].threads, [(2, 'W2')])
+        self.assertFalse(groups[1].idle)
+
+    def test_running_threads(self):
+        import threading
+        event = threading.Event()
+        t = threading.Thread(target=event.wait, name='waiter')
+        t.start()
+        try:
+            groups = self._callFUT()
+        finally:
+            event.set()
+            t.join()
+        names = [name for group in groups for tid, name in group.threads]
+        self.assertTrue('waiter' in names)
+        for group in groups:
+            if ('waiter' in [name for tid, name in group.threads]):
+                self.assertTrue(group.idle)
+
+
+class Test_group_threads_w_inflight(unittest.TestCase):
+
+    def _callFUT(self, inflight):
+        from ..threads import group_threads
+        return group_threads(_dummyFrames(), 9, {}, inflight)
+
+    def _makeRegistry(self, *requests):
+        from repoze.debug.inflight import InflightRegistry
+        from repoze.debug.inflight import InflightRequest
+        registry = InflightRegistry()
+        for request_id, thread_id, begin in requests:
+            registry.requests[request_id] = InflightRequest(
+                request_id, thread_id, 'GET', {}, begin)
+        return registry
+
+    def test_longest_running_first(self):
+        registry = self._makeRegistry((10, 2, 20.0), (11, 4, 15.0),
+                                      (12, 3, 10.0))
+        groups = self._callFUT(registry)
+        self.assertEqual(groups[0].threads, [(3, None), (4, None), (1, None)])
+        self.assertEqual(groups[0].begin, 10.0)
+        self.assertEqual(sorted(groups[0].requests), [3, 4])
+        self.assertEqual(groups[1].threads, [(2, None)])
+        self.assertEqual(groups[1].requests[2].request_id, 10)
+
+    def test_busy_group_first(self):
+        groups = self._callFUT(self._makeRegistry((10, 2, 20.0)))
+        self.assertEqual(groups[0].threads, [(2, None)])
+        self.assertEqual(groups[1].begin, None)
+
+
+class Test_dump_stacks(_Base):
+
+    def _callFUT(self, format='compact', idle=True):
+        return self._dump(format, idle, _dummyFrames(), 9, {1: 'Worker-1'})
+
+    def _dump(self, *arg):
+        from ..threads import dump_stacks
+        return dump_stacks(*arg)
+
+    def setUp(self):
+        import datetime
+        self._setNOW(datetime.datetime(2013, 11, 21, 21, 5, 37))
+
+    def test_compact(self):
+        lines = self._callFUT().splitlines()
+        self.assertEqual(lines, [
+            'Threads stack dump at 2013-11-21 21:05:37:  4 threads, 2 stacks',
+            '',
+            '3 threads (idle):  Worker-1 (1), 3, 4',
+            '  /srv/app/pool.py:12 in work',
+            '  /usr/lib/python3/queue.py:170 in get',
+            '  /usr/lib/python3/threading.py:300 in wait',
+            '',
+            '1 thread:  2',
+            '  /srv/app/pool.py:14 in work',
+            '  /srv/app/views.py:88 in render',
+            '',
+            'End of dump',
+            ])
+
+    def test_compact_wo_idle(self):
+        lines = self._callFUT(idle=False).splitlines()
+        self.assertEqual(lines[0],
+                         'Threads stack dump at 2013-11-21 21:05:37:  '
+                         '4 threads, 1 stacks (3 idle threads hidden)')
+        self.assertEqual(lines[2], '1 thread:  2')
+        self.assertEqual(len(lines), 7)
+
+    def test_json(self):
+        import json
+        dump = json.loads(self._callFUT('json', idle=False))
+        self.assertEqual(dump, {
+            'time': '2013-11-21 21:05:37',
+            'threads': 4,
+            'hidden': 3,
+            'stacks': [{
+                'count': 1,
+                'idle': False,
+                'threads': [{'id': 2, 'name': None, 'request': None}],
+                'frames': [{'file': '/srv/app/pool.py', 'line': 14,
+                            'function': 'work'},
+                           {'file': '/srv/app/views.py', 'line': 88,
+                            'function': 'render'}],
+                }],
+            })
+
+    def _makeRegistry(self):
+        from repoze.debug import clock
+        from repoze.debug.inflight import InflightRegistry
+        from repoze.debug.inflight import InflightRequest
+        registry = InflightRegistry()
+        registry.requests[10] = InflightRequest(
+            10, 2, 'POST', {'url': 'http://localhost/slow'}, clock.now() - 30)
+        return registry
+
+    def test_compact_w_inflight(self):
+        import re
+        lines = self._dump('compact', True, _dummyFrames(), 9, {},
+                           self._makeRegistry()).splitlines()
+        self.assertEqual(lines[2], '1 thread:  2')
+        self.assertTrue(re.match(r'  \* 2 serving request 10:  POST '
+                                 r'http://localhost/slow, running for '
+                                 r'30\.\d\d seconds$', lines[3]))
+        self.assertEqual(lines[4], '  /srv/app/pool.py:14 in work')
+
+    def test_json_w_inflight(self):
+        import json
+        dump = json.loads(self._dump('json', False, _dummyFrames(), 9, {},
+                                     self._makeRegistry()))
+        request = dump['stacks'][0]['threads'][0]['request']
+        self.assertEqual(request['id'], 10)
+        self.assertEqual(request['method'], 'POST')
+        self.assertEqual(request['url'], 'http://localhost/slow')
+        self.assertTrue(30 <= request['elapsed'] < 40)
+
+    def test_running_threads(self):
+        import json
+        dump = json.loads(self._dump('json'))
+        self.assertTrue(dump['threads'] >= 0)
+
 
 class MonitoringMiddlewareTests(_Base):
 
@@ -75,9 +340,17 @@ class MonitoringMiddlewareTests(_Base):
         return self._getTargetClass()(app)
 
     def test_ctor(self):
+        from repoze.debug.inflight import default_registry
         app = DummyApp()
         mw = self._makeOne(app)
         self.assertTrue(mw.app is app)
+        self.assertTrue(mw.inflight is default_registry)
+
+    def test_ctor_w_inflight(self):
+        from repoze.debug.inflight import InflightRegistry
+        registry = InflightRegistry()
+        mw = self._getTargetClass()(DummyApp(), registry)
+        self.assertTrue(mw.inflight is registry)
 
     def test___call___w_debug(self):
         import datetime
@@ -109,6 +382,42 @@ class MonitoringMiddlewareTests(_Base):
         self.assertEqual(lines[1], b"")
         self.assertEqual(lines[2], b"End of dump")
 
+    def _callStacks(self, query):
+        import datetime
+        self._setNOW(datetime.datetime(2013, 11, 21, 21, 5, 37))
+        environ = {'PATH_INFO': '/debug_threads',
+                   'REQUEST_METHOD': 'GET',
+                   'QUERY_STRING': query,
+                  }
+        _started = []
+        def _start_response(status, response_headers, exc_info=None):
+            _started.append((status, response_headers))
+        mw = self._makeOne(DummyApp())
+        mw._frames = _dummyFrames()
+        mw._thread_id = 9
+        mw._names = {}
+        body = b''.join(mw(environ, _start_response))
+        return _started[0][0], dict(_started[0][1]), body.decode('utf-8')
+
+    def test___call___w_debug_compact(self):
+        status, headers, body = self._callStacks('format=compact&idle=0')
+        self.assertEqual(status, '200 OK')
+        self.assertEqual(headers['Content-Type'], 'text/plain; charset=UTF-8')
+        self.assertTrue(body.startswith('Threads stack dump at '))
+        self.assertTrue('(3 idle threads hidden)' in body)
+
+    def test___call___w_debug_json(self):
+        import json
+        status, headers, body = self._callStacks('format=json')
+        self.assertEqual(status, '200 OK')
+        self.assertTrue(headers['Content-Type'].startswith('application/json'))
+        self.assertEqual(json.loads(body)['threads'], 4)
+
+    def test___call___w_debug_bad_parameters(self):
+        for query in ('format=html', 'idle=yes'):
+            status, headers, body = self._callStacks(query)
+            self.assertEqual(status, '400 Bad Request')
+
     def test___call___not_debug(self):
         _environ = {'PATH_INFO': '/path/info',
                     'REQUEST_METHOD': 'GET',
@@ -121,24 +430,249 @@ class MonitoringMiddlewareTests(_Base):
         app = DummyApp()
         mw = self._makeOne(app)
         chunks = list(mw(_environ, _start_response))
-        self.assertEqual(app._environ, _environ)
+        self.assertTrue(app._environ is _environ)
         self.assertEqual(chunks, ['body'])
-        self.assertEqual(_started,
-                        [('200 OK',
-                          [('Content-Type', 'text/html; charset=UTF-8')],
-                          None)])
+        # the application's response is passed through untouched
+        self.assertEqual(_started, [(200, [], None)])
+
+    def test___call___not_debug_passthrough(self):
+        app_iter = object()
+        def app(environ, start_response):
+            return (environ, start_response, app_iter)
+        _environ = {'SCRIPT_NAME': '/debug_threads',
+                    'PATH_INFO': '/child',
+                   }
+        _start_response = object()
+        mw = self._makeOne(app)
+        result = mw(_environ, _start_response)
+        self.assertTrue(result[0] is _environ)
+        self.assertTrue(result[1] is _start_response)
+        self.assertTrue(result[2] is app_iter)
+
+    def test___call___w_debug_under_script_name(self):
+        _environ = {'SCRIPT_NAME': '/debug_threads',
+                    'PATH_INFO': '',
+                    'REQUEST_METHOD': 'GET',
+                   }
+        _started = []
+        def _start_response(status, response_headers, exc_info=None):
+            _started.append(status)
+        app = DummyApp()
+        mw = self._makeOne(app)
+        list(mw(_environ, _start_response))
+        self.assertEqual(_started, ['200 OK'])
+        self.assertTrue(app._environ is None)
+
+
+class MonitoringMiddlewareProfileTests(unittest.TestCase):
+
+    def _makeOne(self):
+        from repoze.debug.threads import MonitoringMiddleware
+        return MonitoringMiddleware(DummyApp())
+
+    def _call(self, mw, query=''):
+        _started = []
+        def _start_response(status, response_headers, exc_info=None):
+            _started.append((status, response_headers))
+        environ = {'PATH_INFO': '/debug_profile',
+                   'REQUEST_METHOD': 'GET',
+                   'QUERY_STRING': query,
+                  }
+        body = b''.join(mw(environ, _start_response))
+        return _started[0][0], dict(_started[0][1]), body.decode('utf-8')
+
+    def test_folded(self):
+        status, headers, body = self._call(self._makeOne(),
+                                           'seconds=0.02&hz=100')
+        self.assertEqual(status, '200 OK')
+        self.assertEqual(headers['Content-Type'], 'text/plain; charset=UTF-8')
+        for line in body.splitlines():
+            self.assertTrue(line.rsplit(' ', 1)[1].isdigit())
+
+    def test_top(self):
+        status, headers, body = self._call(self._makeOne(),
+                                           'seconds=0.02&format=top&top=5')
+        self.assertEqual(status, '200 OK')
+        self.assertTrue(' samples of ' in body.splitlines()[0])
+        self.assertTrue(len(body.splitlines()) <= 8)
+
+    def test_bad_parameters(self):
+        mw = self._makeOne()
+        for query in ('seconds=x', 'seconds=0', 'seconds=61', 'hz=0',
+                      'hz=1001', 'top=x', 'format=svg'):
+            status, headers, body = self._call(mw, query)
+            self.assertEqual(status, '400 Bad Request')
+
+    def test_one_at_a_time(self):
+        mw = self._makeOne()
+        mw.profile_lock.acquire()
+        try:
+            status, headers, body = self._call(mw, 'seconds=0.01')
+        finally:
+            mw.profile_lock.release()
+        self.assertEqual(status, '409 Conflict')
+        self.assertEqual(body, 'A profile is already running\n')
+
+
+class SignalDumperTests(unittest.TestCase):
+
+    def setUp(self):
+        import tempfile
+        self.tempdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        import shutil
+        shutil.rmtree(self.tempdir)
+
+    def _getTargetClass(self):
+        from repoze.debug.threads import SignalDumper
+        return SignalDumper
+
+    def _makeOne(self, filename=None, min_interval=10.0, inflight=None):
+        from repoze.debug.inflight import InflightRegistry
+        if inflight is None:
+            inflight = InflightRegistry()
+        return self._getTargetClass()(filename, min_interval, inflight)
+
+    def _read(self, filename):
+        with open(filename) as f:
+            return f.read()
+
+    def test_ctor_defaults(self):
+        from repoze.debug.inflight import default_registry
+        dumper = self._getTargetClass()()
+        self.assertEqual(dumper.filename, None)
+        self.assertEqual(dumper.min_interval, 10.0)
+        self.assertTrue(dumper.inflight is default_registry)
+
+    def test_dump_includes_interrupted_frame(self):
+        import os
+        import sys
+        from repoze.debug._compat import thread
+        dumper = self._makeOne()
+        frame = sys._getframe()
+        text = dumper.dump(frame, {thread.get_ident(): None})
+        lines = text.splitlines()
+        self.assertEqual(lines[0],
+                         '--- begin THREADS for process %d ---' % os.getpid())
+        self.assertEqual(lines[-1],
+                         '--- end THREADS for process %d ---' % os.getpid())
+        self.assertTrue('Thread %s:' % thread.get_ident() in lines)
+        self.assertTrue('test_dump_includes_interrupted_frame' in text)
+
+    def test_dump_w_inflight(self):
+        import sys
+        from repoze.debug import clock
+        from repoze.debug._compat import thread
+        dumper = self._makeOne()
+        dumper.inflight.begin(1234, 'GET', {'url': 'http://localhost/slow'},
+                              clock.now() - 60)
+        text = dumper.dump(sys._getframe())
+        self.assertTrue('Thread %s (request 1234:  GET http://localhost/slow, '
+                        'running for 60.' % thread.get_ident() in text)
+
+    def test_trigger_rate_limited(self):
+        import os
+        filename = os.path.join(self.tempdir, 'threads.log')
+        dumper = self._makeOne(filename, 10.0)
+        self.assertTrue(dumper.trigger(None, 100.0))
+        self.assertFalse(dumper.trigger(None, 105.0))
+        self.assertFalse(dumper.trigger(None, 109.0))
+        self.assertEqual(dumper.ignored, 2)
+        self.assertEqual(self._read(filename).count('--- begin THREADS'), 1)
+        self.assertTrue(dumper.trigger(None, 110.0))
+        text = self._read(filename)
+        self.assertEqual(text.count('--- begin THREADS'), 2)
+        self.assertTrue('(2 signals ignored since the last dump)' in text)
+        self.assertEqual(dumper.ignored, 0)
+
+    def test_write_stderr(self):
+        import sys
+        from io import StringIO
+        from repoze.debug._compat import TEXT
+        dumper = self._makeOne()
+        text = TEXT('--- begin THREADS for process 1 ---\n')
+        saved, sys.stderr = sys.stderr, StringIO()
+        try:
+            dumper.write(text)
+            self.assertEqual(sys.stderr.getvalue(), text)
+        finally:
+            sys.stderr = saved
+
+    def test_install_and_signal(self):
+        import os
+        import signal
+        if not hasattr(signal, 'SIGUSR1'):  # pragma: no cover  Windows
+            return
+        filename = os.path.join(self.tempdir, 'threads.log')
+        called = []
+        def previous(signum, frame):
+            called.append(signum)
+        saved = signal.signal(signal.SIGUSR1, previous)
+        try:
+            dumper = self._makeOne(filename)
+            dumper.install(signal.SIGUSR1)
+            self.assertTrue(dumper.previous is previous)
+            os.kill(os.getpid(), signal.SIGUSR1)
+        finally:
+            signal.signal(signal.SIGUSR1, saved)
+        self.assertEqual(called, [signal.SIGUSR1])
+        self.assertTrue('test_install_and_signal' in self._read(filename))
+
+
+class Test_parse_signal(unittest.TestCase):
+
+    def _callFUT(self, value):
+        from repoze.debug.threads import parse_signal
+        return parse_signal(value)
+
+    def test_names(self):
+        import signal
+        if not hasattr(signal, 'SIGUSR1'):  # pragma: no cover  Windows
+            return
+        self.assertEqual(self._callFUT('SIGUSR1'), signal.SIGUSR1)
+        self.assertEqual(self._callFUT(' usr2 '), signal.SIGUSR2)
+
+    def test_number(self):
+        self.assertEqual(self._callFUT('10'), 10)
+
+    def test_unknown(self):
+        for value in ('nonesuch', 'SIG_IGN', ''):
+            self.assertRaises(ValueError, self._callFUT, value)
 
 
 class Test_make_middleware(_Base):
 
-    def _callFUT(self, app, global_conf):
+    def _callFUT(self, app, global_conf, **kw):
         from repoze.debug.threads import make_middleware
-        return make_middleware(app, global_conf)
+        return make_middleware(app, global_conf, **kw)
 
     def test_it(self):
         app = DummyApp()
         mw = self._callFUT(app, {})
         self.assertTrue(mw.app is app)
+        self.assertEqual(mw.dumper, None)
+
+    def test_w_dump_signal(self):
+        import signal
+        if not hasattr(signal, 'SIGUSR2'):  # pragma: no cover  Windows
+            return
+        saved = signal.getsignal(signal.SIGUSR2)
+        try:
+            mw = self._callFUT(DummyApp(), {}, dump_signal='SIGUSR2',
+                               dump_file='/tmp/threads.log',
+                               dump_interval='30')
+            self.assertTrue(signal.getsignal(signal.SIGUSR2) is mw.dumper)
+        finally:
+            signal.signal(signal.SIGUSR2, saved)
+        dumper = mw.dumper
+        self.assertEqual(dumper.filename, '/tmp/threads.log')
+        self.assertEqual(dumper.min_interval, 30.0)
+        self.assertTrue(dumper.inflight is mw.inflight)
+
+    def test_w_bad_dump_signal(self):
+        self.assertRaises(ValueError, self._callFUT, DummyApp(), {},
+                          dump_signal='nonesuch')
 
 
 class DummyApp(object):
@@ -0,0 +1,271 @@
+import unittest
+
+
+class BinaryTraceLogTests(unittest.TestCase):
+
+    def _getTargetClass(self):
+        from repoze.debug.tracelog import BinaryTraceLog
+        return BinaryTraceLog
+
+    def _makeOne(self, stream=None, max_strings=10000):
+        import io
+        if stream is None:
+            stream = io.BytesIO()
+        return self._getTargetClass()(stream, max_strings)
+
+    def _log(self, log, code, request_id, when, *fields):
+        # ``when`` in seconds;  the middleware passes integer nanoseconds
+        from repoze.debug.clock import to_ns
+        log.info(log.format_trace(code, 42, request_id, to_ns(when), fields))
+
+    def _read(self, log):
+        import io
+        from repoze.debug.tracelog import BinaryTraceReader
+        return list(BinaryTraceReader(io.BytesIO(log.stream.getvalue())))
+
+    def test_ctor_writes_magic(self):
+        from repoze.debug.tracelog import MAGIC
+        log = self._makeOne()
+        self.assertEqual(log.stream.getvalue(), MAGIC)
+
+    def test_ctor_appending_skips_magic(self):
+        import io
+        stream = io.BytesIO(b'existing')
+        stream.seek(0, 2)
+        log = self._makeOne(stream)
+        self.assertEqual(stream.getvalue(), b'existing')
+
+    def test_roundtrip(self):
+        log = self._makeOne()
+        self._log(log, 'U', 0, 1.5)
+        self._log(log, 'B', 1, 2.0, 'GET', 'http://localhost/')
+        self._log(log, 'A', 1, 2.25, '200', 11)
+        self._log(log, 'E', 1, 2.5, 11)
+        records = self._read(log)
+        self.assertEqual(records, [
+            ['U', '42', '0', 1.5, ''],
+            ['B', '42', '1', 2.0, 'GET http://localhost/'],
+            ['A', '42', '1', 2.25, '200 11'],
+            ['E', '42', '1', 2.5, '11'],
+            ])
+
+    def test_chunk_timings(self):
+        log = self._makeOne()
+        self._log(log, 'F', 1, 2.0)
+        self._log(log, 'E', 1, 2.5, 11, 3, 250000000)
+        records = self._read(log)
+        self.assertEqual(records, [['F', '42', '1', 2.0, ''],
+                                   ['E', '42', '1', 2.5, '11 3 250000000']])
+
+    def test_unknown_lengths(self):
+        log = self._makeOne()
+        self._log(log, 'A', 1, 2.0, '200', None)
+        self._log(log, 'E', 1, 2.0, None)
+        self._log(log, 'A', 2, 2.0, '204', 0)
+        records = self._read(log)
+        self.assertEqual([x[4] for x in records],
+                         ['200 None', 'None', '204 0'])
+
+    def test_strings_written_once(self):
+        from repoze.debug.tracelog import RECORD
+        log = self._makeOne()
+        self._log(log, 'B', 1, 2.0, 'GET', '/a')
+        size = len(log.stream.getvalue())
+        self._log(log, 'B', 2, 3.0, 'GET', '/a')
+        self.assertEqual(len(log.stream.getvalue()) - size, RECORD.size)
+        self._log(log, 'B', 3, 4.0, 'GET', '/b')
+        records = self._read(log)
+        self.assertEqual([x[4] for x in records],
+                         ['GET /a', 'GET /a', 'GET /b'])
+
+    def test_non_ascii_url(self):
+        from repoze.debug._compat import TEXT
+        url = b'/\xc3\xa4'.decode('utf-8')
+        log = self._makeOne()
+        self._log(log, 'B', 1, 2.0, 'GET', url)
+        records = self._read(log)
+        self.assertEqual(records[0][4], TEXT('GET ') + url)
+
+    def test_strings_reset_after_fork(self):
+        log = self._makeOne()
+        self._log(log, 'B', 1, 2.0, 'GET', '/a')
+        log.pid = -1 # as if the writer had been inherited by a child
+        size = len(log.stream.getvalue())
+        self._log(log, 'B', 2, 3.0, 'GET', '/a')
+        self.assertTrue(len(log.stream.getvalue()) - size > 100)
+        records = self._read(log)
+        self.assertEqual(records[1][4], 'GET /a')
+
+    def test_strings_bounded(self):
+        from repoze.debug.tracelog import RECORD
+        log = self._makeOne(max_strings=3)
+        self._log(log, 'B', 1, 2.0, 'GET', '/a')
+        self._log(log, 'B', 2, 2.0, 'GET', '/b')
+        self._log(log, 'B', 3, 2.0, 'GET', '/b')
+        self.assertEqual(len(log.strings), 3)
+        # no room for two more strings:  emptied, and its ids reused
+        self._log(log, 'B', 3, 2.0, 'GET', '/c')
+        self.assertEqual(sorted(log.strings), ['/c', 'GET'])
+        size = len(log.stream.getvalue())
+        self._log(log, 'B', 4, 2.0, 'GET', '/c')
+        self.assertEqual(len(log.stream.getvalue()) - size, RECORD.size)
+        self._log(log, 'B', 5, 2.0, 'GET', '/a')
+        records = self._read(log)
+        self.assertEqual([x[4] for x in records],
+                         ['GET /a', 'GET /b', 'GET /b', 'GET /c', 'GET /c',
+                          'GET /a'])
+
+    def test_open(self):
+        import os
+        import tempfile
+        from repoze.debug.tracelog import MAGIC
+        fn = tempfile.mktemp()
+        try:
+            log = self._getTargetClass().open(fn)
+            log.close()
+            log = self._getTargetClass().open(fn)
+            log.close()
+            with open(fn, 'rb') as f:
+                self.assertEqual(f.read(), MAGIC)
+        finally:
+            os.remove(fn)
+
+    def test_open_rotated(self):
+        import os
+        import shutil
+        import tempfile
+        from repoze.debug.tracelog import BinaryTraceReader
+        tmpdir = tempfile.mkdtemp()
+        try:
+            log = self._getTargetClass().open(
+                os.path.join(tmpdir, 'trace.bin'), 200, 5)
+            log.stream.compress = False
+            log.stream.compress_delay = 0
+            for i in range(10):
+                self._log(log, 'B', i, 2.0, 'GET', '/a')
+            log.stream.flush()
+            log.close()
+            files = log.stream.backups() + [log.stream.filename]
+            self.assertTrue(len(files) > 1)
+            for name in files:
+                # each file stands alone, defining the strings it uses
+                with open(name, 'rb') as f:
+                    records = list(BinaryTraceReader(f))
+                self.assertTrue(records)
+                for record in records:
+                    self.assertEqual(record[4], 'GET /a')
+        finally:
+            shutil.rmtree(tmpdir)
+
+    def test_w_middleware(self):
+        import io
+        from repoze.debug.responselogger import ResponseLoggingMiddleware
+        from repoze.debug.tracelog import BinaryTraceReader
+        def app(environ, start_response):
+            start_response('200 OK', [('Content-Length', '5')])
+            return [b'hello']
+        log = self._makeOne()
+        mw = ResponseLoggingMiddleware(app, 0, 0, None, log)
+        environ = {'REQUEST_METHOD': 'GET', 'SERVER_NAME': 'localhost',
+                   'SERVER_PORT': '80', 'PATH_INFO': '/x',
+                   'wsgi.url_scheme': 'http', 'wsgi.input': io.BytesIO(),
+                   'wsgi.version': (1, 0), 'wsgi.multithread': False,
+                   'wsgi.multiprocess': False, 'wsgi.run_once': False}
+        list(mw(environ, lambda *arg: None))
+        records = self._read(log)
+        self.assertEqual([x[0] for x in records], ['U', 'B', 'A', 'F', 'E'])
+        self.assertEqual(records[1][4], 'GET http://localhost/x')
+        self.assertEqual(records[2][4], '200 5')
+        self.assertEqual(records[3][4], '')
+        self.assertEqual(records[4][4], '5 1 0')
+
+
+class BinaryTraceReaderTests(unittest.TestCase):
+
+    def _getTargetClass(self):
+        from repoze.debug.tracelog import BinaryTraceReader
+        return BinaryTraceReader
+
+    def _makeOne(self, data):
+        import io
+        return self._getTargetClass()(io.BytesIO(data))
+
+    def _pack(self, code, request_id, t, a=0, b=-1, c=-1):
+        from repoze.debug.tracelog import RECORD
+        return RECORD.pack(code, 1, request_id, t, a, b, c)
+
+    def test_ctor_not_binary(self):
+        self.assertRaises(ValueError, self._makeOne, b'U 1 2 3.0\n')
+
+    def test_ctor_empty(self):
+        self.assertRaises(ValueError, self._makeOne, b'')
+
+    def test_empty_log(self):
+        from repoze.debug.tracelog import MAGIC
+        reader = self._makeOne(MAGIC)
+        self.assertEqual(reader.peek(), None)
+        self.assertEqual(list(reader), [])
+
+    def test_peek_advance(self):
+        from repoze.debug.tracelog import MAGIC
+        reader = self._makeOne(MAGIC + self._pack(b'E', 1, 10**9, 3) +
+                               self._pack(b'E', 2, 2 * 10**9, 4))
+        first = reader.peek()
+        self.assertEqual(first, ['E', '1', '1', 1.0, '3'])
+        self.assertTrue(reader.peek() is first)
+        reader.advance()
+        self.assertEqual(reader.peek(), ['E', '1', '2', 2.0, '4'])
+        reader.advance()
+        self.assertEqual(reader.peek(), None)
+
+    def test_concatenated_logs(self):
+        from repoze.debug.tracelog import MAGIC
+        reader = self._makeOne(MAGIC + self._pack(b'E', 1, 10**9, 3) +
+                               MAGIC + self._pack(b'E', 2, 2 * 10**9, 4))
+        self.assertEqual([x[2] for x in reader], ['1', '2'])
+
+    def test_truncated_record(self):
+        from repoze.debug.tracelog import MAGIC
+        reader = self._makeOne(MAGIC + self._pack(b'E', 1, 10**9, 3) +
+                               self._pack(b'E', 2, 2 * 10**9, 4)[:-1])
+        self.assertEqual([x[2] for x in reader], ['1'])
+
+    def test_truncated_string(self):
+        from repoze.debug.tracelog import MAGIC
+        reader = self._makeOne(MAGIC + self._pack(b'S', 0, 0, 7, 10) + b'abc')
+        self.assertEqual(list(reader), [])
+
+    def test_undefined_string(self):
+        from repoze.debug.tracelog import MAGIC
+        reader = self._makeOne(MAGIC + self._pack(b'B', 1, 10**9, 7, 8))
+        self.assertEqual(reader.peek()[4], '? ?')
+
+    def test_large_log(self):
+        from repoze.debug.tracelog import MAGIC
+        data = [MAGIC]
+        for i in range(5000):
+            data.append(self._pack(b'E', i, i * 10**9, i))
+        reader = self._makeOne(b''.join(data))
+        records = list(reader)
+        self.assertEqual(len(records), 5000)
+        self.assertEqual(records[-1], ['E', '1', '4999', 4999.0, '4999'])
+
+
+class Test_is_binary_trace(unittest.TestCase):
+
+    def _callFUT(self, stream):
+        from repoze.debug.tracelog import is_binary_trace
+        return is_binary_trace(stream)
+
+    def test_binary(self):
+        import io
+        from repoze.debug.tracelog import MAGIC
+        stream = io.BytesIO(MAGIC + b'rest')
+        self.assertTrue(self._callFUT(stream))
+        self.assertEqual(stream.tell(), 0)
+
+    def test_text(self):
+        import io
+        stream = io.BytesIO(b'U 1 2 3.0\n')
+        self.assertFalse(self._callFUT(stream))
+        self.assertEqual(stream.tell(), 0)
@@ -93,6 +93,67 @@ class DebugGuiTests(unittest.TestCase):
         self.assertTrue(b'<atom:feed' in b''.join(list(app_iter)))
         # XXX need more assertions?  Damn trying to test rendered output!
 
+    def test___call___w_latency(self):
+        from repoze.debug.metrics import LatencyStats
+        environ = self._makeEnviron(PATH_INFO='/__repoze.debug/latency')
+        _started, _start_response = self._make_start_response()
+        latency = LatencyStats()
+        latency.record('GET', '/foo/1', 0.5)
+        mw = DummyModel(latency=latency, pid=1234)
+        gui = self._makeOne(mw)
+        body = b''.join(gui(environ, _start_response))
+        self.assertEqual(_started[0][0], '200 OK')
+        self.assertTrue(('Content-Type', 'text/plain; charset=UTF-8')
+                            in _started[0][1])
+        self.assertTrue(b'/foo/{id}' in body)
+
+    def test___call___w_latency_json(self):
+        import json
+        from repoze.debug.metrics import LatencyStats
+        environ = self._makeEnviron(PATH_INFO='/__repoze.debug/latency.json')
+        _started, _start_response = self._make_start_response()
+        latency = LatencyStats()
+        latency.record('GET', '/foo/1', 0.5)
+        mw = DummyModel(latency=latency, pid=1234)
+        gui = self._makeOne(mw)
+        body = b''.join(gui(environ, _start_response))
+        self.assertEqual(_started[0][0], '200 OK')
+        data = json.loads(body.decode('utf-8'))
+        self.assertEqual(data['pid'], 1234)
+        self.assertEqual(data['routes'][0]['route'], '/foo/{id}')
+        self.assertEqual(data['routes'][0]['p99'], 0.5)
+
+    def test_getLatency_disabled(self):
+        mw = DummyModel(latency=None, pid=1234)
+        gui = self._makeOne(mw)
+        response = gui.getLatency()
+        self.assertEqual(response.status_int, 404)
+
+    def test___call___w_metrics(self):
+        from repoze.debug.metrics import RequestCounters
+        environ = self._makeEnviron(PATH_INFO='/__repoze.debug/metrics')
+        _started, _start_response = self._make_start_response()
+        counters = RequestCounters()
+        counters.begin()
+        counters.end('200 OK', 0, 5, 0.1)
+        mw = DummyModel(counters=counters, entries=[1, 2], log_writer=None,
+                        pid=1234)
+        gui = self._makeOne(mw)
+        body = b''.join(gui(environ, _start_response))
+        self.assertEqual(_started[0][0], '200 OK')
+        self.assertTrue(('Content-Type',
+                         'text/plain; version=0.0.4; charset=utf-8')
+                            in _started[0][1])
+        lines = body.decode('utf-8').splitlines()
+        self.assertTrue('repoze_debug_requests_total{status="2xx"} 1' in lines)
+        self.assertTrue('repoze_debug_entries_retained 2' in lines)
+
+    def test_getMetrics_disabled(self):
+        mw = DummyModel(counters=None, pid=1234)
+        gui = self._makeOne(mw)
+        response = gui.getMetrics()
+        self.assertEqual(response.status_int, 404)
+
     def test_getStatic_miss(self):
         gui = self._makeOne(None)
         self.assertRaises(ValueError, gui.getStatic, 'nonesuch.html')
@@ -120,7 +181,7 @@ class DebugGuiTests(unittest.TestCase):
         entries = [
             {'id': 'aaaa',
              'request': {
-                'begin': 1234,
+                'begin': 1234 * 10**9,
                 'method': 'GET',
                 'url': '/foo',
                 'cgi_variables': [('cgi_a', 'CGI_A')],
@@ -142,7 +203,7 @@ class DebugGuiTests(unittest.TestCase):
         entries = [
             {'id': 'aaaa',
              'request': {
-                'begin': 1234,
+                'begin': 1234 * 10**9,
                 'method': 'GET',
                 'url': '/foo/%s' % '/'.join(['bbb' * 40]),
                 'cgi_variables': [('cgi_a', 'CGI_A')],
@@ -164,7 +225,7 @@ class DebugGuiTests(unittest.TestCase):
         entries = [
             {'id': 'aaaa',
              'request': {
-                'begin': 1234,
+                'begin': 1234 * 10**9,
                 'method': 'GET',
                 'url': '/foo',
                 'cgi_variables': [('cgi_a', 'CGI_A')],
@@ -172,8 +233,8 @@ class DebugGuiTests(unittest.TestCase):
                 'body': '',
                 },
              'response': {
-                'begin': 1235,
-                'end': 1236,
+                'begin': 1235 * 10**9,
+                'end': 1236500000000,
                 'status': '200 OK',
                 'content-length': 57,
                 'headers': [('header_a', 'HEADER_A')],
@@ -186,7 +247,28 @@ class DebugGuiTests(unittest.TestCase):
         response = gui.getFeed()
         self.assertTrue(isinstance(response, Response))
         self.assertEqual(response.content_type, 'application/atom+xml')
-        # XXX need more assertions?  Damn trying to test rendered output!
+        # times are rendered in seconds
+        self.assertTrue(b'<rz:begin>1235.0</rz:begin>' in response.body)
+        self.assertTrue(b'<rz:end>1236.5</rz:end>' in response.body)
+
+    def test_getFeed_w_pid_tagged_entry(self):
+        entries = [
+            {'id': 'aaaa',
+             'pid': 5678,
+             'request': {
+                'begin': 1234 * 10**9,
+                'method': 'GET',
+                'url': '/foo',
+                'cgi_variables': [],
+                'wsgi_variables': [],
+                'body': '',
+                },
+            },
+        ]
+        mw = DummyModel(entries=entries, pid=1234)
+        gui = self._makeOne(mw)
+        response = gui.getFeed()
+        self.assertTrue(b':aaaa-5678</atom:id>' in response.body)
 
 class DummyModel:
     def __init__(self, **kw):
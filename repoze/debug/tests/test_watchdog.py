@@ -0,0 +1,119 @@
+import unittest
+
+
+class WatchdogTests(unittest.TestCase):
+
+    def _getTargetClass(self):
+        from repoze.debug.watchdog import Watchdog
+        return Watchdog
+
+    def _makeOne(self, registry=None, threshold=10.0, interval=1.0,
+                 repeat=0):
+        from repoze.debug.inflight import InflightRegistry
+        if registry is None:
+            registry = InflightRegistry()
+        self.reported = []
+        def report(request, elapsed, stack):
+            self.reported.append((request.request_id, elapsed, stack))
+        watchdog = self._getTargetClass()(registry, threshold, report,
+                                          interval, repeat)
+        self.addCleanup(watchdog.stop)
+        return watchdog
+
+    def _frames(self):
+        import sys
+        return sys._current_frames()
+
+    def test_check_reports_slow_requests_once(self):
+        watchdog = self._makeOne()
+        slow = watchdog.registry.begin(1, 'GET', {}, 100.0)
+        watchdog.registry.begin(2, 'GET', {}, 105.0)
+        watchdog.check(110.0, self._frames())
+        self.assertEqual(len(self.reported), 1)
+        request_id, elapsed, stack = self.reported[0]
+        self.assertEqual(request_id, 1)
+        self.assertEqual(elapsed, 10.0)
+        self.assertTrue('test_check_reports_slow_requests_once' in stack)
+        self.assertEqual(slow.reported, 110.0)
+        watchdog.check(200.0, self._frames())
+        self.assertEqual([x[0] for x in self.reported], [1, 2])
+
+    def test_check_repeat(self):
+        watchdog = self._makeOne(repeat=30.0)
+        watchdog.registry.begin(1, 'GET', {}, 100.0)
+        for now in (110.0, 120.0, 139.0, 140.0):
+            watchdog.check(now, self._frames())
+        self.assertEqual([x[1] for x in self.reported], [10.0, 40.0])
+
+    def test_check_thread_gone(self):
+        watchdog = self._makeOne()
+        watchdog.registry.begin(1, 'GET', {}, 100.0)
+        watchdog.check(110.0, {})
+        self.assertEqual(self.reported, [])
+
+    def test_check_request_finished_meanwhile(self):
+        from repoze.debug.inflight import InflightRegistry
+        class Registry(InflightRegistry):
+            def get(self, request_id):
+                return None
+        watchdog = self._makeOne(Registry())
+        watchdog.registry.begin(1, 'GET', {}, 100.0)
+        watchdog.check(110.0, self._frames())
+        self.assertEqual(self.reported, [])
+
+    def test_check_defaults(self):
+        watchdog = self._makeOne(threshold=0.0)
+        watchdog.registry.begin(1, 'GET', {}, 0.0)
+        watchdog.check()
+        self.assertEqual(len(self.reported), 1)
+
+    def test_thread(self):
+        import time
+        watchdog = self._makeOne(threshold=0.0, interval=0.01)
+        watchdog.registry.begin(1, 'GET', {}, 0.0)
+        watchdog.ensure_started()
+        thread = watchdog.thread
+        self.assertTrue(thread.daemon)
+        watchdog.ensure_started()
+        self.assertTrue(watchdog.thread is thread)
+        for i in range(500):
+            if self.reported:
+                break
+            time.sleep(0.01)
+        self.assertEqual([x[0] for x in self.reported], [1])
+        watchdog.stop()
+        self.assertFalse(thread.is_alive())
+        self.assertEqual(watchdog.thread, None)
+
+    def test_thread_survives_errors(self):
+        import time
+        from repoze.debug.inflight import InflightRegistry
+        from repoze.debug._compat import NativeStringIO as StringIO
+        import sys
+        checked = []
+        class Registry(InflightRegistry):
+            def snapshot(self):
+                checked.append(True)
+                raise ValueError('broken')
+        watchdog = self._makeOne(Registry(), interval=0.01)
+        saved, sys.stderr = sys.stderr, StringIO()
+        try:
+            watchdog.ensure_started()
+            for i in range(500):
+                if len(checked) > 1:
+                    break
+                time.sleep(0.01)
+            watchdog.stop()
+            printed = sys.stderr.getvalue()
+        finally:
+            sys.stderr = saved
+        self.assertTrue(len(checked) > 1)
+        self.assertTrue('ValueError: broken' in printed)
+
+    def test_ensure_started_after_fork(self):
+        watchdog = self._makeOne()
+        watchdog.registry.begin(1, 'GET', {}, 0.0)
+        watchdog.pid = -1 # as if started by the parent process
+        watchdog.ensure_started()
+        self.assertEqual(len(watchdog.registry), 0)
+        self.assertTrue(watchdog.thread.is_alive())
@@ -1,10 +1,15 @@
 import datetime
+import json
+import os
+import signal
 import sys
+import threading
 
 import traceback
 
-import webob
-
+from repoze.debug import clock
+from repoze.debug import profiler
+from repoze.debug.inflight import default_registry
 from repoze.debug._compat import thread
 from repoze.debug._compat import TEXT
 
@@ -14,52 +19,429 @@ def _now():
         return _NOW
     return datetime.datetime.now()  #pragma NO COVER
 
+def _describe_request(request, now):
+    return 'request %s:  %s %s, running for %.2f seconds' % (
+        request.request_id, request.method, request.url, now - request.begin)
+
 def dump_threads(frames=None,       # testing hook
                  thread_id=None,    #    "     "
+                 inflight=None,
                 ):
     """Dump running threads
 
-    Returns a string with the tracebacks.
+    Returns a string with the tracebacks.  The threads serving a request
+    registered in ``inflight`` (see
+    :class:`repoze.debug.inflight.InflightRegistry`) are annotated with it,
+    the longest-running first.
     """
     if frames is None:
         frames = sys._current_frames()
     if thread_id is None:
         thread_id = thread.get_ident()
+    requests = inflight is not None and inflight.by_thread() or {}
+    now = clock.now()
     res = ["Threads traceback dump at %s\n"
             % _now().strftime("%Y-%m-%d %H:%M:%S")
           ]
-    for f_tid, frame in frames.items():
-        if f_tid != thread_id: #pragma NO COVER
+    thread_ids = [f_tid for f_tid in frames if f_tid != thread_id]
+    if requests:
+        thread_ids.sort(key=lambda x: x in requests and
+                                      (0, requests[x].begin) or (1, 0))
+    for f_tid in thread_ids: #pragma NO COVER
+        request = requests.get(f_tid)
+        if request is None:
             res.append("Thread %s:\n%s" %
-                (f_tid, traceback.format_stack(frame)))
+                (f_tid, traceback.format_stack(frames[f_tid])))
+        else:
+            res.append("Thread %s (%s):\n%s" %
+                (f_tid, _describe_request(request, now),
+                 traceback.format_stack(frames[f_tid])))
     frames = None
     res.append("End of dump")
     return '\n'.join(res)
 
+# Functions in which threads waiting for work (or for a lock, a queue, a
+# connection) spend their time:  stacks ending in one of these are "idle".
+IDLE_FUNCTIONS = set([
+    ('threading.py', 'wait'),
+    ('threading.py', '_wait_for_tstate_lock'),
+    ('queue.py', 'get'),
+    ('Queue.py', 'get'),
+    ('selectors.py', 'select'),
+    ('socket.py', 'accept'),
+    ('socketserver.py', 'serve_forever'),
+    ('SocketServer.py', '_eintr_retry'),
+    ('asyncore.py', 'poll'),
+    ('wasyncore.py', 'poll'),
+])
+
+def thread_names():
+    """ Map the ids of the running threads to their names.
+    """
+    return dict((t.ident, t.name) for t in threading.enumerate())
+
+def walk_stack(frame):
+    """ Return the (code, line number) pairs of ``frame``'s stack, outermost
+    first.
+
+    Nothing is formatted nor read from the source files, so that walking
+    the stacks of all threads is cheap.
+    """
+    stack = []
+    while frame is not None and len(stack) < profiler.MAX_DEPTH:
+        stack.append((frame.f_code, frame.f_lineno))
+        frame = frame.f_back
+    stack.reverse()
+    return tuple(stack)
+
+class StackGroup(object):
+    """ The threads sharing an identical stack.
+    """
+    def __init__(self, stack):
+        self.stack = stack
+        self.threads = []   # (thread id, name)
+        self.requests = {}  # thread id: in-flight request
+
+    @property
+    def begin(self):
+        """ The start time of the longest-running request served by the
+        threads, or None.
+        """
+        if not self.requests:
+            return None
+        return min([request.begin for request in self.requests.values()])
+
+    @property
+    def idle(self):
+        if not self.stack:
+            return False
+        code = self.stack[-1][0]
+        return ((os.path.basename(code.co_filename), code.co_name)
+                in IDLE_FUNCTIONS)
+
+    def frames(self):
+        """ Return the (filename, line number, function) of each frame,
+        outermost first.
+        """
+        return [(code.co_filename, lineno, code.co_name)
+                for code, lineno in self.stack]
+
+def group_threads(frames=None,       # testing hooks
+                  thread_id=None,    #    "     "
+                  names=None,        #    "     "
+                  inflight=None,
+                 ):
+    """ Group the threads, but the calling one, by identical stacks.
+
+    Return a list of :class:`StackGroup`:  those serving the
+    longest-running requests registered in ``inflight`` first, then the
+    most threads first.
+    """
+    if frames is None:
+        frames = sys._current_frames()
+    if thread_id is None:
+        thread_id = thread.get_ident()
+    if names is None:
+        names = thread_names()
+    requests = inflight is not None and inflight.by_thread() or {}
+    groups = {}
+    for f_tid, frame in frames.items():
+        if f_tid != thread_id:
+            stack = walk_stack(frame)
+            group = groups.get(stack)
+            if group is None:
+                group = groups[stack] = StackGroup(stack)
+            group.threads.append((f_tid, names.get(f_tid)))
+            if f_tid in requests:
+                group.requests[f_tid] = requests[f_tid]
+    frames = None
+    result = list(groups.values())
+    for group in result:
+        group.threads.sort(key=lambda x: (
+            x[0] in group.requests and (0, group.requests[x[0]].begin)
+            or (1, 0), x[0]))
+    result.sort(key=lambda x: (x.begin is None, x.begin,
+                               -len(x.threads), x.threads[0][0]))
+    return result
+
+def _thread_label(thread_id, name):
+    if name is None:
+        return '%s' % thread_id
+    return '%s (%s)' % (name, thread_id)
+
+def dump_stacks(format='compact',
+                idle=True,
+                frames=None,       # testing hooks
+                thread_id=None,    #    "     "
+                names=None,        #    "     "
+                inflight=None,
+               ):
+    """ Dump the running threads, grouped by identical stacks.
+
+    ``format`` is 'compact' (plain text) or 'json';  unless ``idle``, the
+    threads waiting for work are left out.  The threads serving a request
+    registered in ``inflight`` are annotated with it.
+    """
+    groups = group_threads(frames, thread_id, names, inflight)
+    now = clock.now()
+    count = sum([len(group.threads) for group in groups])
+    if not idle:
+        groups = [group for group in groups if not group.idle]
+    shown = sum([len(group.threads) for group in groups])
+    when = _now().strftime("%Y-%m-%d %H:%M:%S")
+
+    def _request(request):
+        if request is None:
+            return None
+        return {'id': request.request_id, 'method': request.method,
+                'url': request.url, 'elapsed': now - request.begin}
+
+    if format == 'json':
+        return json.dumps({
+            'time': when,
+            'threads': count,
+            'hidden': count - shown,
+            'stacks': [{
+                'count': len(group.threads),
+                'idle': group.idle,
+                'threads': [{'id': tid, 'name': name,
+                             'request': _request(group.requests.get(tid))}
+                            for tid, name in group.threads],
+                'frames': [{'file': filename, 'line': lineno,
+                            'function': function}
+                           for filename, lineno, function in group.frames()],
+                } for group in groups],
+            }, sort_keys=True)
+
+    res = ['Threads stack dump at %s:  %d threads, %d stacks' % (
+            when, count, len(groups))]
+    if shown < count:
+        res[0] += ' (%d idle threads hidden)' % (count - shown)
+    res.append('')
+    for group in groups:
+        res.append('%d thread%s%s:  %s' % (
+            len(group.threads), len(group.threads) != 1 and 's' or '',
+            group.idle and ' (idle)' or '',
+            ', '.join([_thread_label(tid, name)
+                       for tid, name in group.threads])))
+        for tid, name in group.threads:
+            request = group.requests.get(tid)
+            if request is not None:
+                res.append('  * %s serving %s' % (
+                    _thread_label(tid, name),
+                    _describe_request(request, now)))
+        for filename, lineno, function in group.frames():
+            res.append('  %s:%d in %s' % (filename, lineno, function))
+        res.append('')
+    res.append('End of dump')
+    return '\n'.join(res)
+
+DEBUG_PATHS = frozenset(['/debug_threads', '/debug_profile'])
+
 class MonitoringMiddleware(object):
     """The monitoring middleware intercepts requests for the path
-    '/debug_threads' and returns a plain-text thread dump."""
+    '/debug_threads' and returns a thread dump, and for the path
+    '/debug_profile', which returns a statistical profile of all
+    threads."""
     
-    _frames = _thread_id = None  # testing hooks
+    _frames = _thread_id = _names = None  # testing hooks
+    dumper = None  # see make_middleware
+    max_profile_seconds = 60
+    max_profile_hz = 1000
 
-    def __init__(self, app):
+    def __init__(self, app, inflight=None):
+        if inflight is None:
+            inflight = default_registry
         self.app = app
+        self.inflight = inflight
+        self.profile_lock = threading.Lock()
         
     def __call__(self, environ, start_response):
+        path = environ.get('SCRIPT_NAME', '') + environ.get('PATH_INFO', '')
+        if path not in DEBUG_PATHS:
+            # any other request goes to the application untouched
+            return self.app(environ, start_response)
+
+        # WebOb is only needed to serve our own pages
+        import webob
         request = webob.Request(environ)
 
-        if request.path == '/debug_threads':
-            response = webob.Response(request=request)
-            response.content_type = 'text/plain'
-            t = dump_threads(self._frames, self._thread_id)
+        if path == '/debug_threads':
+            response = self.threads(request)
+        else:
+            response = self.profile(request)
+
+        return response(environ, start_response)
+
+    def threads(self, request):
+        """ Dump the stack of each thread or, with ``format=compact`` or
+        ``format=json``, the threads grouped by identical stacks, without
+        the idle ones if ``idle=0``.
+        """
+        import webob
+        response = webob.Response(request=request)
+        response.content_type = 'text/plain'
+        format = request.GET.get('format', 'text')
+        idle = request.GET.get('idle', '1')
+        if format not in ('text', 'compact', 'json'):
+            response.status = '400 Bad Request'
+            response.text = TEXT(
+                'format must be "text", "compact" or "json"\n')
+            return response
+        if idle not in ('0', '1'):
+            response.status = '400 Bad Request'
+            response.text = TEXT('idle must be 0 or 1\n')
+            return response
+        if format == 'text':
+            t = dump_threads(self._frames, self._thread_id, self.inflight)
             if isinstance(t, TEXT):  # pragma NO COVER Py3k
                 response.text = t
             else:
                 response.body = t
         else:
-            response = request.get_response(self.app, catch_exc_info=True)
-            
-        return response(environ, start_response)
+            t = dump_stacks(format, idle == '1', self._frames,
+                            self._thread_id, self._names, self.inflight)
+            if format == 'json':
+                response.content_type = 'application/json'
+            if isinstance(t, TEXT):
+                t = t.encode('utf-8')
+            response.body = t
+        return response
+
+    def profile(self, request):
+        """ Sample the stacks of all threads for ``seconds`` (default 10)
+        at ``hz`` (default 100) samples per second.
+
+        Return the stacks in the folded format read by flame graph tools
+        or, with ``format=top``, the ``top`` (default 30) functions with
+        the most samples.  Only one profile runs at a time.
+        """
+        import webob
+        response = webob.Response(request=request)
+        response.content_type = 'text/plain'
+        try:
+            seconds = float(request.GET.get('seconds', 10))
+            hz = int(request.GET.get('hz', 100))
+            top = int(request.GET.get('top', 30))
+            format = request.GET.get('format', 'folded')
+            if not 0 < seconds <= self.max_profile_seconds:
+                raise ValueError('seconds must be between 0 and %s'
+                                 % self.max_profile_seconds)
+            if not 0 < hz <= self.max_profile_hz:
+                raise ValueError('hz must be between 1 and %s'
+                                 % self.max_profile_hz)
+            if format not in ('folded', 'top'):
+                raise ValueError('format must be "folded" or "top"')
+        except ValueError as e:
+            response.status = '400 Bad Request'
+            response.text = TEXT('%s\n' % e)
+            return response
+        if not self.profile_lock.acquire(False):
+            response.status = '409 Conflict'
+            response.text = TEXT('A profile is already running\n')
+            return response
+        try:
+            result = profiler.profile(seconds, hz)
+        finally:
+            self.profile_lock.release()
+        if format == 'top':
+            response.text = TEXT(result.top(top))
+        else:
+            response.text = TEXT(result.folded())
+        return response
+
+class SignalDumper(object):
+    """ A signal handler dumping the threads (see :func:`dump_threads`),
+    with the requests registered in ``inflight``, to ``filename`` or to
+    stderr.
+
+    Python runs signal handlers in the main thread, so that the dump is
+    written even when every worker thread is busy.  Signals received less
+    than ``min_interval`` seconds after a dump are ignored.
+    """
+    last = None         # when the last dump was written
+    previous = None     # the handler replaced by install()
+
+    def __init__(self, filename=None, min_interval=10.0, inflight=None):
+        if inflight is None:
+            inflight = default_registry
+        self.filename = filename
+        self.min_interval = min_interval
+        self.inflight = inflight
+        self.ignored = 0
+
+    def install(self, signum):
+        self.previous = signal.signal(signum, self)
+
+    def __call__(self, signum, frame):
+        self.trigger(frame, clock.now())
+        if callable(self.previous):
+            self.previous(signum, frame)
+
+    def trigger(self, frame, now):
+        """ Write a dump, unless one was written less than ``min_interval``
+        seconds ago.
+        """
+        if self.last is not None and now - self.last < self.min_interval:
+            self.ignored += 1
+            return False
+        self.last = now
+        self.write(self.dump(frame))
+        return True
+
+    def dump(self, frame=None, frames=None):
+        if frames is None:
+            frames = sys._current_frames()
+        if frame is not None:
+            # the main thread's stack, as interrupted by the signal
+            frames[thread.get_ident()] = frame
+        pid = os.getpid()
+        header = '--- begin THREADS for process %d ---\n' % pid
+        if self.ignored:
+            header += '(%d signals ignored since the last dump)\n' % (
+                self.ignored)
+            self.ignored = 0
+        # no thread to leave out:  the handler's is the interrupted one
+        text = dump_threads(frames, -1, self.inflight)
+        return '%s%s\n--- end THREADS for process %d ---\n' % (
+            header, text, pid)
+
+    def write(self, text):
+        if self.filename:
+            f = open(self.filename, 'a')
+            try:
+                f.write(text)
+            finally:
+                f.close()
+        else:
+            sys.stderr.write(text)
+            sys.stderr.flush()
+
+def parse_signal(value):
+    """ Return the number of the signal named ``value`` ('SIGUSR1', 'USR1'
+    or a number).
+    """
+    value = value.strip()
+    if value.isdigit():
+        return int(value)
+    name = value.upper()
+    if not name.startswith('SIG'):
+        name = 'SIG' + name
+    signum = getattr(signal, name, None)
+    if not isinstance(signum, int) or name.startswith('SIG_'):
+        raise ValueError('Unknown signal: %r' % value)
+    return signum
 
-def make_middleware(app, global_conf):
-    return MonitoringMiddleware(app)
+def make_middleware(app, global_conf,
+                    dump_signal='',
+                    dump_file='',
+                    dump_interval='10',
+                   ):
+    """ Paste filter-app converter """
+    middleware = MonitoringMiddleware(app)
+    if dump_signal:
+        dumper = SignalDumper(dump_file or None, float(dump_interval),
+                              middleware.inflight)
+        dumper.install(parse_signal(dump_signal))
+        middleware.dumper = dumper
+    return middleware
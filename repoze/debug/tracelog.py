@@ -0,0 +1,244 @@
+"""Compact binary trace log format.
+
+A binary trace log starts with ``MAGIC``, followed by fixed-size records
+laid out as ``RECORD``:  the event code (one ASCII byte), the pid, the
+request id, the time (integer nanoseconds since the epoch), and three
+integer fields whose meaning depends on the code:
+
+``B``
+    string ids of the HTTP method and of the URL
+
+``A``
+    the HTTP status code and the Content-Length header (-1 if unknown)
+
+``F``
+    (unused;  the time is when the first chunk of the body was produced)
+
+``E``
+    the body length (-1 if unknown), the number of chunks in the body and
+    the largest gap between two chunks, in nanoseconds (both -1 if unknown)
+
+``U``
+    (unused)
+
+``S``
+    defines a string:  its id and its length in bytes.  The record is
+    followed by the UTF-8 encoded string.
+
+Each string (method or URL) is written once per writing process (and per
+file, when the log is rotated), and later records refer to it by id.  The
+writer forgets its strings once it has defined ``max_strings`` of them,
+and starts reusing ids:  an ``S`` record redefines an id for the records
+which follow it.  A log may contain several ``MAGIC`` headers (e.g. after
+concatenating logs);  readers skip them.
+"""
+import os
+import struct
+import threading
+
+from repoze.debug.logwriter import AppendFile
+from repoze.debug._compat import TEXT
+
+MAGIC = b'RZTRACE1'
+RECORD = struct.Struct('<cIQqqqq')
+
+def _int(value):
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return -1
+
+def _optional(value):
+    if value < 0:
+        return None
+    return value
+
+class BinaryTraceLog(object):
+    """ Write trace records in the binary format to ``stream``.
+
+    Use it in place of the trace logger passed to
+    :class:`repoze.debug.responselogger.ResponseLoggingMiddleware`.  Each
+    record (with any string it introduces) is written with a single call
+    to ``stream.write``.
+
+    At most ``max_strings`` strings are remembered (most URLs are seen
+    once):  the table is then emptied, and strings are written again when
+    next used.
+    """
+    def __init__(self, stream, max_strings=10000):
+        self.stream = stream
+        self.max_strings = max_strings
+        self.lock = threading.Lock()
+        self.strings = {}
+        self.pid = None
+        self.generation = None
+        if stream.tell() == 0:
+            stream.write(MAGIC)
+
+    @classmethod
+    def open(cls, filename, max_bytes=0, backup_count=0, max_strings=10000):
+        """ Open ``filename`` for appending, as an
+        :class:`repoze.debug.logwriter.AppendFile` rotated when it reaches
+        ``max_bytes`` (if ``backup_count`` is nonzero).
+        """
+        return cls(AppendFile(filename, max_bytes, backup_count,
+                              header=MAGIC), max_strings)
+
+    @staticmethod
+    def format_trace(code, pid, request_id, when, fields):
+        # Records are packed in ``info``, under the lock, so that strings
+        # are always defined before the records using them.
+        return (code, pid, request_id, when, fields)
+
+    def info(self, record):
+        code, pid, request_id, when, fields = record
+        values = [0, 0, 0]
+        self.lock.acquire()
+        try:
+            refresh = getattr(self.stream, 'refresh', None)
+            if refresh is not None:
+                # reopen a rotated file before using any string id
+                refresh()
+            out = []
+            if code == 'B':
+                self._check_strings(fields[:2])
+                values[0] = self._intern(fields[0], out)
+                values[1] = self._intern(fields[1], out)
+            elif code == 'E':
+                values[0] = _int(fields[0])
+                if len(fields) > 2:
+                    values[1] = _int(fields[1])
+                    values[2] = _int(fields[2])
+                else:
+                    values[1] = values[2] = -1
+            else:
+                for i, value in enumerate(fields[:3]):
+                    values[i] = _int(value)
+            out.append(RECORD.pack(code.encode('ascii'), pid, request_id,
+                                   when, *values))
+            self.stream.write(b''.join(out))
+        finally:
+            self.lock.release()
+
+    def _check_strings(self, values):
+        """ Make sure the table can take those of ``values`` it lacks, for
+        the record about to be written.
+        """
+        pid = os.getpid()
+        generation = getattr(self.stream, 'generation', None)
+        if pid != self.pid or generation != self.generation:
+            # ids are unique to the writing process;  don't reuse a table
+            # inherited across a fork, or whose strings were written to a
+            # file since rotated
+            self.strings = {}
+            self.pid = pid
+            self.generation = generation
+        else:
+            missing = len([x for x in values if x not in self.strings])
+            if len(self.strings) + missing > self.max_strings:
+                # ids are reused:  each is redefined before its next use,
+                # and never twice within a record
+                self.strings = {}
+
+    def _intern(self, value, out):
+        sid = self.strings.get(value)
+        if sid is None:
+            sid = self.strings[value] = (self.pid << 32) | len(self.strings)
+            data = value
+            if isinstance(data, TEXT):
+                data = data.encode('utf-8')
+            out.append(RECORD.pack(b'S', 0, 0, 0, sid, len(data), 0))
+            out.append(data)
+        return sid
+
+    def close(self):
+        self.stream.close()
+
+class BinaryTraceReader(object):
+    """ Read records from a binary trace log.
+
+    Records are returned in the same shape as parsed text trace log
+    lines:  ``[code, pid, request_id, fromepoch, desc]``.
+    """
+    def __init__(self, stream):
+        self.stream = stream
+        self.strings = {}
+        self._buf = bytearray()
+        self._pos = 0
+        self._next = None
+        if not self._fill(len(MAGIC)) or not self._at_magic():
+            raise ValueError('Not a binary trace log')
+
+    def _fill(self, size):
+        if len(self._buf) - self._pos >= size:
+            return True
+        del self._buf[:self._pos]
+        self._pos = 0
+        while len(self._buf) < size:
+            data = self.stream.read(65536)
+            if not data:
+                return False
+            self._buf += data
+        return True
+
+    def _at_magic(self):
+        if self._buf[self._pos:self._pos + len(MAGIC)] == MAGIC:
+            self._pos += len(MAGIC)
+            return True
+        return False
+
+    def read(self):
+        """ Return the next record, or None at the end of the log.
+        """
+        strings = self.strings
+        while self._fill(RECORD.size):
+            if self._at_magic():
+                continue
+            code, pid, request_id, t, a, b, c = RECORD.unpack_from(
+                self._buf, self._pos)
+            self._pos += RECORD.size
+            code = code.decode('ascii')
+            if code == 'S':
+                if not self._fill(b):
+                    return None
+                data = bytes(self._buf[self._pos:self._pos + b])
+                self._pos += b
+                strings[a] = data.decode('utf-8', 'replace')
+                continue
+            if code == 'B':
+                desc = '%s %s' % (strings.get(a, '?'), strings.get(b, '?'))
+            elif code == 'A':
+                desc = '%s %s' % (a, _optional(b))
+            elif code == 'E':
+                desc = '%s' % (_optional(a),)
+                if b >= 0:
+                    desc = '%s %s %s' % (desc, b, c)
+            else:
+                desc = ''
+            return [code, str(pid), str(request_id), t / 1e9, desc]
+        return None
+
+    def peek(self):
+        if self._next is None:
+            self._next = self.read()
+        return self._next
+
+    def advance(self):
+        self._next = None
+
+    def __iter__(self):
+        while True:
+            record = self.peek()
+            if record is None:
+                return
+            self.advance()
+            yield record
+
+def is_binary_trace(stream):
+    """ Does ``stream`` (opened in binary mode) start with ``MAGIC``?
+
+    The stream is left at its start.
+    """
+    head = stream.read(len(MAGIC))
+    stream.seek(0)
+    return head == MAGIC
@@ -1,6 +1,7 @@
 """GUI for presenting ways to look at the repoze.debug data
 
 """
+import json
 import mimetypes
 import os
 import pprint
@@ -9,6 +10,8 @@ import time
 from webob import Response
 
 from repoze.debug._compat import escape
+from repoze.debug.metrics import format_summaries
+from repoze.debug.metrics import render_prometheus
 
 _HERE = os.path.abspath(os.path.dirname(__file__))
 gui_flag = '__repoze.debug'
@@ -16,6 +19,16 @@ gui_flag = '__repoze.debug'
 def is_gui_url(environ):
     return gui_flag in environ.get('PATH_INFO', '')
 
+def _text_body(body):
+    # bodies are captured as bytes
+    if isinstance(body, bytes):
+        body = body.decode('latin1')
+    return body
+
+def _seconds(when):
+    # entries keep their times in integer nanoseconds
+    return when / 1e9
+
 def get_mimetype(filename):
     type, encoding = mimetypes.guess_type(filename)
     if type is None and filename.endswith(".xul"):
@@ -36,6 +49,12 @@ class DebugGui(object):
             resp = self.getStatic(path)
         elif gui_flag + '/feed.xml' in path:
             resp = self.getFeed()
+        elif gui_flag + '/latency.json' in path:
+            resp = self.getLatency(as_json=True)
+        elif gui_flag + '/latency' in path:
+            resp = self.getLatency()
+        elif gui_flag + '/metrics' in path:
+            resp = self.getMetrics()
         else:
             raise ValueError('No such handler for debug ui: %s', path)
 
@@ -62,8 +81,9 @@ class DebugGui(object):
     def _generateEntryTagURI(self, entry):
         """ See http//www.taguri.org """
         date = time.strftime('%Y-%m-%d', time.localtime(
-            entry['request']['begin']))
-        pid = self.middleware.pid
+            _seconds(entry['request']['begin'])))
+        # entries from a shared store record the pid which served them
+        pid = entry.get('pid', self.middleware.pid)
         return 'tag:repoze.org,%s:%s-%s' % (date, entry['id'], pid)
 
     def getFeed(self):
@@ -74,7 +94,7 @@ class DebugGui(object):
         for entry in self.middleware.entries:
             request = entry['request']
             response = entry.get('response')
-            begin = time.localtime(request['begin'])
+            begin = time.localtime(_seconds(request['begin']))
             entry_id = self._generateEntryTagURI(entry)
             entry_title = '%s %s ' % (request['method'], request['url'])
 
@@ -102,12 +122,12 @@ class DebugGui(object):
 
             # Make the <rz:request> node
             rzrequest = rzrequest_fmt % {
-                'begin': request['begin'],
+                'begin': _seconds(request['begin']),
                 'cgi_variables': cgivars,
                 'wsgi_variables': wsgivars,
                 'method': request['method'],
-                'url': request['url'],
-                'body': escape(request['body']),
+                'url': escape(request['url']),
+                'body': escape(_text_body(request['body'])),
                 }
 
             if response is not None:
@@ -119,12 +139,12 @@ class DebugGui(object):
                     headers = headers + s
 
                 rzresponse = rzresponse_fmt % {
-                    'begin': response['begin'],
-                    'end': response['end'],
+                    'begin': _seconds(response['begin']),
+                    'end': _seconds(response['end']),
                     'content-length': response['content-length'],
                     'headers': headers,
                     'status': response['status'],
-                    'body': escape(response['body']),
+                    'body': escape(_text_body(response['body'])),
                     }
             else:
                 rzresponse = ''
@@ -158,6 +178,34 @@ class DebugGui(object):
         resp = Response(content_type='application/atom+xml', body=body)
         return resp
 
+    def getLatency(self, as_json=False):
+        """Get the per-route latency percentiles, slowest first"""
+        latency = getattr(self.middleware, 'latency', None)
+        if latency is None:
+            return Response(status=404, content_type='text/plain',
+                            body=b'Latency statistics are disabled.\n')
+        summaries = latency.summaries()
+        if as_json:
+            body = json.dumps({'pid': self.middleware.pid,
+                               'routes': summaries}, indent=2)
+            return Response(content_type='application/json',
+                            body=body.encode('utf-8'))
+        body = format_summaries(summaries)
+        return Response(content_type='text/plain', body=body.encode('utf-8'))
+
+    def getMetrics(self):
+        """Get the request counters in the Prometheus text format"""
+        counters = getattr(self.middleware, 'counters', None)
+        if counters is None:
+            return Response(status=404, content_type='text/plain',
+                            body=b'Metrics are disabled.\n')
+        body = render_prometheus(counters, self.middleware.entries,
+                                 self.middleware.log_writer)
+        return Response(
+            body=body.encode('utf-8'),
+            headerlist=[('Content-Type',
+                         'text/plain; version=0.0.4; charset=utf-8')])
+
 feedfmt = """\
 <?xml version="1.0" encoding="utf-8"?>
 <atom:feed xmlns:atom="http://www.w3.org/2005/Atom">
@@ -0,0 +1,99 @@
+"""Watchdog reporting where slow requests are stuck.
+
+"""
+import os
+import sys
+import threading
+import traceback
+
+from repoze.debug import clock
+
+class Watchdog(object):
+    """ Report the stack of requests running for longer than ``threshold``
+    seconds.
+
+    A daemon thread checks the requests of ``registry`` (a
+    :class:`repoze.debug.inflight.InflightRegistry`) every ``interval``
+    seconds.  The stack of the thread serving a slow request is passed to
+    ``report(request, elapsed, stack)`` once or, if ``repeat`` is nonzero,
+    again every ``repeat`` seconds for as long as it keeps running.
+    """
+    def __init__(self, registry, threshold, report, interval=1.0, repeat=0):
+        self.registry = registry
+        self.threshold = threshold
+        self.report = report
+        self.interval = interval
+        self.repeat = repeat
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+        self.thread = None
+        self.pid = None
+
+    def ensure_started(self):
+        """ Start the watchdog thread, unless it runs in this process.
+
+        Called for each request, so that each (forked) worker process runs
+        its own thread.
+        """
+        pid = os.getpid()
+        if self.pid == pid:
+            return
+        self.lock.acquire()
+        try:
+            if self.pid == pid:
+                return
+            if self.pid is not None:
+                # forked:  the parent's requests aren't served here
+                self.registry.clear()
+            self.pid = pid
+            self.stopped.clear()
+            self.thread = threading.Thread(target=self.run,
+                                           name='repoze.debug watchdog')
+            self.thread.daemon = True
+            self.thread.start()
+        finally:
+            self.lock.release()
+
+    def stop(self):
+        self.stopped.set()
+        thread = self.thread
+        if thread is not None:
+            thread.join()
+        self.thread = self.pid = None
+
+    def run(self):
+        while True:
+            self.stopped.wait(self.interval)
+            if self.stopped.is_set():
+                return
+            try:
+                self.check()
+            except Exception:
+                traceback.print_exc()
+
+    def check(self, now=None, frames=None):
+        """ Report the stacks of the requests which are due.
+        """
+        if now is None:
+            now = clock.now()
+        due = []
+        for request in self.registry.snapshot():
+            if now - request.begin < self.threshold:
+                break # the others started later
+            if request.reported is None or (
+                self.repeat and now - request.reported >= self.repeat):
+                due.append(request)
+        if not due:
+            return
+        if frames is None:
+            frames = sys._current_frames()
+        for request in due:
+            frame = frames.get(request.thread_id)
+            # it may have finished meanwhile, and its thread moved on
+            if frame is None or self.registry.get(
+                request.request_id) is not request:
+                continue
+            request.reported = now
+            self.report(request, now - request.begin,
+                        ''.join(traceback.format_stack(frame)))
+        frame = frames = None
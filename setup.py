@@ -69,14 +69,18 @@ setup(name='repoze.debug',
       tests_require = requires,
       install_requires = requires,
       test_suite="repoze.debug",
+      test_loader="repoze.debug.tests:TestLoader",
       entry_points = """\
         [paste.filter_app_factory]
         responselogger = repoze.debug.responselogger:make_middleware
         canary = repoze.debug.canary:make_middleware
         pdbpm = repoze.debug.pdbpm:make_middleware
         threads = repoze.debug.threads:make_middleware
+        inflight = repoze.debug.inflight:make_middleware
         [console_scripts]
         wsgirequestprofiler = repoze.debug.scripts.requestprofiler:main
+        wsgireplay = repoze.debug.scripts.replay:main
+        wsgibenchmark = repoze.debug.scripts.benchmark:main
       """,
       extras_require = {
         'testing':  requires + testing_extras,